@@ -1,51 +1,123 @@
-from fastapi import FastAPI, Request, Form
+from contextlib import asynccontextmanager, contextmanager
+from fastapi import FastAPI, Request, Response, Form
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from moodify_engine import MoodifyEngine
-import cv2
+from moodify_engine import (EMOTIONS, RECOMMENDATION_MODE, MoodifyEngine, decode_grayscale, get_top_emotion,
+                            get_weather_cell)
+from frame_cache import FrameCache, dhash
+from weather_prefetch import WeatherPrefetcher
 import base64
-import numpy as np
+import hmac
+import math
+import time
 import uvicorn
 import os
 
-app = FastAPI()
+# Keyword arguments of MoodifyEngine, set by serve.py before workers start
+ENGINE_OPTIONS = {}
 
-# Global engine instance
-engine = MoodifyEngine()
+# Global engine instance, created at startup (in every worker of serve.py)
+engine = None
+# Keeps weather of frequently requested locations fresh, see weather_prefetch.py
+prefetcher = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global engine, prefetcher
+    engine = MoodifyEngine(**ENGINE_OPTIONS)
+    prefetcher = WeatherPrefetcher(
+        engine,
+        max_cells=int(os.getenv("MOODIFY_WEATHER_PREFETCH_CELLS", "50")),
+        max_requests_per_minute=int(os.getenv("MOODIFY_WEATHER_PREFETCH_RPM", "30")))
+    if os.getenv("MOODIFY_WEATHER_PREFETCH", "1") != "0":
+        prefetcher.start()
+    yield
+    await prefetcher.stop()
+    engine.catalog.stop()
+
+app = FastAPI(lifespan=lifespan)
+
+# Results of near-identical frames of the same client, see frame_cache.py
+frame_cache = FrameCache(ttl=float(os.getenv("MOODIFY_FRAME_CACHE_TTL", "10")))
 
 templates = Jinja2Templates(directory="templates")
 
+class StageTimer:
+    """Times the stages of a request and reports them in a Server-Timing header"""
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, (time.perf_counter() - start) * 1000))
+
+    def header(self):
+        return ", ".join(f"{name};dur={duration:.2f}" for name, duration in self.stages)
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.post("/analyze")
-async def analyze(request: Request):
+async def analyze(request: Request, response: Response):
+    timer = StageTimer()
+    try:
+        return await _analyze(request, timer)
+    finally:
+        response.headers["Server-Timing"] = timer.header()
+
+async def _analyze(request, timer):
     data = await request.json()
     img_data = data['image'].split(",")[1]
     
-    # Convert base64 to opencv image
-    nparr = np.frombuffer(base64.b64decode(img_data), np.uint8)
-    frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    # Decode base64 straight to a reduced grayscale image
+    with timer.stage("decode"):
+        gray, scale = decode_grayscale(base64.b64decode(img_data))
+    if gray is None:
+        return {"error": "Invalid image"}
     
-    # Detect Emotion
-    emotion, coords = engine.detect_emotion(frame)
-    if not emotion:
+    # Detect Emotion, unless the client's frame has not meaningfully changed
+    session = data.get('session') or request.client.host
+    with timer.stage("cache"):
+        frame_hash = dhash(gray)
+        cached = frame_cache.lookup(session, frame_hash, gray)
+    if cached is None:
+        with timer.stage("detect"):
+            cached = engine.detect_emotion_probabilities(gray)
+        frame_cache.store(session, frame_hash, cached, gray, cached[1])
+    probabilities, coords = cached
+    if probabilities is None:
         return {"error": "No face detected"}
+    emotion = get_top_emotion(probabilities)
     
-    # Coordinates for drawing box on frontend
-    x, y, w, h = [int(v) for v in coords]
+    # Coordinates for drawing box on frontend (in the original frame size)
+    x, y, w, h = [int(v) * scale for v in coords]
     
     # Get Weather
-    weather = engine.get_weather()
+    with timer.stage("weather"):
+        weather = engine.get_weather()
     
-    # Get Recommendation
-    song_name, details = engine.get_recommendation(emotion, weather)
-    spotify_url = engine.search_spotify(song_name)
+    # Get Recommendation, from the top emotion or blended over all of them
+    with timer.stage("recommend"):
+        if data.get('mode', RECOMMENDATION_MODE) == "blend":
+            song_emotion, song_name, details = engine.get_blended_recommendation(probabilities, weather)[0]
+        else:
+            song_emotion = emotion
+            song_name, details = engine.get_recommendation(emotion, weather)
+    with timer.stage("spotify"):
+        spotify_url = engine.search_spotify(song_name)
     
     return {
         "emotion": emotion.capitalize(),
+        "probabilities": get_probability_dict(probabilities),
+        "song_emotion": song_emotion.capitalize(),
         "weather": weather.replace("-", " ").capitalize(),
         "song": song_name,
         "spotify_url": spotify_url,
@@ -54,25 +126,70 @@ async def analyze(request: Request):
         "box": {"x": x, "y": y, "w": w, "h": h}
     }
 
+def get_probability_dict(probabilities):
+    """Probabilities of all emotions by name, as returned to clients"""
+    return {e: round(float(p), 4) for e, p in zip(EMOTIONS, probabilities)}
+
+def parse_probabilities(value):
+    """Parse a comma-separated list of emotion probabilities in EMOTIONS order.
+    Returns None if it is not a valid distribution."""
+    try:
+        probabilities = [float(p) for p in value.split(",")]
+    except ValueError:
+        return None
+    if len(probabilities) != len(EMOTIONS) or min(probabilities) < 0 or not 0 < sum(probabilities) < float("inf"):
+        return None
+    return probabilities
+
+def is_number(value):
+    """Whether a JSON or query value is a finite number or a numeric string"""
+    if isinstance(value, bool):
+        return False
+    try:
+        return math.isfinite(float(value))
+    except (TypeError, ValueError):
+        return False
+
 # ============================================================
 # ANDROID API ENDPOINT
 # The Android app runs the TFLite model locally on-device,
 # detects the emotion, and sends only the emotion name + GPS.
 # This endpoint handles weather lookup + song recommendation.
+# Instead of the emotion name, the app can send all 8 model
+# outputs as probabilities=p1,...,p8 to get a blended pick.
 # ============================================================
 @app.get("/recommend")
-async def recommend(emotion: str, lat: str = "18.5204", lng: str = "73.8567"):
-    emotion = emotion.lower()
+async def recommend(response: Response, emotion: str = None, probabilities: str = None,
+                    lat: str = "18.5204", lng: str = "73.8567"):
     valid_emotions = ['neutral', 'happiness', 'surprise', 'sadness', 'anger', 'disgust', 'fear', 'contempt']
+    if probabilities is not None:
+        probabilities = parse_probabilities(probabilities)
+        if probabilities is None:
+            return {"error": f"Invalid probabilities. Must be {len(valid_emotions)} non-negative numbers "
+                             f"in this order: {valid_emotions}"}
+        emotion = emotion or get_top_emotion(probabilities)
+    emotion = (emotion or "").lower()
     if emotion not in valid_emotions:
         return {"error": f"Invalid emotion. Must be one of: {valid_emotions}"}
+    if not (is_number(lat) and is_number(lng)):
+        return {"error": "Invalid location. lat and lng must be numbers"}
 
-    weather = engine.get_weather(lat, lng)
-    song_name, details = engine.get_recommendation(emotion, weather)
-    spotify_url = engine.search_spotify(song_name)
+    timer = StageTimer()
+    with timer.stage("weather"):
+        weather = engine.get_weather(lat, lng)
+    with timer.stage("recommend"):
+        if probabilities is not None:
+            song_emotion, song_name, details = engine.get_blended_recommendation(probabilities, weather)[0]
+        else:
+            song_emotion = emotion
+            song_name, details = engine.get_recommendation(emotion, weather)
+    with timer.stage("spotify"):
+        spotify_url = engine.search_spotify(song_name)
+    response.headers["Server-Timing"] = timer.header()
 
     return {
         "emotion": emotion.capitalize(),
+        "song_emotion": song_emotion.capitalize(),
         "weather": weather.replace("-", " ").capitalize(),
         "song": song_name,
         "spotify_url": spotify_url,
@@ -81,9 +198,182 @@ async def recommend(emotion: str, lat: str = "18.5204", lng: str = "73.8567"):
         "acoustic_strategy": details['acoustic_strategy']
     }
 
+# Columns of rows returned by /recommend/batch
+BATCH_FIELDS = ["emotion", "probability", "weather", "song", "spotify_url", "genre", "mechanism", "acoustic_strategy"]
+MAX_BATCH_SIZE = 500
+# Distinct weather cells per batch, each uncached one costs an Ambee call
+MAX_BATCH_CELLS = 50
+
+def parse_batch_request(data):
+    """Parse the body of /recommend/batch into (emotion, lat, lng) items and
+    their probabilities (None for explicit requests). Raises ValueError with
+    a message for the client if the body is invalid."""
+    valid_emotions = ['neutral', 'happiness', 'surprise', 'sadness', 'anger', 'disgust', 'fear', 'contempt']
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+
+    if 'probabilities' in data:
+        probabilities = data['probabilities']
+        if isinstance(probabilities, list):
+            if len(probabilities) != len(valid_emotions):
+                raise ValueError(f"probabilities must have {len(valid_emotions)} values in this order: "
+                                 f"{valid_emotions}")
+            probabilities = dict(zip(valid_emotions, probabilities))
+        if not isinstance(probabilities, dict):
+            raise ValueError("probabilities must be a list or an {emotion: probability} object")
+        if not all(is_number(p) and float(p) >= 0 for p in probabilities.values()):
+            raise ValueError("probabilities must be non-negative numbers")
+        lat, lng = data.get('lat', "18.5204"), data.get('lng', "73.8567")
+        ranked = sorted(((float(p), str(e).lower()) for e, p in probabilities.items() if float(p) > 0),
+                        reverse=True)
+        items = [(e, lat, lng) for _, e in ranked]
+        item_probabilities = [p for p, _ in ranked]
+    else:
+        rows = data.get('requests', [])
+        if not isinstance(rows, list):
+            raise ValueError("requests must be a list")
+        items = []
+        for i, r in enumerate(rows):
+            if isinstance(r, dict) and 'emotion' in r:
+                items.append((r['emotion'], r.get('lat', "18.5204"), r.get('lng', "73.8567")))
+            elif isinstance(r, list) and len(r) == 3:
+                items.append(tuple(r))
+            else:
+                raise ValueError(f"Invalid request at index {i}. Must be [emotion, lat, lng] "
+                                 f"or an object with these keys")
+        item_probabilities = [None] * len(items)
+
+    if len(items) > MAX_BATCH_SIZE:
+        raise ValueError(f"Too many requests in a batch, the limit is {MAX_BATCH_SIZE}")
+    invalid = [i for i, (e, _, _) in enumerate(items) if not isinstance(e, str) or e.lower() not in valid_emotions]
+    if invalid:
+        raise ValueError(f"Invalid emotion at indexes {invalid}. Must be one of: {valid_emotions}")
+    invalid = [i for i, (_, lat, lng) in enumerate(items) if not (is_number(lat) and is_number(lng))]
+    if invalid:
+        raise ValueError(f"Invalid location at indexes {invalid}. lat and lng must be numbers")
+    if len(set(get_weather_cell(lat, lng) for _, lat, lng in items)) > MAX_BATCH_CELLS:
+        raise ValueError(f"Too many locations in a batch, the limit is {MAX_BATCH_CELLS} weather cells")
+    return [(e.lower(), lat, lng) for e, lat, lng in items], item_probabilities
+
+@app.post("/recommend/batch")
+async def recommend_batch(request: Request, response: Response):
+    """Recommend songs for many devices or emotions in one request.
+
+    Body is either {"requests": [[emotion, lat, lng], ...]} (items may also be
+    objects with these keys) or {"lat", "lng", "probabilities"} with a list of
+    8 probabilities (in /analyze class order) or an {emotion: probability}
+    object, which returns one row per emotion with non-zero probability, most
+    probable first. Rows are arrays with the columns listed in "fields".
+    The weather and Spotify lookups run in the thread pool, so a large batch
+    does not block other requests.
+    """
+    try:
+        items, item_probabilities = parse_batch_request(await request.json())
+    except ValueError as e:
+        return {"error": str(e)}
+
+    timer = StageTimer()
+    with timer.stage("batch"):
+        recommendations = await run_in_threadpool(engine.recommend_batch, items)
+    response.headers["Server-Timing"] = timer.header()
+
+    return {
+        "fields": BATCH_FIELDS,
+        "results": [
+            [emotion.capitalize(), p, weather.replace("-", " ").capitalize(), song, spotify_url,
+             details['genre'], details['mechanism'], details['acoustic_strategy']]
+            for (emotion, _, _), p, (weather, song, spotify_url, details)
+            in zip(items, item_probabilities, recommendations)
+        ]
+    }
+
 @app.get("/health")
 async def health():
-    return {"status": "ok", "model": "ferplus_model_pd_best.tflite"}
+    return {"status": "ok", "model": engine.models.active.name}
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "frame_cache": frame_cache.get_metrics(),
+        "models": engine.models.get_metrics(),
+        "weather": prefetcher.get_metrics(),
+        "catalog": engine.catalog.get_metrics(),
+    }
+
+# ============================================================
+# MODEL MANAGEMENT
+# Hot-swap the active model and configure an A/B or shadow
+# candidate. With serve.py every worker has its own registry,
+# so these only affect the worker that handles the request;
+# use the MOODIFY_* variables to configure all workers.
+# ============================================================
+@app.get("/models")
+async def models():
+    return {"available": engine.models.available_models(), **engine.models.get_metrics()}
+
+# Changing models needs this token in the X-Admin-Token header. Without it,
+# only requests from the local host may change models.
+ADMIN_TOKEN = os.getenv("MOODIFY_ADMIN_TOKEN")
+LOCAL_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+def get_admin_error(request):
+    """Return why a request may not change models, or None if it may"""
+    if ADMIN_TOKEN:
+        token = request.headers.get("X-Admin-Token", "")
+        if hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return None
+        return "Invalid admin token"
+    if request.client is not None and request.client.host in LOCAL_HOSTS:
+        return None
+    return "Models can only be changed from localhost unless MOODIFY_ADMIN_TOKEN is set"
+
+async def get_admin_request_data(request, response):
+    """Return (JSON object, None) of a model management request, or
+    (None, error dict) after setting the response status"""
+    error = get_admin_error(request)
+    if error:
+        response.status_code = 403
+        return None, {"error": error}
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        response.status_code = 400
+        return None, {"error": "Request body must be a JSON object"}
+    return data, None
+
+@app.post("/models/activate")
+async def activate_model(request: Request, response: Response):
+    data, error = await get_admin_request_data(request, response)
+    if error:
+        return error
+    name = data.get('name')
+    if not isinstance(name, str) or not name:
+        response.status_code = 400
+        return {"error": "Missing model name"}
+    try:
+        # Loading and warming up a model takes a while, keep it off the event loop
+        previous = await run_in_threadpool(engine.models.activate, name)
+    except ValueError as e:
+        response.status_code = 400
+        return {"error": str(e)}
+    return {"active": name, "previous": previous}
+
+@app.post("/models/candidate")
+async def set_candidate_model(request: Request, response: Response):
+    data, error = await get_admin_request_data(request, response)
+    if error:
+        return error
+    try:
+        await run_in_threadpool(engine.models.set_candidate,
+                                data.get('name'),
+                                traffic_percent=data.get('traffic_percent', 0),
+                                shadow_percent=data.get('shadow_percent', 0))
+    except (TypeError, ValueError) as e:
+        response.status_code = 400
+        return {"error": str(e)}
+    return engine.models.get_metrics()
 
 if __name__ == "__main__":
     if not os.path.exists("templates"):
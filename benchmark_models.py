@@ -0,0 +1,231 @@
+import argparse
+from datetime import datetime, timezone
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+
+import numpy as np
+
+
+# Default hyperparameters of the training notebook
+LEAKY_RELU_SLOPE = 0.02
+DROPOUT_RATE = 0.10
+REGULARIZATION_RATE = 0.01
+
+VARIANTS = ['smart', 'base', 'performance']
+
+FORMATS = ['float', 'dynamic_range', 'int8']
+
+BATCH_SIZES = [1, 8, 32, 128]
+
+THREADS = [1, 2, 4]
+
+
+def build_model(variant, checkpoint_path = None):
+    '''Builds the model variant defined in models.py.
+
+    Args:
+        variant(string): 'smart', 'base' or 'performance'
+        checkpoint_path(string): optional path to trained weights, the model
+                                 keeps random weights if it is not given
+
+    Returns: keras.Model
+    '''
+    from tensorflow import keras
+    import models
+
+    kwargs = {'leaky_relu_slope': LEAKY_RELU_SLOPE,
+              'dropout_rate': DROPOUT_RATE,
+              'regularization_rate': REGULARIZATION_RATE}
+    if variant == 'smart':
+        model = models.get_smart_model(keras.Input(shape = (48, 48, 1)), **kwargs)
+    elif variant == 'base':
+        model = models.get_base_model(**kwargs)
+    elif variant == 'performance':
+        model = models.get_performance_model(**kwargs)
+    else:
+        raise ValueError('Unknown model variant: {}'.format(variant))
+
+    if checkpoint_path is not None:
+        model.load_weights(checkpoint_path)
+    return model
+
+def benchmark_variant(variant,
+                      checkpoint_path = None,
+                      formats = FORMATS,
+                      batch_sizes = BATCH_SIZES,
+                      threads = THREADS,
+                      n_runs = 100):
+    '''Builds the variant, converts it to tflite and measures every format.
+
+    Args:
+        variant(string): 'smart', 'base' or 'performance'
+        checkpoint_path(string): optional path to trained weights
+        formats(list): tflite formats to measure ('float', 'dynamic_range'
+                       with int8 weights and float activations, 'int8' with
+                       int8 weights, activations, input and output)
+        batch_sizes(list): batch sizes for the throughput measurement
+        threads(list): thread counts for the thread scaling measurement
+        n_runs(int): number of timed invokes per measurement
+
+    Returns: a dict with results of the variant.
+    '''
+    import tflite_utils
+
+    model = build_model(variant, checkpoint_path)
+    # Calibration images, random when there is no dataset at hand
+    representative_images = np.random.default_rng(0).integers(
+        0, 256, size = (100, 48, 48, 1)
+    ).astype(np.uint8)
+
+    results = {'variant': variant,
+               'checkpoint': checkpoint_path,
+               'parameters': int(model.count_params()),
+               'formats': {}}
+    for tflite_format in formats:
+        tflite_model = tflite_utils.convert_to_tflite(
+            model,
+            quantize = tflite_format != 'float',
+            representative_images = (representative_images
+                                     if tflite_format == 'int8' else None),
+            integer_io = tflite_format == 'int8'
+        )
+        results['formats'][tflite_format] = _run_isolated(_benchmark_tflite,
+                                                          tflite_model,
+                                                          batch_sizes,
+                                                          threads,
+                                                          n_runs)
+    return results
+
+def run_benchmarks(variants = VARIANTS, checkpoints = None, **kwargs):
+    '''Runs benchmarks of all variants.
+
+    Args:
+        variants(list): names of variants to benchmark
+        checkpoints(dict(string, string)): optional trained weights per variant
+        kwargs: passed to benchmark_variant
+
+    Returns: a dict with environment metadata and results of every variant.
+    '''
+    import tensorflow as tf
+
+    checkpoints = checkpoints or {}
+    return {'created': datetime.now(timezone.utc).isoformat(),
+            'commit': _get_commit(),
+            'tensorflow': tf.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'results': [benchmark_variant(variant,
+                                          checkpoints.get(variant),
+                                          **kwargs)
+                        for variant in variants]}
+
+def _benchmark_tflite(tflite_model, batch_sizes, threads, n_runs):
+    '''Measures a single tflite model. Runs in a separate process, so that its
+    peak memory can be measured.'''
+    import tflite_utils
+
+    baseline_rss = _get_peak_rss_mb()
+    results = {
+        'size_bytes': len(tflite_model),
+        'single_image': tflite_utils.measure_tflite_latency(tflite_model,
+                                                            n_runs = n_runs),
+        'batch_throughput': {
+            str(batch_size): tflite_utils.measure_tflite_latency(
+                tflite_model,
+                batch_size = batch_size,
+                n_runs = max(10, n_runs // batch_size)
+            )
+            for batch_size in batch_sizes
+        },
+        'thread_scaling': {
+            str(num_threads): tflite_utils.measure_tflite_latency(
+                tflite_model,
+                num_threads = num_threads,
+                n_runs = n_runs
+            )
+            for num_threads in threads
+        }
+    }
+    results['peak_memory_mb'] = _get_peak_rss_mb()
+    results['peak_memory_delta_mb'] = results['peak_memory_mb'] - baseline_rss
+    return results
+
+def _run_isolated(function, *args):
+    '''Runs the function in a fresh process and returns its result'''
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(function, args)
+
+def _get_peak_rss_mb():
+    '''Returns peak resident memory of the current process in MB'''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2 ** 20 if platform.system() == 'Darwin' else peak / 2 ** 10
+
+def _get_commit():
+    '''Returns current git commit or None if it is not available'''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _print_summary(report):
+    '''Prints the most important numbers as a console table'''
+    header = '{:<12} {:<14} {:>10} {:>10} {:>10} {:>14}'.format('Variant',
+                                                               'Format',
+                                                               'Size [kB]',
+                                                               'p50 [ms]',
+                                                               'Peak [MB]',
+                                                               'Max img/s')
+    print(header)
+    print('-' * len(header))
+    for result in report['results']:
+        for tflite_format, r in result['formats'].items():
+            max_throughput = max(b['images_per_sec']
+                                 for b in r['batch_throughput'].values())
+            print('{:<12} {:<14} {:>10.1f} {:>10.3f} {:>10.1f} {:>14.0f}'.format(
+                result['variant'],
+                tflite_format,
+                r['size_bytes'] / 1024.,
+                r['single_image']['p50_ms'],
+                r['peak_memory_mb'],
+                max_throughput))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmark inference cost '
+                                                   'of models.py architectures')
+    parser.add_argument('--variants', nargs = '+', default = VARIANTS,
+                        choices = VARIANTS)
+    parser.add_argument('--checkpoint', action = 'append', default = [],
+                        metavar = 'VARIANT=PATH',
+                        help = 'trained weights of a variant, random weights '
+                               'are used if not given')
+    parser.add_argument('--formats', nargs = '+', default = FORMATS,
+                        choices = FORMATS)
+    parser.add_argument('--batch-sizes', nargs = '+', type = int,
+                        default = BATCH_SIZES)
+    parser.add_argument('--threads', nargs = '+', type = int, default = THREADS)
+    parser.add_argument('--runs', type = int, default = 100)
+    parser.add_argument('--output', default = 'benchmark_models.json')
+    args = parser.parse_args()
+
+    checkpoints = dict(c.split('=', 1) for c in args.checkpoint)
+    report = run_benchmarks(args.variants,
+                            checkpoints,
+                            formats = args.formats,
+                            batch_sizes = args.batch_sizes,
+                            threads = args.threads,
+                            n_runs = args.runs)
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent = 2)
+    _print_summary(report)
+    print('Results saved to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
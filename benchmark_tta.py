@@ -0,0 +1,139 @@
+from data import dataset
+from data.data import get_image_data, get_labels
+from data.model_class.DataPipelineParams import DataPipelineParams, Dataset
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from moodify_engine import FACE_SIZE, TTA_SHIFT, get_tta_batch
+import tflite_utils
+
+
+MODEL_PATH = os.path.join('model', 'ferplus_model_pd_best.tflite')
+
+
+def benchmark_tta(tflite_model,
+                  images,
+                  labels,
+                  num_threads = 1,
+                  n_warmup = 10):
+    '''Classifies every face once with the single center crop used by
+    MoodifyEngine and once with its test-time augmentation batch, and
+    measures accuracy and per-face latency (preprocessing and invoke) of both.
+
+    Dataset images are already aligned 48x48 faces, so the TTA margin is made
+    by replicating their border pixels.
+
+    Args:
+        tflite_model(string or bytes): path to .tflite model or its content
+        images(ndarray): (n, 48, 48, 1) unnormalized test images
+        labels(ndarray): (n,) integer majority labels
+        num_threads(int): number of interpreter threads
+        n_warmup(int): number of untimed faces per mode
+
+    Returns: a dict with results of both modes.
+    '''
+    faces = images.reshape(-1, FACE_SIZE, FACE_SIZE).astype(np.uint8)
+    modes = {'single': _get_single_batch, 'tta': _get_tta_batch}
+
+    results = {}
+    for mode, get_batch in modes.items():
+        batch_size = len(get_batch(faces[0]))
+        interpreter = tflite_utils.get_interpreter(tflite_model, num_threads)
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        from_logits = tflite_utils.outputs_are_logits(interpreter)
+        interpreter.resize_tensor_input(input_index,
+                                        [batch_size, FACE_SIZE, FACE_SIZE, 1])
+        interpreter.allocate_tensors()
+
+        def classify(face):
+            interpreter.set_tensor(input_index, get_batch(face))
+            interpreter.invoke()
+            ps = tflite_utils.to_probabilities(interpreter.get_tensor(output_index),
+                                              from_logits)
+            return ps.mean(axis = 0).argmax()
+
+        for face in faces[:n_warmup]:
+            classify(face)
+
+        predictions = np.empty(len(faces), dtype = np.int64)
+        times = np.empty(len(faces))
+        for i, face in enumerate(faces):
+            start = time.perf_counter()
+            predictions[i] = classify(face)
+            times[i] = time.perf_counter() - start
+
+        times *= 1000.
+        results[mode] = {'batch_size': batch_size,
+                         'accuracy': float(np.mean(predictions == labels)),
+                         'mean_ms': float(times.mean()),
+                         'p50_ms': float(np.percentile(times, 50)),
+                         'p95_ms': float(np.percentile(times, 95)),
+                         'faces_per_sec': float(1000. / times.mean())}
+
+    results['accuracy_gain'] = results['tta']['accuracy'] - results['single']['accuracy']
+    results['latency_ratio'] = results['tta']['p50_ms'] / results['single']['p50_ms']
+    return results
+
+def _get_single_batch(face):
+    '''Returns the single center crop batch, as used by MoodifyEngine'''
+    return (face.astype(np.float32) / 255.)[np.newaxis, ..., np.newaxis]
+
+def _get_tta_batch(face):
+    '''Returns the TTA batch of an aligned face with replicated border'''
+    return get_tta_batch(np.pad(face, TTA_SHIFT, mode = 'edge'))
+
+def _print_results(results):
+    '''Prints both modes as a console table'''
+    header = '{:<8} {:>6} {:>10} {:>10} {:>10} {:>12}'.format('Mode',
+                                                            'Batch',
+                                                            'Accuracy',
+                                                            'p50 [ms]',
+                                                            'p95 [ms]',
+                                                            'Faces/s')
+    print(header)
+    print('-' * len(header))
+    for mode in ['single', 'tta']:
+        r = results[mode]
+        print('{:<8} {:>6} {:>10.4f} {:>10.3f} {:>10.3f} {:>12.0f}'.format(
+            mode,
+            r['batch_size'],
+            r['accuracy'],
+            r['p50_ms'],
+            r['p95_ms'],
+            r['faces_per_sec']))
+    print('Accuracy gain: {:+.4f}, latency x{:.2f}'.format(results['accuracy_gain'],
+                                                          results['latency_ratio']))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Measure accuracy gain and '
+                                                   'latency cost of TTA')
+    parser.add_argument('--model', default = MODEL_PATH)
+    parser.add_argument('--dataset-dir', default = 'dataset')
+    parser.add_argument('--threads', type = int, default = 1)
+    parser.add_argument('--limit', type = int, default = None,
+                        help = 'number of test images to use (all by default)')
+    parser.add_argument('--output', default = 'benchmark_tta.json')
+    args = parser.parse_args()
+
+    # The engine serves the FER-Plus model, test on majority labels
+    params = DataPipelineParams(dataset = Dataset.FERPLUS, sparse_labels = True)
+    test_df = dataset.get_dataset_dict(args.dataset_dir)['test']
+    images = get_image_data(test_df, params)[:args.limit]
+    labels = get_labels(test_df, params)[:args.limit]
+
+    results = benchmark_tta(args.model, images, labels, args.threads)
+    results.update({'model': args.model,
+                    'threads': args.threads,
+                    'n_images': len(images)})
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent = 2)
+    _print_results(results)
+    print('Results saved to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
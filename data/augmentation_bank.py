@@ -0,0 +1,173 @@
+from . import data
+import json
+import math
+import os
+
+import numpy as np
+import tensorflow as tf
+
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Upper bound of the epoch counter of an endless training pipeline
+MAX_EPOCHS = 2 ** 31 - 1
+
+
+def build_augmentation_bank(dataset_df,
+                            params,
+                            bank_dir,
+                            n_epochs,
+                            shard_size = 4096):
+    '''Pre-generates n_epochs augmented copies of the training dataset using the
+    same ImageDataGenerator as data.get_data_pipeline and saves them as
+    compressed shards. Epoch k is generated with seed params.seed + k, so the
+    bank is deterministic and can be reused by every run of a sweep. Every
+    epoch holds the samples in a different random permutation, like the
+    shuffled iterator of data.get_data_pipeline.
+
+    Args:
+        dataset_df(dataframe): training dataset loaded from a unified dataset
+                               created using dataset.get_dataset_dict()
+        params(DataPipelineParams): wrapper object with pipeline parameters
+        bank_dir(string): a path to a directory where shards will be saved
+        n_epochs(int): number of augmented epochs to generate
+        shard_size(int): number of images in a single shard
+
+    Returns: a dict with the bank manifest (also saved in bank_dir).
+    '''
+    os.makedirs(bank_dir, exist_ok = True)
+
+    image_gen = data._get_image_generator(params.augmentation, True)
+    images, labels = data._get_images_labels(dataset_df,
+                                             params.dataset,
+                                             params.cross_entropy,
+                                             params.original_preprocessing,
+                                             params.sparse_labels)
+    n_shards = math.ceil(len(images) / shard_size)
+
+    shards = []
+    for epoch in range(n_epochs):
+        # Shards follow a new permutation of the samples in every epoch
+        order = np.random.default_rng(params.seed + epoch).permutation(len(images))
+        ds_iterator = image_gen.flow(x = images[order],
+                                     y = labels[order],
+                                     batch_size = shard_size,
+                                     seed = params.seed + epoch,
+                                     shuffle = False)
+        epoch_shards = []
+        for i in range(n_shards):
+            image_batch, label_batch = next(ds_iterator)
+            # Color range [0, 1] -> [0, 255] to store compact uint8 images
+            image_batch = np.rint(image_batch * 255.).astype(np.uint8)
+            file_name = 'epoch_{:03d}_shard_{:03d}.npz'.format(epoch, i)
+            np.savez_compressed(os.path.join(bank_dir, file_name),
+                                images = image_batch,
+                                labels = label_batch)
+            epoch_shards.append(file_name)
+        shards.append(epoch_shards)
+        print('Epoch {}/{}: {} shards saved'.format(epoch + 1,
+                                                    n_epochs,
+                                                    n_shards))
+
+    manifest = {'n_epochs': n_epochs,
+                'n_elements': len(images),
+                'shard_size': shard_size,
+                'seed': params.seed,
+                'dataset': params.dataset.name,
+                'augmentation': params.augmentation.name,
+                'cross_entropy': params.cross_entropy,
+                'original_preprocessing': params.original_preprocessing,
+                'sparse_labels': data.has_sparse_labels(params),
+                'label_dtype': labels.dtype.name,
+                'image_shape': list(images.shape[1:]),
+                'label_shape': list(labels.shape[1:]),
+                'shards': shards}
+    with open(os.path.join(bank_dir, MANIFEST_FILE_NAME), 'w') as file:
+        json.dump(manifest, file, indent = 2)
+
+    return manifest
+
+def read_manifest(bank_dir):
+    '''Reads the manifest of a previously built augmentation bank'''
+    with open(os.path.join(bank_dir, MANIFEST_FILE_NAME), 'r') as file:
+        return json.load(file)
+
+def get_augmentation_bank_pipeline(bank_dir,
+                                   params,
+                                   n_workers = 4,
+                                   initial_epoch = 0):
+    '''Get training pipeline that streams pre-generated augmented epochs from
+    the bank. Shards are read and decompressed in parallel by n_workers and
+    the bank is cycled if training runs for more epochs than it holds. The
+    order of shards is shuffled with a seed of the epoch and samples are
+    shuffled in a buffer spanning n_workers shards, so a run resumed at
+    initial_epoch does not replay the order of epoch 0.
+
+    Args:
+        bank_dir(string): a path to a directory with the augmentation bank
+        params(DataPipelineParams): wrapper object with pipeline parameters,
+                                    they have to match the ones of the bank
+        n_workers(int): number of shards read in parallel
+        initial_epoch(int): epoch to start from
+
+    Returns: a tuple (dataset, steps_per_epoch). The dataset is endless, so
+             steps_per_epoch has to be passed to model.fit().
+    '''
+    manifest = read_manifest(bank_dir)
+    _check_manifest(manifest, params)
+
+    shard_paths = [[os.path.join(bank_dir, file_name) for file_name in epoch]
+                   for epoch in manifest['shards']]
+    shard_paths = tf.constant(shard_paths)
+    n_bank_epochs = manifest['n_epochs']
+    image_shape = manifest['image_shape']
+    label_shape = manifest['label_shape']
+    label_dtype = tf.as_dtype(manifest['label_dtype'])
+
+    def load_shard(path):
+        images, labels = tf.numpy_function(_read_shard,
+                                           [path],
+                                           (tf.uint8, label_dtype))
+        images.set_shape([None] + image_shape)
+        labels.set_shape([None] + label_shape)
+        return tf.data.Dataset.from_tensor_slices((images, labels))
+
+    n_shards = len(manifest['shards'][0])
+
+    ds = tf.data.Dataset.range(initial_epoch, MAX_EPOCHS)
+    ds = ds.flat_map(lambda epoch: tf.data.Dataset.from_tensor_slices(
+        shard_paths[epoch % n_bank_epochs]
+    ).shuffle(n_shards, seed = params.seed + epoch))
+    ds = ds.interleave(load_shard,
+                       cycle_length = n_workers,
+                       num_parallel_calls = n_workers,
+                       deterministic = True)
+    ds = ds.shuffle(manifest['shard_size'] * n_workers,
+                    seed = params.seed + initial_epoch)
+    ds = ds.batch(params.batch_size)
+    ds = ds.map(lambda x, y: (tf.cast(x, tf.float32) / 255., y),
+                num_parallel_calls = AUTOTUNE)
+
+    steps_per_epoch = math.ceil(manifest['n_elements'] / params.batch_size)
+    return ds.prefetch(AUTOTUNE), steps_per_epoch
+
+def _read_shard(path):
+    '''Loads (images, labels) from a shard file'''
+    with np.load(path.decode()) as shard:
+        return shard['images'], shard['labels']
+
+def _check_manifest(manifest, params):
+    '''Raises ValueError if the bank was built with different parameters'''
+    expected = {'dataset': params.dataset.name,
+                'augmentation': params.augmentation.name,
+                'cross_entropy': params.cross_entropy,
+                'original_preprocessing': params.original_preprocessing,
+                'sparse_labels': data.has_sparse_labels(params)}
+    for key, value in expected.items():
+        if manifest[key] != value:
+            raise ValueError('Augmentation bank was built with {} = {}, '
+                             'but {} was requested'.format(key,
+                                                           manifest[key],
+                                                           value))
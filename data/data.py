@@ -1,7 +1,9 @@
 from . import outliers_processing as op
 from .model_class.DataPipelineParams import DataPipelineParams
 from .model_class.DataPipelineParams import Augmentation, Dataset
+from .profiling import profile_stage
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
+from tensorflow.keras.preprocessing.image import NumpyArrayIterator
 
 import numpy as np
 
@@ -33,10 +35,17 @@ COLUMN_NAMES = ['dataset', 'image', 'fer_code', 'neutral', 'happiness', \
 
 IMG_SHAPE = 48
 
+# Color range of decoded dataset images and of images produced by the
+# pipelines (rescaled by 1/255), e.g. for predictions.render_contact_sheet
+RAW_VALUE_RANGE = (0., 255.)
+PIPELINE_VALUE_RANGE = (0., 1.)
 
+
+@profile_stage('get_data_pipeline')
 def get_data_pipeline(dataset_df,
                       params,
-                      shuffle = False):
+                      shuffle = False,
+                      sampling_weights = None):
     '''Get data pipeline that is ready for training. Apply color normalization
     and optionally, data augmentation.
 
@@ -47,6 +56,11 @@ def get_data_pipeline(dataset_df,
         params(DataPipelineParams): wrapper object with pipeline parameters
         shuffle(boolean): indicates whether data points should be shuffled
                           (indicates if data is training data)
+        sampling_weights(Series): optional weights indexed by dataset rows,
+                                  e.g. from HardExampleIndex.get_sampling_weights().
+                                  If given, every epoch draws len(dataset)
+                                  samples with replacement proportionally to
+                                  them (rows without a weight get the mean one)
 
     Returns: an iterator yielding tuples of ndarrays (x, y). If non-zero value
              for sample_weights_threshold is given, it will return
@@ -56,17 +70,29 @@ def get_data_pipeline(dataset_df,
     image_gen = _get_image_generator(params.augmentation, shuffle)
 
     # Extract (x, y) which are (images, labels)
-    images, labels = _get_images_labels(dataset_df,
-                                        params.dataset,
-                                        params.cross_entropy,
-                                        params.original_preprocessing)
+    images, labels, rows = _get_images_labels(dataset_df,
+                                              params.dataset,
+                                              params.cross_entropy,
+                                              params.original_preprocessing,
+                                              params.sparse_labels,
+                                              return_rows = True)
 
     # Finally, get dataset iterator
-    ds_iterator = image_gen.flow(x = images,
-                                 y = labels,
-                                 batch_size = params.batch_size,
-                                 seed = params.seed,
-                                 shuffle = shuffle)
+    if sampling_weights is not None:
+        ds_iterator = _WeightedArrayIterator(
+            images,
+            labels,
+            image_gen,
+            _get_sampling_probabilities(rows, sampling_weights),
+            batch_size = params.batch_size,
+            seed = params.seed
+        )
+    else:
+        ds_iterator = image_gen.flow(x = images,
+                                     y = labels,
+                                     batch_size = params.batch_size,
+                                     seed = params.seed,
+                                     shuffle = shuffle)
 
     print("Number of elements: {}".format(len(images)))
     return ds_iterator
@@ -91,7 +117,8 @@ def get_image_data(dataset_df, params):
     images, _ = _get_images_labels(dataset_df,
                                    params.dataset,
                                    params.cross_entropy,
-                                   params.original_preprocessing)
+                                   params.original_preprocessing,
+                                   params.sparse_labels)
     return images
 
 def get_labels(dataset_df, params):
@@ -106,9 +133,42 @@ def get_labels(dataset_df, params):
     _, labels = _get_images_labels(dataset_df,
                                    params.dataset,
                                    params.cross_entropy,
-                                   params.original_preprocessing)
+                                   params.original_preprocessing,
+                                   params.sparse_labels)
     return labels
 
+def has_sparse_labels(params):
+    '''Returns True if the pipeline yields integer class indices as labels,
+    in which case sparse categorical loss has to be used for training.
+        Args:
+            params(DataPipelineParams): wrapper object with pipeline parameters
+    '''
+    is_distribution = params.dataset == Dataset.FERPLUS and params.cross_entropy
+    return params.sparse_labels and not is_distribution
+
+class _WeightedArrayIterator(NumpyArrayIterator):
+    '''NumpyArrayIterator that draws the samples of every epoch with
+    replacement from given probabilities instead of permuting them'''
+
+    def __init__(self, x, y, image_data_generator, probabilities, **kwargs):
+        self.probabilities = probabilities
+        super().__init__(x, y, image_data_generator, shuffle = True, **kwargs)
+
+    def _set_index_array(self):
+        # The iterator seeds numpy with seed + batches seen before calling it
+        self.index_array = np.random.choice(self.n,
+                                            size = self.n,
+                                            p = self.probabilities)
+
+def _get_sampling_probabilities(rows, sampling_weights):
+    '''Aligns sampling weights with dataset rows and normalizes them'''
+    weights = np.asarray(sampling_weights.reindex(rows).values,
+                         dtype = np.float64)
+    missing = np.isnan(weights)
+    weights[missing] = weights[~missing].mean() if np.any(~missing) else 1.
+    weights = np.clip(weights, 0., None)
+    return weights / weights.sum()
+
 def _get_image_generator(augmentation, is_training_set):
     '''Returns image generator that applies augmentation based on augmentation
     argument. It always applies color range normalization, even if
@@ -140,10 +200,13 @@ def _get_image_generator(augmentation, is_training_set):
 
     return image_gen
 
+@profile_stage('get_images_labels')
 def _get_images_labels(dataset_df,
                        dataset,
                        cross_entropy,
-                       original_preprocessing):
+                       original_preprocessing,
+                       sparse_labels = False,
+                       return_rows = False):
     '''Get image (x) and label (y) data out of dataset dataframe.
 
     Args:
@@ -152,12 +215,45 @@ def _get_images_labels(dataset_df,
         cross_entropy(boolean): whether labels should be class probabilities
                                 (it has effect only on FER-Plus)
         original_preprocessing(boolean): whether to apply original preprocessing
+        sparse_labels(boolean): whether majority labels should be class indices
+        return_rows(boolean): whether to return dataset rows of the images too
 
     Returns:
         images(ndarray)
         labels(ndarray)
+        rows(ndarray): dataframe index of every image, if return_rows is set
+    '''
+    dataset_df = _remove_outliers(dataset_df,
+                                  dataset,
+                                  cross_entropy,
+                                  original_preprocessing)
+
+    image_data = _get_image_array(dataset_df)
+    label_data = _get_label_data(dataset_df,
+                                 dataset,
+                                 cross_entropy,
+                                 sparse_labels)
+
+    if return_rows:
+        return (image_data, label_data, dataset_df.index.values)
+    return (image_data, label_data)
+
+@profile_stage('remove_outliers')
+def _remove_outliers(dataset_df,
+                     dataset,
+                     cross_entropy,
+                     original_preprocessing):
+    '''Removes outliers from FER-Plus dataframe. FER dataframe is returned
+    unchanged.
+
+    Args:
+        dataset_df(dataframe): dataframe of the specific dataset (from unified)
+        dataset(enum): FER or FER-Plus
+        cross_entropy(boolean): whether labels should be class probabilities
+        original_preprocessing(boolean): whether to apply original preprocessing
+
+    Returns: a dataframe without outliers.
     '''
-    # For FER-Plus start with removing outliers
     if dataset == Dataset.FERPLUS and original_preprocessing:
         dataset_df = op.get_dataset_without_original_outliers(dataset_df,
                                                               cross_entropy,
@@ -165,29 +261,53 @@ def _get_images_labels(dataset_df,
     elif dataset == Dataset.FERPLUS:
         dataset_df = op.get_dataset_without_custom_outliers(dataset_df,
                                                             COLUMN_NAMES)
+    return dataset_df
 
+@profile_stage('decode_images')
+def _get_image_array(dataset_df):
+    '''Decode image strings of the dataset dataframe into (n, 48, 48, 1)
+    ndarray'''
     # Reshape image data into ndarray fromat
     image_data = np.empty((len(dataset_df), IMG_SHAPE, IMG_SHAPE, 1))
     for i, img in enumerate(dataset_df['image']):
         image_data[i] = _str_to_image_data(img).reshape(IMG_SHAPE, IMG_SHAPE, 1)
+    return image_data
+
+@profile_stage('get_label_data')
+def _get_label_data(dataset_df,
+                    dataset,
+                    cross_entropy,
+                    sparse_labels = False):
+    '''Get label (y) data out of dataset dataframe with outliers removed.
+
+    Args:
+        dataset_df(dataframe): dataframe of the specific dataset (from unified)
+        dataset(enum): get labels of FER or FER-Plus
+        cross_entropy(boolean): whether labels should be class probabilities
+                                (it has effect only on FER-Plus)
+        sparse_labels(boolean): whether majority labels should be int8 class
+                                indices instead of basis vectors
 
+    Returns: ndarray of labels.
+    '''
     # For FER, return the integer label
     if dataset == Dataset.FER:
         int_labels = dataset_df.iloc[:, 2].values
-        label_data = _basis_vectors(int_labels, 7)
+        n_classes = 7
     # For FER-Plus...
     else:
         label_data = dataset_df.iloc[:, 3:].values
         # Either return the distribution of probabilities as label
         # (array of elements in range [0, 1])
         if cross_entropy:
-            label_data = [_p_distribution(row) for row in label_data]
-        # or majority label (basis vector)
-        else:
-            int_labels = label_data.argmax(1)
-            label_data = _basis_vectors(int_labels, 8)
+            return _p_distribution(label_data)
+        # or majority label
+        int_labels = label_data.argmax(1)
+        n_classes = 8
 
-    return (image_data, label_data)
+    if sparse_labels:
+        return int_labels.astype(np.int8)
+    return _basis_vectors(int_labels, n_classes)
 
 def _str_to_image_data(image_blob):
     '''Convert image encoded as a string into image array'''
@@ -197,16 +317,14 @@ def _str_to_image_data(image_blob):
     return image_data
 
 def _p_distribution(x):
-    '''Divide each vector element by their sum. Returns a vector'''
-    if isinstance(x, np.ndarray):
-        return (x / x.sum()).tolist()
-    else:
-        return [float(xi) / sum(x) for xi in x]
+    '''Divide each vector element by their sum. Works on a single vector or on
+    a matrix of row vectors. Returns float32 ndarray'''
+    x = np.asarray(x, dtype = np.float32)
+    return x / x.sum(axis = -1, keepdims = True)
 
 def _basis_vectors(int_labels, n_classes):
-    '''Transforms an array of integer labels into an array of basis vectors'''
-    label_shape = (int_labels.shape[0], n_classes)
-    label_data = np.zeros(label_shape)
-    for row, arg in zip(label_data, int_labels):
-        row[arg] = 1
+    '''Transforms an array of integer labels into a float32 array of basis
+    vectors'''
+    label_data = np.zeros((len(int_labels), n_classes), dtype = np.float32)
+    label_data[np.arange(len(int_labels)), int_labels] = 1
     return label_data
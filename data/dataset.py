@@ -1,3 +1,4 @@
+from .profiling import profile_stage
 import csv
 from itertools import islice
 import os
@@ -15,6 +16,7 @@ COLUMN_NAMES = ['dataset', 'image', 'fer_code', 'neutral', 'happiness', \
 'no-face']
 
 
+@profile_stage('get_dataset_dict')
 def get_dataset_dict(dataset_dir = '../dataset',
                      fer_file_name = 'fer2013.csv',
                      fer_plus_file_name = 'fer2013new.csv'):
@@ -41,6 +43,7 @@ def get_dataset_dict(dataset_dir = '../dataset',
             'valid' : dataset_df.loc[dataset_df['dataset'] == 'valid'],
             'test' : dataset_df.loc[dataset_df['dataset'] == 'test']}
 
+@profile_stage('read_dataset_csv')
 def read_dataset_csv(dataset_dir = './'):
     '''Reads into a dataframe a previously generated output dataset csv file.
 
@@ -52,6 +55,7 @@ def read_dataset_csv(dataset_dir = './'):
     dataset_path = os.path.join(dataset_dir, UNIFIED_DATASET_FILE_NAME)
     return pd.read_csv(dataset_path)
 
+@profile_stage('generate_dataset_csv')
 def _generate_dataset_csv(dataset_dir = '../dataset',
                           fer_file_name = 'fer2013.csv',
                           fer_plus_file_name = 'fer2013new.csv'):
@@ -15,7 +15,8 @@ class DataPipelineParams():
                  original_preprocessing = False,
                  batch_size = 32,
                  augmentation = Augmentation.NONE,
-                 seed = 123):
+                 seed = 123,
+                 sparse_labels = False):
         '''Args:
             dataset(enum): based on it, labels of FER or FER-Plus will be used
             cross_entropy(boolean): whether labels should be class probabilities
@@ -24,6 +25,9 @@ class DataPipelineParams():
             batch_size(int)
             augmentation(enum): indicates level of augmentation to apply
             seed(int)
+            sparse_labels(boolean): whether majority labels should be int8 class
+                                    indices instead of basis vectors (PD
+                                    labels are always float32 distributions)
             preprocessing_function(function): custom function to be applied to the
                                               data before creating a pipeline
         '''
@@ -33,3 +37,4 @@ class DataPipelineParams():
         self.batch_size = batch_size
         self.augmentation = augmentation
         self.seed = seed
+        self.sparse_labels = sparse_labels
@@ -52,21 +52,25 @@ def get_dataset_without_original_outliers(dataset_df,
     Returns: a dataframe without outlier records and votes.
     '''
     preprocessed_list = []
+    preprocessed_index = []
 
-    for _, row in dataset_df.iterrows():
+    for index, row in dataset_df.iterrows():
         orginal_votes = list(row[3:])
         processed_votes = _process_votes(orginal_votes, cross_entropy)
-        index = np.argmax(processed_votes)
-        if index < 8: # not unknown or no-face category
+        label = np.argmax(processed_votes)
+        if label < 8: # not unknown or no-face category
             processed_votes = processed_votes[:-2] # cut unknown and no-face
 
             # Concat original data with processed votes
             record = row[0:3].tolist() + processed_votes
             # Append
             preprocessed_list.append(record)
+            preprocessed_index.append(index)
 
+    # Keep row indexes of the input df, so records can be traced back to it
     preprocessed_df = pd.DataFrame(preprocessed_list,
-                                   columns = df_column_names[:-2])
+                                   columns = df_column_names[:-2],
+                                   index = preprocessed_index)
     return preprocessed_df
 
 def _process_votes(original_votes, cross_entropy):
@@ -0,0 +1,172 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import functools
+import json
+import platform
+import time
+import tracemalloc
+
+
+# Profiler recording the stages, None if profiling is disabled
+_active_profiler = None
+
+
+class DataProfiler():
+    '''Records wall time, peak memory and row counts of data loading stages.
+    Stages can be nested (e.g. outlier removal inside get_data_pipeline), peak
+    memory of a stage includes peaks of its nested stages.'''
+
+    def __init__(self, label = None):
+        '''Args:
+            label(string): optional name of the run (e.g. version or commit)
+                           saved in the report
+        '''
+        self.label = label
+        self.stages = []
+        self._stack = []
+
+    @contextmanager
+    def stage(self, name, rows_in = None):
+        '''Context manager measuring a single stage.
+
+        Args:
+            name(string): name of the stage
+            rows_in(int): number of input rows, if known
+
+        Yields: a dict of the stage record, 'rows_out' can be set on it.
+        '''
+        # Peak reached by the parent so far would be lost by resetting it
+        _, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1]['child_peak'] = max(self._stack[-1]['child_peak'], peak)
+        tracemalloc.reset_peak()
+
+        record = {'name': name,
+                  'depth': len(self._stack),
+                  'rows_in': rows_in,
+                  'rows_out': None}
+        self.stages.append(record)
+        frame = {'child_peak': 0, 'start_memory': tracemalloc.get_traced_memory()[0]}
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            wall_time = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            peak = max(peak, frame['child_peak'])
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]['child_peak'] = max(self._stack[-1]['child_peak'], peak)
+
+            record['wall_time_s'] = wall_time
+            record['peak_memory_mb'] = peak / 2 ** 20
+            record['memory_delta_mb'] = (current - frame['start_memory']) / 2 ** 20
+
+    def get_report(self):
+        '''Returns a JSON serializable dict with all the recorded stages'''
+        top_level = [s for s in self.stages if s['depth'] == 0]
+        return {'label': self.label,
+                'created': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'total_wall_time_s': sum(s['wall_time_s'] for s in top_level),
+                'peak_memory_mb': max([s['peak_memory_mb'] for s in top_level],
+                                      default = 0.),
+                'stages': self.stages}
+
+    def save_json(self, file_path):
+        '''Saves the report as a JSON file'''
+        with open(file_path, 'w') as file:
+            json.dump(self.get_report(), file, indent = 2)
+
+    def print_table(self):
+        '''Prints the report as a console table'''
+        header = '{:<40} {:>10} {:>10} {:>10} {:>10}'.format('Stage',
+                                                             'Time [s]',
+                                                             'Peak [MB]',
+                                                             'Rows in',
+                                                             'Rows out')
+        print(header)
+        print('-' * len(header))
+        for s in self.stages:
+            name = '  ' * s['depth'] + s['name']
+            print('{:<40} {:>10.3f} {:>10.1f} {:>10} {:>10}'.format(
+                name[:40],
+                s['wall_time_s'],
+                s['peak_memory_mb'],
+                _format_rows(s['rows_in']),
+                _format_rows(s['rows_out'])))
+
+
+@contextmanager
+def profile(label = None):
+    '''Enables profiling of data stages for the duration of the block.
+
+    Example:
+        with profile('v1.2') as profiler:
+            dataset_dict = get_dataset_dict(dataset_dir)
+            pipeline = get_data_pipeline(dataset_dict['train'], params, True)
+        profiler.print_table()
+        profiler.save_json('data_profile.json')
+
+    Args:
+        label(string): optional name of the run saved in the report
+
+    Yields: DataProfiler
+    '''
+    global _active_profiler
+    profiler = DataProfiler(label)
+    previous_profiler = _active_profiler
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    _active_profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _active_profiler = previous_profiler
+        if not was_tracing:
+            tracemalloc.stop()
+
+def profile_stage(name):
+    '''Decorator recording the function as a data stage when profiling is
+    enabled. Rows in are counted from the first argument and rows out from the
+    returned value.
+
+    Args:
+        name(string): name of the stage
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _active_profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+
+            rows_in = _count_rows(args[0]) if args else None
+            with profiler.stage(name, rows_in) as record:
+                result = function(*args, **kwargs)
+                record['rows_out'] = _count_rows(result)
+            return result
+        return wrapper
+    return decorator
+
+def _count_rows(obj):
+    '''Returns number of rows of a dataframe, an array, a keras iterator or
+    a tuple/dict of them, None if it cannot be counted'''
+    if isinstance(obj, tuple):
+        return _count_rows(obj[0]) if obj else None
+    if isinstance(obj, dict):
+        counts = [_count_rows(value) for value in obj.values()]
+        return None if None in counts else sum(counts)
+    # Keras iterators
+    if hasattr(obj, 'n') and isinstance(obj.n, int):
+        return obj.n
+    if hasattr(obj, 'shape') and hasattr(obj, '__len__'):
+        return len(obj)
+    return None
+
+def _format_rows(rows):
+    '''Formats row count for the console table'''
+    return '-' if rows is None else str(rows)
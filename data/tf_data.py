@@ -0,0 +1,269 @@
+from . import data
+from .model_class.DataPipelineParams import Augmentation
+from .profiling import profile_stage
+import math
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+# Upper bound of the epoch counter of an endless training pipeline
+MAX_EPOCHS = 2 ** 31 - 1
+
+
+@profile_stage('get_tf_data_pipeline')
+def get_tf_data_pipeline(dataset_df,
+                         params,
+                         shuffle = False,
+                         initial_epoch = 0):
+    '''Get tf.data pipeline that is ready for training. It is an alternative to
+    data.get_data_pipeline that applies the same color normalization and
+    augmentation, but decodes images in parallel, caches them as uint8 tensors
+    and augments whole batches at once.
+
+    Args:
+        dataset_df(dataframe): specific dataset (train, valid or test) loaded
+                               from a unified dataset created using
+                               dataset.get_dataset_dict()
+        params(DataPipelineParams): wrapper object with pipeline parameters
+        shuffle(boolean): indicates whether data points should be shuffled
+                          (indicates if data is training data)
+        initial_epoch(int): epoch to start from, shuffling and augmentation
+                            of every epoch are derived from params.seed and
+                            the epoch number (has effect only if shuffle)
+
+    Returns: a tuple (dataset, steps_per_epoch). If shuffle is True, the
+             dataset is endless like the keras iterator, so steps_per_epoch
+             has to be passed to model.fit().
+    '''
+    dataset_df = data._remove_outliers(dataset_df,
+                                       params.dataset,
+                                       params.cross_entropy,
+                                       params.original_preprocessing)
+    labels = data._get_label_data(dataset_df,
+                                  params.dataset,
+                                  params.cross_entropy,
+                                  params.sparse_labels)
+
+    # Decode image strings in parallel and cache the decoded uint8 tensors
+    images = tf.data.Dataset.from_tensor_slices(dataset_df['image'].values)
+    images = images.map(_decode_image, num_parallel_calls = AUTOTUNE)
+    labels = tf.data.Dataset.from_tensor_slices(_as_label_array(labels))
+    cached_ds = tf.data.Dataset.zip((images, labels)).cache()
+
+    print("Number of elements: {}".format(len(dataset_df)))
+    return _get_pipeline(cached_ds, len(dataset_df), params, shuffle, initial_epoch)
+
+def get_tf_data_pipeline_from_arrays(images,
+                                     labels,
+                                     params,
+                                     shuffle = False,
+                                     initial_epoch = 0):
+    '''Same as get_tf_data_pipeline, but works on already decoded images
+    (e.g. a memory-mapped array) instead of a dataset dataframe. Nothing is
+    copied into the pipeline: row indices are shuffled and batched, and every
+    batch is gathered from the arrays when it is needed, so processes that
+    memory-map the same files share one copy of the data.
+
+    Args:
+        images(ndarray): (n, 48, 48, 1) array of uint8 images
+        labels(ndarray): labels matching the images
+        params(DataPipelineParams): wrapper object with pipeline parameters
+        shuffle(boolean): indicates whether data points should be shuffled
+        initial_epoch(int): epoch to start from (has effect only if shuffle)
+
+    Returns: a tuple (dataset, steps_per_epoch).
+    '''
+    label_dtype = tf.float32 if labels.ndim > 1 else tf.as_dtype(labels.dtype)
+
+    def gather(indices):
+        return (np.asarray(images[indices], dtype = np.uint8),
+                _as_label_array(labels[indices]))
+
+    def load_batch(indices):
+        image_batch, label_batch = tf.numpy_function(gather,
+                                                     [indices],
+                                                     (tf.uint8, label_dtype))
+        image_batch.set_shape((None,) + tuple(images.shape[1:]))
+        label_batch.set_shape((None,) + tuple(labels.shape[1:]))
+        return image_batch, label_batch
+
+    indices = tf.data.Dataset.range(len(images))
+    return _get_pipeline(indices, len(images), params, shuffle, initial_epoch,
+                         load_batch = load_batch)
+
+def benchmark_pipelines(dataset_df, params, n_batches = 50, shuffle = True):
+    '''Measures throughput (images/sec) of the keras ImageDataGenerator
+    pipeline and of the tf.data pipeline built from the same parameters.
+    Both pipelines are created beforehand and warmed up with one batch, so
+    only the iteration is timed.
+
+    Args:
+        dataset_df(dataframe): specific dataset (train, valid or test)
+        params(DataPipelineParams): wrapper object with pipeline parameters
+        n_batches(int): number of batches to time
+        shuffle(boolean): whether to benchmark training pipelines
+
+    Returns: a dict with images/sec of both pipelines and the speedup.
+    '''
+    keras_iterator = data.get_data_pipeline(dataset_df, params, shuffle)
+    tf_dataset, steps = get_tf_data_pipeline(dataset_df, params, shuffle)
+    if not shuffle:
+        # Validation and test datasets are finite (one batch is for warm-up)
+        n_batches = min(n_batches, steps - 1)
+
+    keras_ips = _measure_throughput(iter(keras_iterator), n_batches)
+    tf_ips = _measure_throughput(iter(tf_dataset), n_batches)
+
+    results = {'image_data_generator': keras_ips,
+               'tf_data': tf_ips,
+               'speedup': tf_ips / keras_ips}
+    print('ImageDataGenerator: {:.1f} images/sec'.format(keras_ips))
+    print('tf.data: {:.1f} images/sec'.format(tf_ips))
+    print('Speedup: {:.2f}x'.format(results['speedup']))
+    return results
+
+def _measure_throughput(iterator, n_batches):
+    '''Returns number of images per second yielded by the iterator'''
+    # Warm up (fills caches and starts background threads)
+    next(iterator)
+
+    n_images = 0
+    start = time.perf_counter()
+    for _ in range(n_batches):
+        images = next(iterator)[0]
+        n_images += len(images)
+    return n_images / (time.perf_counter() - start)
+
+def _get_pipeline(cached_ds,
+                  n_elements,
+                  params,
+                  shuffle,
+                  initial_epoch,
+                  load_batch = None):
+    '''Adds shuffling, batching, augmentation and prefetching to the cached
+    dataset of (uint8 image, label) elements. If load_batch is given, the
+    elements are row indices and load_batch maps a batch of them to a batch
+    of (uint8 images, labels).'''
+    steps_per_epoch = math.ceil(n_elements / params.batch_size)
+
+    def batch(ds):
+        ds = ds.batch(params.batch_size)
+        if load_batch is not None:
+            ds = ds.map(load_batch, num_parallel_calls = AUTOTUNE)
+        return ds
+
+    if not shuffle:
+        ds = batch(cached_ds)
+        ds = ds.map(lambda x, y: (_normalize(x), y),
+                    num_parallel_calls = AUTOTUNE)
+        return ds.prefetch(AUTOTUNE), steps_per_epoch
+
+    augmentation = params.augmentation
+    seed = params.seed
+
+    def epoch_dataset(epoch):
+        # Every epoch has its own shuffling and augmentation seeds, so
+        # the sequence of batches does not depend on the iterator state
+        ds = cached_ds.shuffle(n_elements,
+                               seed = seed + epoch,
+                               reshuffle_each_iteration = False)
+        ds = batch(ds).enumerate()
+        return ds.map(lambda step, batch: (epoch, step, batch[0], batch[1]))
+
+    ds = tf.data.Dataset.range(initial_epoch, MAX_EPOCHS)
+    ds = ds.flat_map(epoch_dataset)
+    ds = ds.map(lambda epoch, step, x, y:
+                    (_augment_batch(x, augmentation, [seed + epoch, step]), y),
+                num_parallel_calls = AUTOTUNE)
+    return ds.prefetch(AUTOTUNE), steps_per_epoch
+
+def _decode_image(image_string):
+    '''Convert image encoded as a string into (48, 48, 1) uint8 tensor'''
+    pixels = tf.strings.to_number(tf.strings.split(image_string, ' '),
+                                  out_type = tf.int32)
+    return tf.reshape(tf.cast(pixels, tf.uint8), (data.IMG_SHAPE, data.IMG_SHAPE, 1))
+
+def _as_label_array(labels):
+    '''Converts labels to an array, keeping integer class indices compact and
+    casting label vectors to float32'''
+    labels = np.asarray(labels)
+    if labels.ndim == 1:
+        return labels
+    return labels.astype(np.float32)
+
+def _normalize(images):
+    '''Color range [0, 255] -> [0, 1]'''
+    return tf.cast(images, tf.float32) / 255.
+
+def _augment_batch(images, augmentation, seed):
+    '''Applies random augmentation to the whole batch of uint8 images at once.
+    It mirrors data._get_image_generator: rotation, shifts, shear and zoom are
+    combined with the horizontal flip into a single projective transform per
+    image, brightness is a random per-image factor.
+
+    Args:
+        images(tensor): (batch, 48, 48, 1) uint8 images
+        augmentation(Augmentation): level of augmentation to apply
+        seed(list): stateless random seed of two integers
+
+    Returns: (batch, 48, 48, 1) float32 images in range [0, 1].
+    '''
+    if augmentation == Augmentation.NONE:
+        return _normalize(images)
+
+    images = tf.cast(images, tf.float32)
+    batch_size = tf.shape(images)[0]
+    seeds = tf.random.experimental.stateless_split(tf.cast(seed, tf.int64), 8)
+
+    def uniform(i, limit, center = 0.):
+        return tf.random.stateless_uniform((batch_size,),
+                                           seeds[i],
+                                           center - limit,
+                                           center + limit)
+
+    # Same ranges as in data._get_image_generator
+    theta = uniform(0, np.deg2rad(30))
+    zoom_x = uniform(1, 0.2, 1.)
+    zoom_y = uniform(2, 0.2, 1.)
+    flip = tf.where(uniform(3, 1.) < 0, -1., 1.)
+    if augmentation == Augmentation.HIGH:
+        shear = uniform(4, np.deg2rad(0.2))
+        shift_x = uniform(5, 0.2 * data.IMG_SHAPE)
+        shift_y = uniform(6, 0.2 * data.IMG_SHAPE)
+    else:
+        shear = shift_x = shift_y = tf.zeros((batch_size,))
+
+    # Matrix mapping output to input coordinates:
+    # rotation x shear x zoom x horizontal flip
+    a00 = tf.cos(theta) * zoom_x * flip
+    a01 = -tf.sin(theta + shear) * zoom_y
+    a10 = tf.sin(theta) * zoom_x * flip
+    a11 = tf.cos(theta + shear) * zoom_y
+    # Transform around the image center
+    center = (data.IMG_SHAPE - 1) / 2.
+    b0 = center - a00 * center - a01 * center + shift_x
+    b1 = center - a10 * center - a11 * center + shift_y
+    zeros = tf.zeros((batch_size,))
+    transforms = tf.stack([a00, a01, b0, a10, a11, b1, zeros, zeros], axis = 1)
+
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images = images,
+        transforms = transforms,
+        output_shape = [data.IMG_SHAPE, data.IMG_SHAPE],
+        fill_value = 0.,
+        interpolation = 'BILINEAR',
+        fill_mode = 'NEAREST'
+    )
+
+    # Brightness range (0.2, 1.2)
+    brightness = tf.random.stateless_uniform((batch_size, 1, 1, 1),
+                                             seeds[7],
+                                             0.2,
+                                             1.2)
+    images = tf.clip_by_value(images * brightness, 0., 255.)
+
+    return images / 255.
@@ -0,0 +1,251 @@
+from data import tf_data
+from data.data import get_image_data, get_labels, has_sparse_labels
+import copy
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+import models
+import tflite_utils
+import training
+
+
+class Distiller(keras.Model):
+    '''Trains a student model to match softened outputs of a teacher model
+    and the ground truth labels at the same time. Both models output logits.'''
+
+    def __init__(self, student, teacher):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.teacher.trainable = False
+
+    def compile(self,
+                optimizer,
+                metrics,
+                student_loss_fn,
+                alpha = 0.5,
+                temperature = 4.,
+                **kwargs):
+        '''Args:
+            optimizer(keras.optimizers.Optimizer)
+            metrics(list): metrics of student predictions
+            student_loss_fn(keras.losses.Loss): loss between labels and
+                                                student logits
+            alpha(float): weight of the student loss, the distillation loss
+                          has weight (1 - alpha)
+            temperature(float): temperature used to soften both distributions
+        '''
+        super().compile(optimizer = optimizer, metrics = metrics, **kwargs)
+        self.student_loss_fn = student_loss_fn
+        self.distillation_loss_fn = keras.losses.KLDivergence()
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def train_step(self, data):
+        x, y = data
+        teacher_logits = self.teacher(x, training = False)
+
+        with tf.GradientTape() as tape:
+            student_logits = self.student(x, training = True)
+            student_loss = self.student_loss_fn(y, student_logits)
+            distillation_loss = self._distillation_loss(teacher_logits,
+                                                        student_logits)
+            loss = (self.alpha * student_loss
+                    + (1. - self.alpha) * distillation_loss
+                    + tf.add_n(self.student.losses or [0.]))
+
+        variables = self.student.trainable_variables
+        gradients = tape.gradient(loss, variables)
+        self.optimizer.apply_gradients(zip(gradients, variables))
+
+        self.compiled_metrics.update_state(y, student_logits)
+        results = {m.name: m.result() for m in self.metrics}
+        results.update({'loss': loss,
+                        'student_loss': student_loss,
+                        'distillation_loss': distillation_loss})
+        return results
+
+    def test_step(self, data):
+        x, y = data
+        student_logits = self.student(x, training = False)
+        student_loss = self.student_loss_fn(y, student_logits)
+
+        self.compiled_metrics.update_state(y, student_logits)
+        results = {m.name: m.result() for m in self.metrics}
+        results['loss'] = student_loss
+        return results
+
+    def call(self, x):
+        return self.student(x)
+
+    def _distillation_loss(self, teacher_logits, student_logits):
+        '''KL divergence of softened distributions, scaled by T^2 so that its
+        gradients keep the magnitude of the student loss'''
+        t = self.temperature
+        return self.distillation_loss_fn(
+            tf.nn.softmax(teacher_logits / t, axis = 1),
+            tf.nn.softmax(student_logits / t, axis = 1)
+        ) * t ** 2
+
+
+def get_student_configs():
+    '''Returns default students: narrower models, optionally working on 32x32
+    images internally'''
+    return {'micro_w50': {'width_multiplier': 0.5},
+            'micro_w35': {'width_multiplier': 0.35},
+            'micro_w25': {'width_multiplier': 0.25},
+            'micro_w50_32px': {'width_multiplier': 0.5, 'internal_resolution': 32},
+            'micro_w25_32px': {'width_multiplier': 0.25, 'internal_resolution': 32}}
+
+def distill(teacher_path,
+            dataset_dict,
+            pipeline_params,
+            student_configs = None,
+            epochs = 100,
+            learning_rate = 0.005,
+            alpha = 0.1,
+            temperature = 4.,
+            output_dir = 'model',
+            leaky_relu_slope = 0.02,
+            dropout_rate = 0.10,
+            regularization_rate = 0.01):
+    '''Distills the teacher model into every student and saves their tflite
+    files together with an accuracy/latency Pareto report.
+
+    Args:
+        teacher_path(string): path to trained .h5 teacher model (logits output)
+        dataset_dict(dict): datasets created using dataset.get_dataset_dict()
+        pipeline_params(DataPipelineParams): parameters of the training
+                                             pipeline (PD labels recommended)
+        student_configs(dict(string, dict)): name -> get_micro_model kwargs,
+                                             get_student_configs() by default
+        epochs(int)
+        learning_rate(float)
+        alpha(float): weight of the ground truth loss
+        temperature(float): softmax temperature of the distillation loss
+        output_dir(string): directory for tflite files and the report
+        leaky_relu_slope(float)
+        dropout_rate(float)
+        regularization_rate(float)
+
+    Returns: a dict with the Pareto report (also saved as JSON).
+    '''
+    student_configs = student_configs or get_student_configs()
+    os.makedirs(output_dir, exist_ok = True)
+
+    teacher = keras.models.load_model(teacher_path, compile = False)
+
+    # Test on majority labels, like in the training notebook
+    test_params = copy.copy(pipeline_params)
+    test_params.cross_entropy = False
+    test_params.sparse_labels = True
+    test_images = get_image_data(dataset_dict['test'], test_params)
+    test_labels = get_labels(dataset_dict['test'], test_params)
+
+    training_pipeline, steps_per_epoch = tf_data.get_tf_data_pipeline(
+        dataset_dict['train'],
+        pipeline_params,
+        shuffle = True
+    )
+    # Validate on majority labels in the same format as the training labels
+    valid_params = copy.copy(test_params)
+    valid_params.sparse_labels = has_sparse_labels(pipeline_params)
+    validation_pipeline, _ = tf_data.get_tf_data_pipeline(dataset_dict['valid'],
+                                                          valid_params)
+    callbacks = [keras.callbacks.EarlyStopping(monitor = 'val_loss',
+                                               patience = 30,
+                                               min_delta = 0.001,
+                                               restore_best_weights = True)]
+
+    results = [_evaluate_tflite('teacher',
+                                tflite_utils.convert_to_tflite(teacher),
+                                teacher.count_params(),
+                                test_images,
+                                test_labels)]
+
+    for name, config in student_configs.items():
+        student = models.get_micro_model(leaky_relu_slope,
+                                         dropout_rate,
+                                         regularization_rate,
+                                         logits = True,
+                                         **config)
+        distiller = Distiller(student, teacher)
+        distiller.compile(optimizer = keras.optimizers.Adam(learning_rate = learning_rate),
+                          metrics = training.get_metrics(pipeline_params),
+                          student_loss_fn = training.get_loss(pipeline_params),
+                          alpha = alpha,
+                          temperature = temperature)
+        distiller.fit(training_pipeline,
+                      validation_data = validation_pipeline,
+                      epochs = epochs,
+                      steps_per_epoch = steps_per_epoch,
+                      callbacks = callbacks)
+
+        tflite_model = tflite_utils.convert_to_tflite(student)
+        tflite_path = os.path.join(output_dir, name + '.tflite')
+        with open(tflite_path, 'wb') as f:
+            f.write(tflite_model)
+
+        result = _evaluate_tflite(name,
+                                  tflite_model,
+                                  student.count_params(),
+                                  test_images,
+                                  test_labels)
+        result.update(config)
+        result['tflite'] = tflite_path
+        results.append(result)
+
+    report = {'teacher': teacher_path,
+              'alpha': alpha,
+              'temperature': temperature,
+              'results': _mark_pareto_front(results)}
+    with open(os.path.join(output_dir, 'distillation_report.json'), 'w') as file:
+        json.dump(report, file, indent = 2)
+    _print_report(report)
+    return report
+
+def _evaluate_tflite(name, tflite_model, n_parameters, test_images, test_labels):
+    '''Returns accuracy on the test split and single image latency of the
+    tflite model'''
+    outputs = tflite_utils.get_tflite_model_outputs(tflite_model, test_images)
+    latency = tflite_utils.measure_tflite_latency(tflite_model, n_runs = 500)
+    return {'name': name,
+            'parameters': int(n_parameters),
+            'size_bytes': len(tflite_model),
+            'accuracy': float(np.mean(outputs.argmax(1) == test_labels)),
+            'latency_p50_ms': latency['p50_ms'],
+            'latency_p95_ms': latency['p95_ms']}
+
+def _mark_pareto_front(results):
+    '''Marks results that are not dominated by another one, i.e. no other model
+    is both faster and at least as accurate'''
+    for r in results:
+        r['pareto_optimal'] = not any(
+            other['latency_p50_ms'] <= r['latency_p50_ms']
+            and other['accuracy'] >= r['accuracy']
+            and (other['latency_p50_ms'] < r['latency_p50_ms']
+                 or other['accuracy'] > r['accuracy'])
+            for other in results
+        )
+    return sorted(results, key = lambda r: r['latency_p50_ms'])
+
+def _print_report(report):
+    '''Prints the Pareto report as a console table'''
+    header = '{:<18} {:>10} {:>10} {:>10} {:>8}'.format('Model',
+                                                        'Params',
+                                                        'Accuracy',
+                                                        'p50 [ms]',
+                                                        'Pareto')
+    print(header)
+    print('-' * len(header))
+    for r in report['results']:
+        print('{:<18} {:>10} {:>10.4f} {:>10.3f} {:>8}'.format(
+            r['name'][:18],
+            r['parameters'],
+            r['accuracy'],
+            r['latency_p50_ms'],
+            '*' if r['pareto_optimal'] else ''))
@@ -0,0 +1,256 @@
+from data import data
+from data.model_class.DataPipelineParams import Dataset
+import json
+
+import numpy as np
+
+import tflite_utils
+
+
+class EvaluationAccumulator():
+    '''Accumulates the confusion matrix, top-k hits and cross-entropy over
+    batches of predictions, so that a split of any size can be evaluated in
+    bounded memory.'''
+
+    def __init__(self, n_classes, top_k = (1, 2, 3)):
+        '''Args:
+            n_classes(int)
+            top_k(tuple): k values of top-k accuracy
+        '''
+        self.n_classes = n_classes
+        self.top_k = tuple(top_k)
+        self.confusion_matrix = np.zeros((n_classes, n_classes), dtype = np.int64)
+        self.top_k_hits = np.zeros(len(self.top_k), dtype = np.int64)
+        self.n_samples = 0
+        self.mv_cross_entropy_sum = 0.
+        self.pd_cross_entropy_sum = 0.
+        self.n_pd_samples = 0
+
+    def update(self, y_true, probabilities, target_distributions = None):
+        '''Adds a batch of predictions.
+
+        Args:
+            y_true(ndarray): (batch,) integer majority labels
+            probabilities(ndarray): (batch, n_classes) predicted probabilities
+            target_distributions(ndarray): optional (batch, n_classes) PD labels
+        '''
+        y_true = np.asarray(y_true, dtype = np.int64)
+        y_pred = probabilities.argmax(axis = 1)
+        n = self.n_classes
+        self.confusion_matrix += np.bincount(y_true * n + y_pred,
+                                             minlength = n * n).reshape(n, n)
+
+        # Rank of the true class = number of classes with higher probability
+        true_p = probabilities[np.arange(len(y_true)), y_true]
+        rank = (probabilities > true_p[:, np.newaxis]).sum(axis = 1)
+        self.top_k_hits += (rank[np.newaxis, :] < np.array(self.top_k)[:, np.newaxis]).sum(axis = 1)
+
+        log_p = np.log(np.clip(probabilities, 1e-7, 1.))
+        self.mv_cross_entropy_sum += float(-log_p[np.arange(len(y_true)), y_true].sum())
+        if target_distributions is not None:
+            self.pd_cross_entropy_sum += float(-(target_distributions * log_p).sum())
+            self.n_pd_samples += len(y_true)
+        self.n_samples += len(y_true)
+
+    def get_results(self):
+        '''Returns a dict with the confusion matrix, accuracy, per-class
+        precision/recall/F1, top-k accuracy and cross-entropies.'''
+        cm = self.confusion_matrix
+        true_positives = np.diag(cm).astype(np.float64)
+        support = cm.sum(axis = 1)
+        predicted = cm.sum(axis = 0)
+        precision = np.divide(true_positives, predicted,
+                              out = np.zeros(self.n_classes), where = predicted > 0)
+        recall = np.divide(true_positives, support,
+                           out = np.zeros(self.n_classes), where = support > 0)
+        f1_denominator = precision + recall
+        f1 = np.divide(2 * precision * recall, f1_denominator,
+                       out = np.zeros(self.n_classes), where = f1_denominator > 0)
+
+        n = max(self.n_samples, 1)
+        results = {'n_samples': self.n_samples,
+                   'accuracy': float(true_positives.sum() / n),
+                   'confusion_matrix': cm,
+                   'precision': precision,
+                   'recall': recall,
+                   'f1': f1,
+                   'support': support,
+                   'top_k_accuracy': {k: float(hits / n) for k, hits
+                                      in zip(self.top_k, self.top_k_hits)},
+                   'mv_cross_entropy': self.mv_cross_entropy_sum / n}
+        if self.n_pd_samples:
+            results['pd_cross_entropy'] = self.pd_cross_entropy_sum / self.n_pd_samples
+        return results
+
+
+def get_predict_function(model, from_logits = None):
+    '''Returns a function mapping a batch of unnormalized images to class
+    probabilities.
+
+    Args:
+        model(keras.Model, string or bytes): keras model, path to .tflite or
+                                             .h5 model file or the content of
+                                             a tflite model
+        from_logits(boolean): whether the model outputs logits, detected from
+                              its last operator or layer if None
+    '''
+    is_tflite = (isinstance(model, (bytes, bytearray, memoryview))
+                 or (isinstance(model, str) and model.endswith('.tflite')))
+    if is_tflite:
+        interpreter = tflite_utils.get_interpreter(model)
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        current_size = [None]
+        if from_logits is None:
+            from_logits = tflite_utils.outputs_are_logits(interpreter)
+
+        def predict(images):
+            images = images.astype(np.float32) / 255.
+            if len(images) != current_size[0]:
+                interpreter.resize_tensor_input(input_index, images.shape)
+                interpreter.allocate_tensors()
+                current_size[0] = len(images)
+            interpreter.set_tensor(input_index, images)
+            interpreter.invoke()
+            return tflite_utils.to_probabilities(interpreter.get_tensor(output_index),
+                                                 from_logits)
+        return predict
+
+    if isinstance(model, str):
+        from tensorflow import keras
+        model = keras.models.load_model(model, compile = False)
+    if from_logits is None:
+        from_logits = tflite_utils.keras_outputs_are_logits(model)
+
+    def predict(images):
+        outputs = model.predict_on_batch(images.astype(np.float32) / 255.)
+        return tflite_utils.to_probabilities(outputs, from_logits)
+    return predict
+
+def evaluate(model,
+             dataset_df,
+             params,
+             batch_size = 256,
+             chunk_size = 4096,
+             top_k = (1, 2, 3)):
+    '''Streams a dataset split through batched inference and accumulates
+    evaluation metrics. The dataframe is preprocessed and decoded chunk by
+    chunk, so only chunk_size images are held in memory at once.
+
+    Args:
+        model(keras.Model, string or bytes): keras model, path to .tflite or
+                                             .h5 model file or tflite content
+        dataset_df(dataframe): specific dataset (train, valid or test) loaded
+                               from a unified dataset created using
+                               dataset.get_dataset_dict()
+        params(DataPipelineParams): wrapper object with pipeline parameters
+                                    (dataset and outlier preprocessing)
+        batch_size(int): number of images passed to the model at once
+        chunk_size(int): number of dataframe rows decoded at once
+        top_k(tuple): k values of top-k accuracy
+
+    Returns: a dict of results, see EvaluationAccumulator.get_results().
+    '''
+    n_classes = 7 if params.dataset == Dataset.FER else 8
+    accumulator = EvaluationAccumulator(n_classes, top_k)
+    for _, y_true, distributions, probabilities in iterate_predictions(
+            model, dataset_df, params, batch_size, chunk_size):
+        accumulator.update(y_true, probabilities, distributions)
+    return accumulator.get_results()
+
+def has_pd_labels(params):
+    '''Tells whether the preprocessed dataset keeps PD labels, i.e. PD
+    cross-entropy is meaningful'''
+    return (params.dataset == Dataset.FERPLUS
+            and (params.cross_entropy or not params.original_preprocessing))
+
+def iterate_predictions(model,
+                        dataset_df,
+                        params,
+                        batch_size = 256,
+                        chunk_size = 4096):
+    '''Yields batched predictions of a dataset split in bounded memory.
+
+    Args:
+        model(keras.Model, string or bytes): keras model, path to .tflite or
+                                             .h5 model file or tflite content
+        dataset_df(dataframe): specific dataset (train, valid or test)
+        params(DataPipelineParams): wrapper object with pipeline parameters
+                                    (dataset and outlier preprocessing)
+        batch_size(int): number of images passed to the model at once
+        chunk_size(int): number of dataframe rows decoded at once
+
+    Returns: a generator of tuples (rows, y_true, distributions,
+             probabilities) where rows are dataframe indexes, y_true integer
+             majority labels and distributions PD labels (None for FER and
+             for the original preprocessing without cross-entropy, which
+             turns the labels into one-hot majority votes).
+    '''
+    predict = get_predict_function(model)
+
+    for start in range(0, len(dataset_df), chunk_size):
+        chunk_df = data._remove_outliers(dataset_df.iloc[start:start + chunk_size],
+                                         params.dataset,
+                                         params.cross_entropy,
+                                         params.original_preprocessing)
+        if len(chunk_df) == 0:
+            continue
+        rows = chunk_df.index.values
+        images = data._get_image_array(chunk_df).astype(np.uint8)
+        y_true = data._get_label_data(chunk_df,
+                                      params.dataset,
+                                      cross_entropy = False,
+                                      sparse_labels = True)
+        distributions = None
+        if has_pd_labels(params):
+            distributions = data._get_label_data(chunk_df,
+                                                 params.dataset,
+                                                 cross_entropy = True)
+
+        for i in range(0, len(images), batch_size):
+            batch = slice(i, i + batch_size)
+            yield (rows[batch],
+                   y_true[batch],
+                   None if distributions is None else distributions[batch],
+                   predict(images[batch]))
+
+def plot_results(results, class_mapping):
+    '''Plots the confusion matrix using predictions.plot_confusion_matrix and
+    prints per-class metrics.
+
+    Args:
+        results(dict): results of evaluate()
+        class_mapping(dict(int, string)): a mapping of class labels to class names
+    '''
+    import predictions
+
+    class_names = list(class_mapping.values())
+    print_results(results, class_names)
+    predictions.plot_confusion_matrix(results['confusion_matrix'], class_names)
+
+def print_results(results, class_names):
+    '''Prints accuracy, top-k accuracy, cross-entropy and per-class metrics'''
+    print('Samples: {}'.format(results['n_samples']))
+    print('Accuracy: {:.4f}'.format(results['accuracy']))
+    for k, accuracy in results['top_k_accuracy'].items():
+        print('Top-{} accuracy: {:.4f}'.format(k, accuracy))
+    print('Cross-entropy (MV labels): {:.4f}'.format(results['mv_cross_entropy']))
+    if 'pd_cross_entropy' in results:
+        print('Cross-entropy (PD labels): {:.4f}'.format(results['pd_cross_entropy']))
+
+    print('{:<12} {:>10} {:>10} {:>10} {:>8}'.format('Class', 'Precision',
+                                                     'Recall', 'F1', 'Support'))
+    for i, name in enumerate(class_names):
+        print('{:<12} {:>10.4f} {:>10.4f} {:>10.4f} {:>8}'.format(
+            name,
+            results['precision'][i],
+            results['recall'][i],
+            results['f1'][i],
+            results['support'][i]))
+
+def save_results(results, file_path):
+    '''Saves results as a JSON file'''
+    serializable = {key: value.tolist() if isinstance(value, np.ndarray) else value
+                    for key, value in results.items()}
+    with open(file_path, 'w') as file:
+        json.dump(serializable, file, indent = 2)
@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+from tensorflow.keras import layers
+
+import tflite_utils
+
+
+# Layers that only have effect during training
+TRAINING_ONLY_LAYERS = (layers.Dropout, layers.SpatialDropout2D, layers.GaussianNoise)
+
+# Activations that tflite fuses into the preceding convolution
+FUSABLE_ACTIVATIONS = ('relu', 'relu6')
+
+
+def get_inference_model(model):
+    '''Rebuilds a trained model for inference only:
+    * BatchNormalization is folded into the preceding (separable) convolution,
+    * dropout layers and identity activations are removed,
+    * ReLU activations are fused into the preceding convolution,
+    * the final 1x1 convolution is moved after global average pooling and
+      becomes a dense layer (both are linear, so the result is the same, but
+      the classifier runs on a single vector instead of every pixel).
+
+    Args:
+        model(keras.Model): trained model built with models.py (a chain of
+                            layers, Sequential or functional)
+
+    Returns: keras.Model computing the same function in inference mode.
+    '''
+    model_layers = [l for l in model.layers
+                    if not isinstance(l, layers.InputLayer)]
+
+    inputs = keras.Input(shape = model.input_shape[1:])
+    x = inputs
+    i = 0
+    while i < len(model_layers):
+        layer = model_layers[i]
+        next_layer = model_layers[i + 1] if i + 1 < len(model_layers) else None
+
+        if isinstance(layer, TRAINING_ONLY_LAYERS) or _is_identity(layer):
+            i += 1
+            continue
+
+        # 1x1 convolution + global average pooling -> pooling + dense
+        if (isinstance(next_layer, layers.GlobalAveragePooling2D)
+                and _is_pointwise_conv(layer)):
+            x = layers.GlobalAveragePooling2D()(x)
+            kernel, bias = _get_dense_weights(layer)
+            dense = layers.Dense(kernel.shape[1], name = layer.name)
+            x = dense(x)
+            dense.set_weights([kernel, bias])
+            i += 2
+            continue
+
+        if isinstance(layer, (layers.SeparableConv2D, layers.Conv2D)):
+            weights = _get_conv_weights(layer)
+            if isinstance(next_layer, layers.BatchNormalization):
+                weights = _fold_batch_norm(weights, next_layer)
+                i += 1
+            x, i = _add_conv(layer, weights, x, model_layers, i + 1)
+            continue
+
+        # Other layers (pooling, LeakyReLU, softmax...) are copied
+        new_layer = layer.__class__.from_config(_get_float32_config(layer))
+        x = new_layer(x)
+        new_layer.set_weights(layer.get_weights())
+        i += 1
+
+    return keras.Model(inputs, x, name = model.name + '_inference')
+
+def verify_parity(model, inference_model, image_data, atol = 1e-4, batch_size = 256):
+    '''Compares outputs of the original and the inference model.
+
+    Args:
+        model(keras.Model): original model
+        inference_model(keras.Model or bytes): rebuilt model or tflite model
+        image_data(ndarray): unnormalized images (n, 48, 48, 1), e.g. test split
+        atol(float): maximum allowed absolute difference of outputs
+        batch_size(int)
+
+    Returns: a dict with maximum absolute difference, argmax agreement and
+             whether the models are within tolerance.
+    '''
+    expected = model.predict(image_data / 255., batch_size = batch_size)
+    if isinstance(inference_model, bytes):
+        actual = tflite_utils.get_tflite_model_outputs(inference_model,
+                                                       image_data,
+                                                       batch_size)
+    else:
+        actual = inference_model.predict(image_data / 255.,
+                                         batch_size = batch_size)
+
+    max_abs_diff = float(np.max(np.abs(expected - actual)))
+    agreement = float(np.mean(expected.argmax(1) == actual.argmax(1)))
+    return {'max_abs_diff': max_abs_diff,
+            'argmax_agreement': agreement,
+            'within_tolerance': max_abs_diff <= atol}
+
+def export_inference_model(h5_path, output_dir, image_data = None, atol = 1e-4):
+    '''Exports a trained .h5 model as an inference-optimized SavedModel and
+    tflite file. If image data is given, the exported models are checked for
+    numerical parity with the original one.
+
+    Args:
+        h5_path(string): path to trained .h5 model
+        output_dir(string): directory for the exported files
+        image_data(ndarray): unnormalized images (n, 48, 48, 1) used for the
+                             parity check, e.g. data.get_image_data() of the
+                             test split
+        atol(float): maximum allowed absolute difference of outputs
+
+    Returns: a dict with the export report (also saved as JSON).
+    '''
+    name = os.path.splitext(os.path.basename(h5_path))[0]
+    os.makedirs(output_dir, exist_ok = True)
+
+    model = keras.models.load_model(h5_path, compile = False)
+    inference_model = get_inference_model(model)
+    tflite_model = tflite_utils.convert_to_tflite(inference_model)
+    original_tflite_model = tflite_utils.convert_to_tflite(model)
+
+    report = {'source': h5_path,
+              'layers': len(model.layers),
+              'inference_layers': len(inference_model.layers),
+              'tflite_ops': _count_tflite_ops(original_tflite_model),
+              'inference_tflite_ops': _count_tflite_ops(tflite_model)}
+
+    if image_data is not None:
+        report['keras_parity'] = verify_parity(model, inference_model, image_data, atol)
+        report['tflite_parity'] = verify_parity(model, tflite_model, image_data, atol)
+        for key in ('keras_parity', 'tflite_parity'):
+            if not report[key]['within_tolerance']:
+                raise ValueError('Exported model differs from the original: '
+                                 '{}'.format(report[key]))
+
+    saved_model_path = os.path.join(output_dir, name + '_inference')
+    inference_model.save(saved_model_path)
+    tflite_path = os.path.join(output_dir, name + '_inference.tflite')
+    with open(tflite_path, 'wb') as f:
+        f.write(tflite_model)
+
+    report['saved_model'] = saved_model_path
+    report['tflite'] = tflite_path
+    report['tflite_size_bytes'] = len(tflite_model)
+    report['load_time_s'] = {'h5': _measure_load_time(h5_path),
+                             'saved_model': _measure_load_time(saved_model_path)}
+
+    with open(os.path.join(output_dir, name + '_inference.json'), 'w') as file:
+        json.dump(report, file, indent = 2)
+    return report
+
+def _get_float32_config(layer):
+    '''Returns layer config with float32 dtype (the model might have been
+    trained with a mixed precision policy)'''
+    config = layer.get_config()
+    config['dtype'] = 'float32'
+    return config
+
+def _is_identity(layer):
+    '''Returns True for linear activation layers (e.g. float32 output cast)'''
+    return (isinstance(layer, layers.Activation)
+            and layer.get_config()['activation'] == 'linear')
+
+def _is_pointwise_conv(layer):
+    '''Returns True for linear 1x1 convolutions'''
+    return (isinstance(layer, (layers.SeparableConv2D, layers.Conv2D))
+            and tuple(layer.kernel_size) == (1, 1)
+            and tuple(layer.strides) == (1, 1)
+            and layer.get_config()['activation'] == 'linear')
+
+def _get_conv_weights(layer):
+    '''Returns a dict with kernels and bias (zeros if the layer has none)'''
+    if isinstance(layer, layers.SeparableConv2D):
+        weights = {'depthwise': layer.depthwise_kernel.numpy(),
+                   'kernel': layer.pointwise_kernel.numpy()}
+    else:
+        weights = {'kernel': layer.kernel.numpy()}
+    n_filters = weights['kernel'].shape[-1]
+    weights['bias'] = (layer.bias.numpy() if layer.use_bias
+                       else np.zeros(n_filters, dtype = np.float32))
+    return weights
+
+def _get_dense_weights(layer):
+    '''Returns (kernel, bias) of a dense layer equivalent to the linear 1x1
+    convolution applied after global average pooling'''
+    weights = _get_conv_weights(layer)
+    kernel = weights['kernel'][0, 0]
+    if 'depthwise' in weights:
+        # 1x1 depthwise convolution scales every input channel
+        kernel = weights['depthwise'][0, 0, :, 0][:, np.newaxis] * kernel
+    return kernel, weights['bias']
+
+def _fold_batch_norm(weights, bn):
+    '''Folds batch normalization into the kernel and bias of a convolution.
+    BN(conv(x)) = scale * (conv(x) - mean) + beta, scale = gamma / std'''
+    config = bn.get_config()
+    mean = bn.moving_mean.numpy()
+    variance = bn.moving_variance.numpy()
+    gamma = bn.gamma.numpy() if config['scale'] else np.ones_like(mean)
+    beta = bn.beta.numpy() if config['center'] else np.zeros_like(mean)
+
+    scale = gamma / np.sqrt(variance + config['epsilon'])
+    return dict(weights,
+                kernel = weights['kernel'] * scale,
+                bias = (weights['bias'] - mean) * scale + beta)
+
+def _add_conv(layer, weights, x, model_layers, i):
+    '''Adds the convolution with given weights to the graph, fusing the
+    following activation into it if tflite supports that.
+
+    Returns: a tuple (output tensor, index of the next layer to process).
+    '''
+    config = _get_float32_config(layer)
+    config['use_bias'] = True
+    # Regularizers and constraints are used only in training
+    for key in list(config):
+        if key.endswith('_regularizer') or key.endswith('_constraint'):
+            config[key] = None
+
+    next_layer = model_layers[i] if i < len(model_layers) else None
+    if (config['activation'] == 'linear'
+            and isinstance(next_layer, (layers.ReLU, layers.Activation))):
+        activation = _get_fusable_activation(next_layer)
+        if activation is not None:
+            config['activation'] = activation
+            i += 1
+
+    new_layer = layer.__class__.from_config(config)
+    x = new_layer(x)
+    if 'depthwise' in weights:
+        new_layer.set_weights([weights['depthwise'],
+                               weights['kernel'],
+                               weights['bias']])
+    else:
+        new_layer.set_weights([weights['kernel'], weights['bias']])
+    return x, i
+
+def _get_fusable_activation(layer):
+    '''Returns name of the activation if the layer can be fused into a
+    convolution, None otherwise'''
+    if isinstance(layer, layers.Activation):
+        activation = layer.get_config()['activation']
+        return activation if activation in FUSABLE_ACTIVATIONS else None
+    config = layer.get_config()
+    if config.get('negative_slope', 0) != 0 or config.get('threshold', 0) != 0:
+        return None
+    if config.get('max_value') is None:
+        return 'relu'
+    if config['max_value'] == 6:
+        return 'relu6'
+    return None
+
+def _count_tflite_ops(tflite_model):
+    '''Returns number of operators in the tflite model'''
+    interpreter = tf.lite.Interpreter(model_content = tflite_model)
+    return len(interpreter._get_ops_details())
+
+def _measure_load_time(model_path):
+    '''Returns time of loading a keras model in seconds'''
+    start = time.perf_counter()
+    keras.models.load_model(model_path, compile = False)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Export inference-optimized '
+                                                   'SavedModel and tflite model')
+    parser.add_argument('h5_path', help = 'path to trained .h5 model')
+    parser.add_argument('--output-dir', default = 'model')
+    parser.add_argument('--dataset-dir',
+                        help = 'directory with dataset files, if given, the '
+                               'export is checked on the test split')
+    parser.add_argument('--fer', action = 'store_true',
+                        help = 'use FER labels instead of FER-Plus')
+    parser.add_argument('--atol', type = float, default = 1e-4)
+    args = parser.parse_args()
+
+    image_data = None
+    if args.dataset_dir:
+        from data.dataset import get_dataset_dict
+        from data.data import get_image_data
+        from data.model_class.DataPipelineParams import DataPipelineParams, Dataset
+
+        dataset = Dataset.FER if args.fer else Dataset.FERPLUS
+        params = DataPipelineParams(dataset = dataset,
+                                    original_preprocessing = True)
+        dataset_dict = get_dataset_dict(args.dataset_dir)
+        image_data = get_image_data(dataset_dict['test'], params)
+
+    report = export_inference_model(args.h5_path,
+                                    args.output_dir,
+                                    image_data,
+                                    args.atol)
+    print(json.dumps(report, indent = 2))
+
+if __name__ == "__main__":
+    main()
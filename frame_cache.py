@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+
+def dhash(gray, hash_size=8):
+    """Difference hash of a grayscale frame as a hash_size**2 bit integer.
+
+    The frame is downsampled to (hash_size + 1) x hash_size and every bit tells
+    whether a pixel is brighter than its right neighbour, so the hash survives
+    JPEG noise and small lighting changes but not a moving face.
+    """
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(a, b):
+    """Number of differing bits of two hashes"""
+    return bin(a ^ b).count('1')
+
+def region_hash(gray, box, hash_size=8):
+    """Difference hash of the (x, y, w, h) box of a grayscale frame"""
+    x, y, w, h = [int(v) for v in box]
+    return dhash(gray[max(y, 0):y + h, max(x, 0):x + w], hash_size)
+
+
+class FrameCache:
+    """Per-session cache of analysis results keyed by perceptual frame hashes.
+
+    A frame hits the cache when a result of the same session was stored for a
+    hash within max_distance bits less than ttl seconds ago. The face usually
+    covers a small part of the frame, so a change of expression barely moves
+    the frame hash; results stored with a face box therefore also need the
+    hash of that box in the new frame to be within max_region_distance bits.
+    Sessions and their entries are evicted in least recently used order.
+    """
+
+    def __init__(self, max_sessions=1024, entries_per_session=4, ttl=10.0, max_distance=6,
+                 max_region_distance=4):
+        self.max_sessions = max_sessions
+        self.entries_per_session = entries_per_session
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.max_region_distance = max_region_distance
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted_sessions = 0
+        self.region_misses = 0
+
+    def lookup(self, session, frame_hash, gray=None):
+        """Return the cached result of a near-identical frame or None. gray is
+        the frame the hash was computed from, needed to check face regions."""
+        now = time.monotonic()
+        with self.lock:
+            entries = self.sessions.get(session)
+            if entries is None:
+                self.misses += 1
+                return None
+            self.sessions.move_to_end(session)
+
+            # Drop expired entries, then find the closest remaining hash
+            for key in [k for k, (_, created, _, _) in entries.items() if now - created > self.ttl]:
+                del entries[key]
+                self.expired += 1
+            best = min(entries, key=lambda k: hamming_distance(k, frame_hash), default=None)
+            if best is None or hamming_distance(best, frame_hash) > self.max_distance:
+                self.misses += 1
+                return None
+
+            result, _, box, box_hash = entries[best]
+            if box is not None and (gray is None or hamming_distance(
+                    region_hash(gray, box), box_hash) > self.max_region_distance):
+                self.misses += 1
+                self.region_misses += 1
+                return None
+
+            entries.move_to_end(best)
+            self.hits += 1
+            return result
+
+    def store(self, session, frame_hash, result, gray=None, box=None):
+        """Cache the analysis result of a frame. If the result has a face box,
+        pass it with the frame, so that later frames are checked within it."""
+        if gray is None:
+            box = None
+        box_hash = region_hash(gray, box) if box is not None else None
+        with self.lock:
+            entries = self.sessions.get(session)
+            if entries is None:
+                entries = self.sessions[session] = OrderedDict()
+                if len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+                    self.evicted_sessions += 1
+            self.sessions.move_to_end(session)
+            entries[frame_hash] = (result, time.monotonic(), box, box_hash)
+            entries.move_to_end(frame_hash)
+            while len(entries) > self.entries_per_session:
+                entries.popitem(last=False)
+
+    def get_metrics(self):
+        """Return hit/miss counters and the current size of the cache"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "region_misses": self.region_misses,
+                "expired": self.expired,
+                "evicted_sessions": self.evicted_sessions,
+                "sessions": len(self.sessions),
+                "entries": sum(len(e) for e in self.sessions.values()),
+            }
@@ -0,0 +1,262 @@
+from data import data
+from data.model_class.DataPipelineParams import Dataset
+import argparse
+from datetime import datetime, timezone
+import json
+
+import numpy as np
+import pandas as pd
+
+import evaluation
+
+
+class HardExampleIndex():
+    '''Per-sample loss, predicted distribution and margin of a model over a
+    dataset split, keyed by dataset rows (index of the unified dataframe).
+    Built once with build_index() and queried without running the model.'''
+
+    def __init__(self, rows, labels, probabilities, loss, margin, metadata):
+        '''Args:
+            rows(ndarray): dataframe index of every sample
+            labels(ndarray): integer majority labels
+            probabilities(ndarray): (n, n_classes) predicted distributions
+            loss(ndarray): cross-entropy with the training labels
+            margin(ndarray): probability of the true class minus the highest
+                             probability of other classes (negative for
+                             misclassified samples)
+            metadata(dict): model and pipeline parameters of the index
+        '''
+        self.rows = rows
+        self.labels = labels
+        self.probabilities = probabilities
+        self.loss = loss
+        self.margin = margin
+        self.metadata = metadata
+
+    @property
+    def predictions(self):
+        return self.probabilities.argmax(axis = 1)
+
+    def save(self, index_path):
+        '''Saves the index as an uncompressed .npz file'''
+        np.savez(index_path,
+                 rows = self.rows,
+                 labels = self.labels,
+                 probabilities = self.probabilities,
+                 loss = self.loss,
+                 margin = self.margin,
+                 metadata = np.array(json.dumps(self.metadata)))
+
+    @classmethod
+    def load(cls, index_path):
+        '''Loads an index saved with save()'''
+        with np.load(index_path) as index:
+            return cls(index['rows'],
+                       index['labels'],
+                       index['probabilities'],
+                       index['loss'],
+                       index['margin'],
+                       json.loads(str(index['metadata'])))
+
+    def hardest(self, k = 24, class_label = None):
+        '''Returns positions of the k samples with the highest loss,
+        optionally only of the given true class'''
+        return self._top_k(self.loss, k, self._class_mask(class_label))
+
+    def lowest_margin(self, k = 24, class_label = None):
+        '''Returns positions of the k samples with the lowest margin, i.e. the
+        most confidently misclassified ones first'''
+        return self._top_k(-self.margin, k, self._class_mask(class_label))
+
+    def confused(self, class_a, class_b, k = 24, symmetric = True):
+        '''Returns positions of the k samples of class_a that get the highest
+        probability of class_b (and vice versa if symmetric), e.g. the most
+        confused anger and disgust samples.
+
+        Args:
+            class_a(int): true class label
+            class_b(int): confused class label
+            k(int)
+            symmetric(boolean): whether to include class_b samples confused
+                                with class_a
+        '''
+        score = np.full(len(self.rows), -np.inf, dtype = np.float32)
+        mask = self.labels == class_a
+        score[mask] = self.probabilities[mask, class_b]
+        if symmetric:
+            mask = self.labels == class_b
+            score[mask] = self.probabilities[mask, class_a]
+        return self._top_k(score, k, np.isfinite(score))
+
+    def get_rows(self, positions):
+        '''Returns dataset rows of positions returned by the queries'''
+        return self.rows[positions]
+
+    def get_view_data(self, dataset_df, positions):
+        '''Returns data of queried samples in the format expected by
+        predictions.display_* and predictions.save_contact_sheet.
+
+        Args:
+            dataset_df(dataframe): dataset the index was built from
+            positions(ndarray): positions returned by the queries
+
+        Returns:
+            images(ndarray): images in data.RAW_VALUE_RANGE
+            labels(ndarray): label distributions for FER-Plus with cross
+                             entropy, basis vectors otherwise
+            probabilities(ndarray): predicted distributions
+        '''
+        dataset = Dataset[self.metadata['dataset']]
+        cross_entropy = self.metadata['cross_entropy']
+        rows = self.get_rows(positions)
+        samples_df = data._remove_outliers(dataset_df.loc[rows],
+                                           dataset,
+                                           cross_entropy,
+                                           self.metadata['original_preprocessing'])
+        samples_df = samples_df.loc[rows]
+        images = data._get_image_array(samples_df)
+        labels = data._get_label_data(samples_df, dataset, cross_entropy)
+        return (images, labels, self.probabilities[positions].astype(np.float32))
+
+    def display(self, dataset_df, positions, class_mapping):
+        '''Displays queried samples with predictions.display_* (24 samples for
+        majority labels, 12 for label distributions)'''
+        import predictions
+
+        images, labels, probabilities = self.get_view_data(dataset_df, positions)
+        is_distribution = (self.metadata['dataset'] == Dataset.FERPLUS.name
+                           and self.metadata['cross_entropy'])
+        if is_distribution:
+            predictions.display_cross_entropy_predictions(images,
+                                                          labels,
+                                                          class_mapping,
+                                                          probabilities)
+        else:
+            predictions.display_majority_predictions(images,
+                                                     labels,
+                                                     class_mapping,
+                                                     probabilities)
+
+    def get_sampling_weights(self, power = 1., uniform_mix = 0.5):
+        '''Returns sampling weights for data.get_data_pipeline(), higher for
+        samples with higher loss. Weights are mixed with uniform ones so that
+        every sample keeps being seen.
+
+        Args:
+            power(float): exponent applied to losses
+            uniform_mix(float): weight of the uniform part, in [0, 1]
+
+        Returns: a Series of weights (mean 1) indexed by dataset rows.
+        '''
+        hardness = self.loss.astype(np.float64) ** power
+        hardness /= max(hardness.mean(), 1e-12)
+        weights = uniform_mix + (1. - uniform_mix) * hardness
+        return pd.Series(weights, index = self.rows)
+
+    def _class_mask(self, class_label):
+        if class_label is None:
+            return np.ones(len(self.rows), dtype = bool)
+        return self.labels == class_label
+
+    @staticmethod
+    def _top_k(score, k, mask):
+        '''Returns positions of the k highest scores among masked samples'''
+        candidates = np.flatnonzero(mask)
+        k = min(k, len(candidates))
+        if k == 0:
+            return candidates
+        top = np.argpartition(-score[candidates], k - 1)[:k]
+        top = top[np.argsort(-score[candidates][top], kind = 'stable')]
+        return candidates[top]
+
+
+def build_index(model,
+                dataset_df,
+                params,
+                index_path = None,
+                batch_size = 256,
+                chunk_size = 4096):
+    '''Runs the model over the dataset split once in batches and indexes the
+    loss, predicted distribution and margin of every sample.
+
+    Args:
+        model(keras.Model, string or bytes): keras model, path to .tflite or
+                                             .h5 model file or tflite content
+        dataset_df(dataframe): specific dataset (usually train) loaded from
+                               a unified dataset created using
+                               dataset.get_dataset_dict()
+        params(DataPipelineParams): parameters of the training pipeline, the
+                                    loss is computed with its labels
+        index_path(string): optional path of the .npz file to save the index
+        batch_size(int): number of images passed to the model at once
+        chunk_size(int): number of dataframe rows decoded at once
+
+    Returns: HardExampleIndex.
+    '''
+    pd_loss = params.dataset == Dataset.FERPLUS and params.cross_entropy
+    rows, labels, probabilities, loss, margin = [], [], [], [], []
+    for batch_rows, y_true, distributions, batch_ps in evaluation.iterate_predictions(
+            model, dataset_df, params, batch_size, chunk_size):
+        log_p = np.log(np.clip(batch_ps, 1e-7, 1.))
+        batch = np.arange(len(y_true))
+        true_p = batch_ps[batch, y_true]
+        other_ps = batch_ps.copy()
+        other_ps[batch, y_true] = -np.inf
+
+        rows.append(batch_rows)
+        labels.append(y_true.astype(np.int8))
+        probabilities.append(batch_ps.astype(np.float16))
+        loss.append(-(distributions * log_p).sum(axis = 1) if pd_loss
+                    else -log_p[batch, y_true])
+        margin.append(true_p - other_ps.max(axis = 1))
+
+    metadata = {'model': model if isinstance(model, str) else None,
+                'dataset': params.dataset.name,
+                'cross_entropy': params.cross_entropy,
+                'original_preprocessing': params.original_preprocessing,
+                'created': datetime.now(timezone.utc).isoformat()}
+    index = HardExampleIndex(np.concatenate(rows).astype(np.int64),
+                             np.concatenate(labels),
+                             np.concatenate(probabilities),
+                             np.concatenate(loss).astype(np.float32),
+                             np.concatenate(margin).astype(np.float32),
+                             metadata)
+    if index_path is not None:
+        index.save(index_path)
+    return index
+
+def main():
+    from data import dataset
+    from data.model_class.DataPipelineParams import DataPipelineParams
+
+    parser = argparse.ArgumentParser(description = 'Build a hard-example index '
+                                                   'of a model over a split')
+    parser.add_argument('model', help = 'path to .tflite or .h5 model')
+    parser.add_argument('--dataset-dir', default = '../dataset')
+    parser.add_argument('--split', default = 'train',
+                        choices = ['train', 'valid', 'test'])
+    parser.add_argument('--dataset', default = Dataset.FERPLUS.name,
+                        choices = [d.name for d in Dataset])
+    parser.add_argument('--cross-entropy', action = 'store_true')
+    parser.add_argument('--original-preprocessing', action = 'store_true')
+    parser.add_argument('--batch-size', type = int, default = 256)
+    parser.add_argument('--output', default = 'hard_examples.npz')
+    args = parser.parse_args()
+
+    params = DataPipelineParams(dataset = Dataset[args.dataset],
+                                cross_entropy = args.cross_entropy,
+                                original_preprocessing = args.original_preprocessing)
+    dataset_dict = dataset.get_dataset_dict(args.dataset_dir)
+    index = build_index(args.model,
+                        dataset_dict[args.split],
+                        params,
+                        args.output,
+                        args.batch_size)
+    print('Indexed {} samples, mean loss {:.4f}, {} misclassified'.format(
+        len(index.rows),
+        float(index.loss.mean()),
+        int(np.sum(index.margin < 0))))
+    print('Index saved to {}'.format(args.output))
+
+if __name__ == "__main__":
+    main()
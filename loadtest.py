@@ -0,0 +1,337 @@
+"""Load-test harness of the Moodify API.
+
+Starts local stub Ambee and Spotify servers with configurable latency and
+error rate, launches the API (serve.py, or app.py's single process with
+--single-process) pointed at them, and replays /analyze and /recommend
+traffic at a fixed concurrency. Reports
+throughput, latency percentiles and the per-stage breakdown taken from the
+Server-Timing headers of the API.
+
+Traffic is either synthetic or replayed from a JSONL file with one request
+per line: {"method": "GET", "path": "/recommend?emotion=happiness"} or
+{"method": "POST", "path": "/analyze", "body": {"image": "data:image/jpeg;base64,..."}}.
+Synthetic traffic can be saved in the same format with --save-traffic.
+
+With --target the requests go to an already running API instead, and no
+stubs are started: that server calls whichever Ambee and Spotify it was
+configured with, usually the real ones, so its numbers include their latency.
+
+Usage:
+    python loadtest.py --start-server --workers 2 --concurrency 8 --duration 30
+    python loadtest.py --single-process --concurrency 8 --duration 30
+    python loadtest.py --target http://staging:8000 --replay traffic.jsonl
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+import requests
+
+from song_dictionary import AMBEE_WEATHER_KEYS
+
+EMOTIONS = ['neutral', 'happiness', 'surprise', 'sadness', 'anger', 'disgust', 'fear', 'contempt']
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+def get_ambee_response(path):
+    """Stub of Ambee /weather/latest/by-lat-lng"""
+    if not path.startswith('/weather/latest/by-lat-lng'):
+        return 404, {"message": "not found"}
+    return 200, {"message": "success", "data": {"icon": random.choice(AMBEE_WEATHER_KEYS)}}
+
+def get_spotify_response(path):
+    """Stub of Spotify /api/token (accounts) and /v1/search (API)"""
+    if path.startswith('/api/token'):
+        return 200, {"access_token": "stub-token", "token_type": "Bearer", "expires_in": 3600}
+    if path.startswith('/v1/search'):
+        track = {"external_urls": {"spotify": "https://open.spotify.com/track/stub"}}
+        return 200, {"tracks": {"items": [track]}}
+    return 404, {"error": "not found"}
+
+def start_stub_server(get_response, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+    """Serve a stub upstream on a free local port from a background thread.
+
+    Every request waits latency_ms +- jitter_ms and fails with HTTP 500 with
+    probability error_rate. Returns (server, base url).
+    """
+    class StubHandler(BaseHTTPRequestHandler):
+        def _respond(self):
+            delay = max(0.0, latency_ms + random.uniform(-jitter_ms, jitter_ms))
+            time.sleep(delay / 1000)
+            if random.random() < error_rate:
+                status, body = 500, {"error": "stub failure"}
+            else:
+                status, body = get_response(self.path)
+            content = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        do_GET = _respond
+        do_POST = _respond
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+def start_api_server(port, workers, env, single_process=False):
+    """Launch serve.py (or app.py's app in a single uvicorn process) with the
+    given environment and wait until it is healthy"""
+    if single_process:
+        command = [sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, 'serve.py', '--port', str(port),
+                   '--workers', str(workers), '--log-level', 'warning']
+    process = subprocess.Popen(command, env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 180
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API server exited with status {process.returncode}")
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                return process, url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("API server did not become healthy in time")
+
+def get_face_frames(dataset_dir, n_frames=32, frame_size=(640, 480), face_size=192):
+    """Build JPEG webcam-like frames with FER-Plus test faces pasted at random positions"""
+    from data.dataset import read_dataset_csv
+    from data.data import _str_to_image_data
+
+    dataset_df = read_dataset_csv(dataset_dir)
+    test_df = dataset_df.loc[dataset_df['dataset'] == 'test'].sample(n_frames, random_state=0)
+    frames = []
+    for image in test_df['image']:
+        face = cv2.resize(_str_to_image_data(image), (face_size, face_size))
+        frame = np.full((frame_size[1], frame_size[0]), 128, dtype=np.uint8)
+        x = random.randint(0, frame_size[0] - face_size)
+        y = random.randint(0, frame_size[1] - face_size)
+        frame[y:y + face_size, x:x + face_size] = face
+        frames.append(_encode_frame(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)))
+    return frames
+
+def get_noise_frames(n_frames=8, frame_size=(640, 480)):
+    """Build JPEG frames without faces, which exercise decoding and detection only"""
+    rng = np.random.default_rng(0)
+    return [_encode_frame(rng.integers(0, 256, (frame_size[1], frame_size[0], 3), dtype=np.uint8))
+            for _ in range(n_frames)]
+
+def _encode_frame(frame):
+    _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.tobytes()).decode()
+
+def get_synthetic_traffic(n_requests, analyze_percent, frames):
+    """Mix /analyze requests (one session per frame) with /recommend requests"""
+    traffic = []
+    for i in range(n_requests):
+        if frames and random.random() * 100 < analyze_percent:
+            frame_index = random.randrange(len(frames))
+            traffic.append({"method": "POST", "path": "/analyze",
+                            "body": {"image": frames[frame_index], "session": f"loadtest-{i}"}})
+        else:
+            lat, lng = random.uniform(-60, 60), random.uniform(-180, 180)
+            traffic.append({"method": "GET",
+                            "path": f"/recommend?emotion={random.choice(EMOTIONS)}&lat={lat:.4f}&lng={lng:.4f}"})
+    return traffic
+
+def load_traffic(traffic_path):
+    with open(traffic_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def save_traffic(traffic, traffic_path):
+    with open(traffic_path, 'w') as f:
+        for request in traffic:
+            f.write(json.dumps(request) + "\n")
+
+def run_load(target, traffic, concurrency, duration=None, n_requests=None, timeout=30):
+    """Replay traffic (cycled) from concurrency clients until duration seconds
+    or n_requests requests. Returns (results, elapsed seconds)."""
+    n_requests = n_requests or (None if duration else len(traffic))
+    counter = iter(range(sys.maxsize))
+    counter_lock = threading.Lock()
+    results = []
+    start = time.perf_counter()
+
+    def client():
+        session = requests.Session()
+        while True:
+            with counter_lock:
+                i = next(counter)
+            if n_requests is not None and i >= n_requests:
+                return
+            if duration is not None and time.perf_counter() - start > duration:
+                return
+            request = traffic[i % len(traffic)]
+            results.append(_send(session, target, request, timeout))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(client)
+    return results, time.perf_counter() - start
+
+def _send(session, target, request, timeout):
+    """Send one request and return its endpoint, status, latency and stage timings"""
+    endpoint = urlparse(request['path']).path
+    start = time.perf_counter()
+    try:
+        response = session.request(request.get('method', 'GET'), target + request['path'],
+                                   json=request.get('body'), timeout=timeout)
+        latency = (time.perf_counter() - start) * 1000
+        failed = response.status_code >= 400 or 'error' in response.json()
+        return {"endpoint": endpoint, "status": response.status_code, "latency_ms": latency,
+                "failed": failed, "stages": parse_server_timing(response.headers.get('Server-Timing', ''))}
+    except (requests.RequestException, ValueError) as e:
+        latency = (time.perf_counter() - start) * 1000
+        return {"endpoint": endpoint, "status": type(e).__name__, "latency_ms": latency,
+                "failed": True, "stages": {}}
+
+def parse_server_timing(header):
+    """Parse 'name;dur=1.23, other;dur=4.56' into {name: duration}"""
+    stages = {}
+    for entry in header.split(','):
+        name, _, params = entry.strip().partition(';')
+        if name and params.startswith('dur='):
+            stages[name] = float(params[4:])
+    return stages
+
+def summarize(results, elapsed):
+    """Aggregate results into throughput, latency percentiles and stage breakdown per endpoint"""
+    report = {"requests": len(results), "elapsed_s": elapsed,
+              "throughput_rps": len(results) / elapsed if elapsed else 0.0,
+              "failed": sum(r['failed'] for r in results), "endpoints": {}}
+    for endpoint in sorted(set(r['endpoint'] for r in results)):
+        endpoint_results = [r for r in results if r['endpoint'] == endpoint]
+        latencies = np.array([r['latency_ms'] for r in endpoint_results])
+        statuses = {}
+        for r in endpoint_results:
+            statuses[str(r['status'])] = statuses.get(str(r['status']), 0) + 1
+
+        stages = {}
+        for r in endpoint_results:
+            for name, duration in r['stages'].items():
+                stages.setdefault(name, []).append(duration)
+
+        report["endpoints"][endpoint] = {
+            "requests": len(endpoint_results),
+            "failed": sum(r['failed'] for r in endpoint_results),
+            "statuses": statuses,
+            "throughput_rps": len(endpoint_results) / elapsed if elapsed else 0.0,
+            "latency_ms": dict({f"p{p}": float(np.percentile(latencies, p)) for p in PERCENTILES},
+                               mean=float(latencies.mean())),
+            "stages_ms": {name: {"count": len(d), "mean": float(np.mean(d)), "p95": float(np.percentile(d, 95))}
+                          for name, d in stages.items()},
+        }
+    return report
+
+def print_report(report):
+    print(f"{report['requests']} requests in {report['elapsed_s']:.1f} s, "
+          f"{report['throughput_rps']:.1f} req/s, {report['failed']} failed")
+    for endpoint, r in report['endpoints'].items():
+        latency = r['latency_ms']
+        print(f"\n{endpoint}: {r['requests']} requests ({r['throughput_rps']:.1f} req/s), "
+              f"{r['failed']} failed, statuses {r['statuses']}")
+        print("  latency  " + "  ".join(f"p{p} {latency[f'p{p}']:.1f} ms" for p in PERCENTILES))
+        for name, stage in r['stages_ms'].items():
+            print(f"  {name:<10} mean {stage['mean']:8.2f} ms  p95 {stage['p95']:8.2f} ms  ({stage['count']})")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the Moodify API against stub upstreams')
+    parser.add_argument('--target', default=None, help='URL of a running API, tested without stubs (default: start one)')
+    parser.add_argument('--start-server', action='store_true',
+                        help='launch serve.py pointed at the stubs (default if no --target)')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--single-process', action='store_true',
+                        help='launch app.py\'s app in one process instead of serve.py (baseline)')
+    parser.add_argument('--frame-cache-ttl', type=float, default=0.0,
+                        help='MOODIFY_FRAME_CACHE_TTL of the launched server (0 disables the cache)')
+    parser.add_argument('--upstream-latency-ms', type=float, default=50.0)
+    parser.add_argument('--upstream-jitter-ms', type=float, default=10.0)
+    parser.add_argument('--upstream-error-rate', type=float, default=0.0)
+    parser.add_argument('--replay', default=None, help='JSONL file with recorded requests')
+    parser.add_argument('--save-traffic', default=None, help='save synthetic traffic as JSONL')
+    parser.add_argument('--requests', type=int, default=1000,
+                        help='number of requests (synthetic traffic size if --duration is set)')
+    parser.add_argument('--duration', type=float, default=None, help='run for this many seconds')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--analyze-percent', type=float, default=50.0)
+    parser.add_argument('--dataset-dir', default=None,
+                        help='directory with dataset.csv to build frames with faces')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='loadtest.json')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.replay:
+        traffic = load_traffic(args.replay)
+    else:
+        frames = get_face_frames(args.dataset_dir) if args.dataset_dir else get_noise_frames()
+        traffic = get_synthetic_traffic(args.requests, args.analyze_percent, frames)
+        if args.save_traffic:
+            save_traffic(traffic, args.save_traffic)
+
+    process = None
+    stubs = []
+    target = args.target
+    if target is None or args.start_server or args.single_process:
+        stub_options = dict(latency_ms=args.upstream_latency_ms,
+                            jitter_ms=args.upstream_jitter_ms,
+                            error_rate=args.upstream_error_rate)
+        ambee, ambee_url = start_stub_server(get_ambee_response, **stub_options)
+        spotify, spotify_url = start_stub_server(get_spotify_response, **stub_options)
+        stubs = [ambee, spotify]
+        env = dict(os.environ,
+                   AMBEE_API_URL=ambee_url,
+                   SPOTIFY_ACCOUNTS_URL=spotify_url,
+                   SPOTIFY_API_URL=spotify_url,
+                   AMBEE_API_KEY='stub',
+                   SPOTIFY_CLIENT_ID='stub',
+                   SPOTIFY_CLIENT_SECRET='stub',
+                   MOODIFY_FRAME_CACHE_TTL=str(args.frame_cache_ttl))
+        process, target = start_api_server(args.port, args.workers, env, args.single_process)
+    else:
+        print(f"Testing {target} without stubs: it calls the Ambee and Spotify it was configured with, "
+              f"and their latency is part of the results")
+
+    try:
+        results, elapsed = run_load(target, traffic, args.concurrency,
+                                    duration=args.duration,
+                                    n_requests=None if args.duration else len(traffic))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        for stub in stubs:
+            stub.shutdown()
+
+    report = summarize(results, elapsed)
+    report["config"] = dict(vars(args), stub_upstreams=bool(stubs))
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"\nReport saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
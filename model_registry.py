@@ -0,0 +1,231 @@
+import glob
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from tflite_utils import dequantize_output, outputs_are_logits, quantize_input, to_probabilities
+
+MODEL_DIR = 'model'
+DEFAULT_MODEL = 'ferplus_model_pd_best.tflite'
+
+# Number of recent latencies kept per model for percentiles
+LATENCY_WINDOW = 1024
+
+
+def get_latency_summary(latencies):
+    """Return count and p50/p95 of a window of latencies in milliseconds"""
+    if not latencies:
+        return {"count": 0, "p50_ms": None, "p95_ms": None}
+    values = np.array(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+    }
+
+
+def get_percent(name, value):
+    """Return a percentage as a float, raise ValueError if it is not a number in [0, 100]"""
+    try:
+        percent = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number between 0 and 100") from None
+    if not (math.isfinite(percent) and 0 <= percent <= 100):
+        raise ValueError(f"{name} must be a number between 0 and 100")
+    return percent
+
+
+class TFLiteModel:
+    """A loaded .tflite model with its own interpreter.
+
+    An interpreter cannot run two invokes at once, so predict() holds a lock.
+    The input is resized only when the batch size changes. Fully quantized
+    models get their float input quantized and their output dequantized.
+    """
+
+    def __init__(self, name, model_content=None, model_path=None, num_threads=None):
+        self.name = name
+        if model_content is not None:
+            self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        else:
+            self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.input_index = self.input_details['index']
+        self.output_index = self.output_details['index']
+        self.input_shape = tuple(self.input_details['shape'][1:])
+        # Decided once per model, so that all its outputs are handled alike
+        self.from_logits = outputs_are_logits(self.interpreter)
+        self.batch_size = 1
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+
+    def predict(self, batch):
+        """Run a single invoke on a float batch and return probabilities"""
+        with self.lock:
+            start = time.perf_counter()
+            if len(batch) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(batch)
+            self.interpreter.set_tensor(self.input_index, quantize_input(batch, self.input_details))
+            self.interpreter.invoke()
+            outputs = dequantize_output(self.interpreter.get_tensor(self.output_index), self.output_details)
+            self.latencies.append((time.perf_counter() - start) * 1000)
+            self.requests += 1
+        return to_probabilities(outputs, self.from_logits)
+
+    def warmup(self, batch_size=1):
+        """Run the model once, so that the first request does not pay for lazy
+        initialization. predict() quantizes the zero input for integer models."""
+        self.predict(np.zeros((batch_size,) + self.input_shape, dtype='float32'))
+        self.latencies.clear()
+        self.requests = 0
+
+
+class ModelRegistry:
+    """Loads .tflite models from a directory and routes predictions between them.
+
+    One model is active. A candidate can receive traffic_percent of requests
+    (A/B routing) and/or be shadow-run on shadow_percent of the requests
+    served by the active model: its prediction is computed off the request
+    path and only compared with the active one to record agreement.
+
+    Swapping models replaces references under a lock only after the new model
+    is loaded and warmed up. Requests already running keep the model they
+    started with, so none are dropped.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR, active=None, model_contents=None, num_threads=None,
+                 warmup_batch_size=1):
+        self.model_dir = model_dir
+        self.model_contents = model_contents or {}
+        self.num_threads = num_threads
+        self.warmup_batch_size = warmup_batch_size
+        self.models = {}
+        self.lock = threading.Lock()
+        self.candidate = None
+        self.traffic_percent = 0.0
+        self.shadow_percent = 0.0
+        self.shadow_stats = {}
+        # At most one shadow run is queued or running, the others are skipped
+        # so that a slow candidate cannot pile up request copies
+        self.shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shadow')
+        self.shadow_slot = threading.Semaphore(1)
+        self.shadow_skipped = 0
+        self.active = self.load(active or DEFAULT_MODEL)
+
+    def available_models(self):
+        """Names of .tflite files in the model directory"""
+        paths = glob.glob(os.path.join(self.model_dir, '*.tflite'))
+        return sorted(set(os.path.basename(p) for p in paths) | set(self.model_contents))
+
+    def load(self, name):
+        """Load (or return the already loaded) model by its file name. Raises
+        ValueError for an unknown model or one the interpreter cannot run."""
+        with self.lock:
+            if name in self.models:
+                return self.models[name]
+        if name not in self.available_models():
+            raise ValueError(f"Unknown model: {name}")
+
+        try:
+            model = TFLiteModel(name,
+                                model_content=self.model_contents.get(name),
+                                model_path=os.path.join(self.model_dir, name),
+                                num_threads=self.num_threads)
+            model.warmup(self.warmup_batch_size)
+        except (RuntimeError, ValueError) as e:
+            raise ValueError(f"Cannot load model {name}: {e}") from e
+        with self.lock:
+            return self.models.setdefault(name, model)
+
+    def activate(self, name):
+        """Atomically make a model the active one"""
+        model = self.load(name)
+        with self.lock:
+            previous = self.active
+            self.active = model
+            if self.candidate is model:
+                self.candidate = None
+        return previous.name
+
+    def set_candidate(self, name, traffic_percent=0.0, shadow_percent=0.0):
+        """Route traffic_percent of requests to a candidate model and shadow-run
+        it on shadow_percent of the rest. name None removes the candidate.
+        Raises ValueError if a percentage is not a number in [0, 100]."""
+        traffic_percent = get_percent('traffic_percent', traffic_percent)
+        shadow_percent = get_percent('shadow_percent', shadow_percent)
+        model = self.load(name) if name else None
+        with self.lock:
+            self.candidate = model
+            self.traffic_percent = traffic_percent if model else 0.0
+            self.shadow_percent = shadow_percent if model else 0.0
+
+    def predict(self, batch):
+        """Return (probabilities, model name) of a batch, routed between models"""
+        with self.lock:
+            active, candidate = self.active, self.candidate
+            traffic_percent, shadow_percent = self.traffic_percent, self.shadow_percent
+
+        if candidate is not None and random.random() * 100 < traffic_percent:
+            return candidate.predict(batch), candidate.name
+
+        probabilities = active.predict(batch)
+        if candidate is not None and random.random() * 100 < shadow_percent:
+            if self.shadow_slot.acquire(blocking=False):
+                self.shadow_executor.submit(self._shadow_run, candidate, active.name, batch.copy(), probabilities)
+            else:
+                with self.lock:
+                    self.shadow_skipped += 1
+        return probabilities, active.name
+
+    def _shadow_run(self, candidate, active_name, batch, active_probabilities):
+        """Run the candidate on a request served by the active model and record agreement"""
+        try:
+            probabilities = candidate.predict(batch)
+        except Exception as e:
+            print(f"Shadow run of {candidate.name} failed: {e}")
+            return
+        finally:
+            self.shadow_slot.release()
+        agree = probabilities.mean(axis=0).argmax() == active_probabilities.mean(axis=0).argmax()
+        with self.lock:
+            stats = self.shadow_stats.setdefault((candidate.name, active_name), {"runs": 0, "agreements": 0})
+            stats["runs"] += 1
+            stats["agreements"] += int(agree)
+
+    def get_metrics(self):
+        """Return routing configuration, per-model latency and shadow agreement"""
+        with self.lock:
+            models = dict(self.models)
+            metrics = {
+                "active": self.active.name,
+                "candidate": self.candidate.name if self.candidate else None,
+                "traffic_percent": self.traffic_percent,
+                "shadow_percent": self.shadow_percent,
+                "shadow_skipped": self.shadow_skipped,
+                "shadow": [
+                    {
+                        "candidate": candidate,
+                        "active": active,
+                        "runs": stats["runs"],
+                        "agreement": stats["agreements"] / stats["runs"] if stats["runs"] else None,
+                    }
+                    for (candidate, active), stats in self.shadow_stats.items()
+                ],
+            }
+        metrics["models"] = {
+            name: dict(get_latency_summary(list(model.latencies)), requests=model.requests)
+            for name, model in models.items()
+        }
+        return metrics
@@ -79,8 +79,7 @@ def get_smart_model(input,
     x = layers.Conv2D(n_classes, (1, 1), padding = 'same')(x)
     output = layers.GlobalAveragePooling2D()(x)
 
-    if not logits:
-        output = layers.Softmax()(output)
+    output = _get_output_layer(logits)(output)
 
     model = Model(input, output)
     return model
@@ -155,8 +154,7 @@ def get_base_model(leaky_relu_slope,
         layers.GlobalAveragePooling2D()
     ])
 
-    if not logits:
-        model.append(layers.Softmax())
+    model.add(_get_output_layer(logits))
 
     return model
 
@@ -242,7 +240,74 @@ def get_performance_model(leaky_relu_slope,
         layers.GlobalAveragePooling2D()
     ])
 
-    if not logits:
-        model.append(layers.Softmax())
+    model.add(_get_output_layer(logits))
 
     return model
+
+
+def get_micro_model(leaky_relu_slope,
+                    dropout_rate,
+                    regularization_rate,
+                    width_multiplier = 0.5,
+                    internal_resolution = None,
+                    input_shape = (48, 48, 1),
+                    n_classes = 8,
+                    logits = False):
+    '''Narrower version of the base model meant to be a distillation student.
+
+    Args:
+        width_multiplier(float): multiplies the number of filters of every
+                                 separable convolution of the base model
+        internal_resolution(int): if given, input images are downscaled to
+                                  this resolution inside the model, so it
+                                  still takes (48, 48, 1) images
+    '''
+    regularization = l2(regularization_rate)
+
+    def width(n_filters):
+        return max(8, int(round(n_filters * width_multiplier)))
+
+    model = keras.Sequential([layers.InputLayer(input_shape = input_shape)])
+    if internal_resolution is not None:
+        model.add(layers.Resizing(internal_resolution,
+                                  internal_resolution,
+                                  interpolation = 'bilinear'))
+
+    for n_filters in (48, 96, 192):
+        model.add(layers.SeparableConv2D(width(n_filters),
+                                         (3, 3),
+                                         kernel_regularizer = regularization,
+                                         padding = 'same'))
+        model.add(layers.BatchNormalization())
+        model.add(layers.LeakyReLU(leaky_relu_slope))
+        model.add(layers.SeparableConv2D(width(n_filters),
+                                         (3, 3),
+                                         kernel_regularizer = regularization,
+                                         padding = 'same'))
+        model.add(layers.BatchNormalization())
+        model.add(layers.MaxPooling2D((2, 2)))
+        model.add(layers.SpatialDropout2D(dropout_rate))
+        model.add(layers.LeakyReLU(leaky_relu_slope))
+
+    model.add(layers.SeparableConv2D(width(384),
+                                     (3, 3),
+                                     kernel_regularizer = regularization,
+                                     padding = 'same'))
+    model.add(layers.BatchNormalization())
+    model.add(layers.MaxPooling2D((2, 2)))
+    model.add(layers.SpatialDropout2D(dropout_rate))
+    model.add(layers.LeakyReLU(leaky_relu_slope))
+
+    model.add(layers.SeparableConv2D(n_classes, (1, 1), padding = 'same'))
+    model.add(layers.GlobalAveragePooling2D())
+    model.add(_get_output_layer(logits))
+
+    return model
+
+
+def _get_output_layer(logits):
+    '''Returns the last layer of a model. It is computed in float32, so that
+    softmax and loss stay numerically stable under a mixed precision policy.'''
+    if logits:
+        return layers.Activation('linear', dtype = 'float32')
+    return layers.Softmax(dtype = 'float32')
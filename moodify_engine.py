@@ -1,10 +1,17 @@
+import math
 import os
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
-import tensorflow as tf
 import requests
 from dotenv import load_dotenv
-from song_dictionary import SONG_DICTIONARY, infer_weather_key_from_ambee
+from song_dictionary import SONG_CATALOG_PATH, infer_weather_key_from_ambee
+from song_catalog import SongCatalog
+from model_registry import DEFAULT_MODEL, MODEL_DIR, ModelRegistry
 
 # Load environment variables
 load_dotenv()
@@ -13,106 +20,362 @@ AMBEE_API_KEY = os.getenv("AMBEE_API_KEY")
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 
+# Upstream services, overridden by loadtest.py to point at local stubs
+AMBEE_API_URL = os.getenv("AMBEE_API_URL", "https://api.ambeedata.com")
+SPOTIFY_ACCOUNTS_URL = os.getenv("SPOTIFY_ACCOUNTS_URL", "https://accounts.spotify.com")
+SPOTIFY_API_URL = os.getenv("SPOTIFY_API_URL", "https://api.spotify.com")
+
+MODEL_PATH = os.path.join(MODEL_DIR, DEFAULT_MODEL)
+
+# Number of Spotify URLs kept, least recently used ones are dropped
+SPOTIFY_CACHE_SIZE = 10000
+# Number of weather cells kept, least recently used ones are dropped
+WEATHER_CACHE_SIZE = 10000
+
+# Seconds to wait for Ambee and Spotify
+UPSTREAM_TIMEOUT = 10
+# Upstream calls of one recommend_batch() that run at once
+BATCH_CONCURRENCY = 8
+
 # Mapping of emotion classes (Match index to name)
 EMOTIONS = ['neutral', 'happiness', 'surprise', 'sadness', 'anger', 'disgust', 'fear', 'contempt']
 
+# How /analyze picks songs: "argmax" from the most probable emotion only, or
+# "blend" from a mixture of all emotions weighted by probability ** BLEND_POWER
+# (powers above 1 favour the most probable emotion more)
+RECOMMENDATION_MODE = os.getenv("MOODIFY_RECOMMENDATION_MODE", "argmax")
+BLEND_POWER = float(os.getenv("MOODIFY_BLEND_POWER", "1"))
+
+def get_top_emotion(probabilities):
+    """Name of the most probable emotion"""
+    return EMOTIONS[int(np.argmax(probabilities))]
+
+# Test-time augmentation: the face is cropped with a margin of TTA_SHIFT pixels
+# (at model resolution) and classified at these (dy, dx) offsets, each also
+# flipped horizontally. (TTA_SHIFT, TTA_SHIFT) is the plain center crop.
+FACE_SIZE = 48
+TTA_SHIFT = 2
+TTA_OFFSETS = [(2, 2), (0, 2), (4, 2), (2, 0), (2, 4)]
+
+def get_tta_batch(face):
+    """Build the TTA batch of a face cropped with margin in one vectorized step.
+
+    face is a (FACE_SIZE + 2 * TTA_SHIFT) square uint8 grayscale image. Returns
+    a (2 * len(TTA_OFFSETS), 48, 48, 1) float32 batch of shifted crops and
+    their horizontal flips.
+    """
+    windows = np.lib.stride_tricks.sliding_window_view(face, (FACE_SIZE, FACE_SIZE))
+    offsets = np.array(TTA_OFFSETS)
+    crops = windows[offsets[:, 0], offsets[:, 1]]
+    batch = np.concatenate([crops, crops[:, :, ::-1]])
+    return (batch.astype('float32') / 255.0)[..., np.newaxis]
+
+# Weather is cached per grid cell of this many degrees (0.1 is about 11 km)
+WEATHER_CELL_DEGREES = float(os.getenv("MOODIFY_WEATHER_CELL", "0.1"))
+
+def get_weather_cell(lat, lng):
+    """Snap coordinates to the center of their weather grid cell"""
+    size = WEATHER_CELL_DEGREES
+    return (round((math.floor(float(lat) / size) + 0.5) * size, 4),
+            round((math.floor(float(lng) / size) + 0.5) * size, 4))
+
+# Frames are decoded at 1/2, 1/4 or 1/8 size (DCT-domain downscaling for JPEG)
+# as long as they stay at least this wide, which is enough for face detection
+DETECTION_WIDTH = int(os.getenv("MOODIFY_DETECTION_WIDTH", "320"))
+REDUCED_GRAYSCALE_FLAGS = {
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+}
+
+def get_image_size(buffer):
+    """Read (width, height) from a JPEG or PNG header without decoding, None if unknown"""
+    if buffer[:8] == b'\x89PNG\r\n\x1a\n' and len(buffer) >= 24:
+        return struct.unpack('>II', buffer[16:24])
+    if buffer[:2] != b'\xff\xd8':
+        return None
+
+    # Walk JPEG segments until a start-of-frame marker
+    i = 2
+    while i + 9 <= len(buffer):
+        if buffer[i] != 0xFF:
+            return None
+        marker = buffer[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # Segments without length
+            i += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', buffer[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack('>H', buffer[i + 2:i + 4])[0]
+    return None
+
+def decode_grayscale(buffer, target_width=DETECTION_WIDTH):
+    """Decode an encoded frame straight to grayscale at reduced resolution.
+
+    The largest reduction that keeps the frame at least target_width wide is
+    picked from the header. Returns (gray, scale), where coordinates in gray
+    multiplied by scale map back to the original frame. gray is None if the
+    buffer cannot be decoded.
+    """
+    size = get_image_size(buffer)
+    scale = 1
+    if size is not None:
+        scale = next((f for f in (8, 4, 2) if size[0] // f >= target_width), 1)
+    flag = REDUCED_GRAYSCALE_FLAGS.get(scale, cv2.IMREAD_GRAYSCALE)
+    gray = cv2.imdecode(np.frombuffer(buffer, np.uint8), flag)
+    return gray, scale
+
 class MoodifyEngine:
-    def __init__(self):
-        # Load TFLite model
-        model_path = os.path.join('model', 'ferplus_model_pd_best.tflite')
-        self.interpreter = tf.lite.Interpreter(model_path=model_path)
-        self.interpreter.allocate_tensors()
-        self.input_details = self.interpreter.get_input_details()
-        self.output_details = self.interpreter.get_output_details()
+    def __init__(self, tta=None, model_contents=None, num_threads=None, model_dir=MODEL_DIR):
+        # Test-time augmentation costs one batched invoke of 10 crops per face
+        if tta is None:
+            tta = os.getenv("MOODIFY_TTA", "0") == "1"
+        self.tta = tta
+
+        # Load TFLite models, from buffers shared by serve.py workers if given
+        self.models = ModelRegistry(
+            model_dir=model_dir,
+            active=os.getenv("MOODIFY_MODEL", DEFAULT_MODEL),
+            model_contents=model_contents,
+            num_threads=num_threads,
+            warmup_batch_size=2 * len(TTA_OFFSETS) if tta else 1,
+        )
+        candidate = os.getenv("MOODIFY_CANDIDATE_MODEL")
+        if candidate:
+            self.models.set_candidate(
+                candidate,
+                traffic_percent=float(os.getenv("MOODIFY_CANDIDATE_TRAFFIC", "0")),
+                shadow_percent=float(os.getenv("MOODIFY_SHADOW_PERCENT", "0")),
+            )
         
         # Load Face Cascade
         self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
         
         self.spotify_token = self._get_spotify_token()
         
-        # Weather Cache
-        self.weather_cache = None
-        self.last_weather_update = 0
+        # Weather Cache, (weather key, update time, prefetched) per weather cell,
+        # in least recently used order. Updated from request and prefetch threads.
+        self.weather_cache = OrderedDict()
+        self.weather_lock = threading.Lock()
         self.weather_cache_duration = 600 # 10 minutes (600 seconds)
+        # Requests per cell since the prefetcher last looked, counted only while
+        # a prefetcher runs (it sets track_weather_demand), and cache counters
+        self.weather_demand = Counter()
+        self.track_weather_demand = False
+        self.weather_stats = Counter()
+        # Ambee rate limit: no calls until this time after a 429 response
+        self.weather_backoff_until = 0
+
+        # Song catalog, reloaded every MOODIFY_CATALOG_RELOAD seconds if its file changed
+        self.catalog = SongCatalog(
+            os.getenv("MOODIFY_CATALOG", SONG_CATALOG_PATH),
+            reload_interval=float(os.getenv("MOODIFY_CATALOG_RELOAD", "5")),
+        )
+        self.catalog.start()
+
+        # Spotify URLs of songs that were found
+        self.spotify_cache = OrderedDict()
+        self.spotify_lock = threading.Lock()
+        # Runs the weather and Spotify lookups of batches
+        self.batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix='batch')
 
     def _get_spotify_token(self):
         """Get Spotify access token using Client Credentials Flow"""
-        auth_url = 'https://accounts.spotify.com/api/token'
+        auth_url = f'{SPOTIFY_ACCOUNTS_URL}/api/token'
         data = {
             'grant_type': 'client_credentials',
             'client_id': SPOTIFY_CLIENT_ID,
             'client_secret': SPOTIFY_CLIENT_SECRET,
         }
-        res = requests.post(auth_url, data=data)
+        try:
+            res = requests.post(auth_url, data=data, timeout=UPSTREAM_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Spotify token error: {e}")
+            return None
         if res.status_code == 200:
             return res.json()['access_token']
         return None
 
-    def get_weather(self, lat="18.5204", lng="73.8567"): # Default to Pune
-        """Get weather from Ambee API with 10-minute caching"""
-        import time
+    def get_weather(self, lat="18.5204", lng="73.8567", count_demand=True): # Default to Pune
+        """Get weather from Ambee API with 10-minute caching per weather cell.
+        Callers that count the demand of the lookup themselves pass count_demand=False."""
         current_time = time.time()
+        cell = get_weather_cell(lat, lng)
+        with self.weather_lock:
+            cached = self.weather_cache.get(cell)
+            if cached:
+                self.weather_cache.move_to_end(cell)
+        if count_demand and self.track_weather_demand:
+            self.weather_demand[cell] += 1
         
         # If we have a fresh cache, use it
-        if self.weather_cache and (current_time - self.last_weather_update < self.weather_cache_duration):
-            return self.weather_cache
+        if cached and (current_time - cached[1] < self.weather_cache_duration):
+            self.weather_stats['hits'] += 1
+            if cached[2]:
+                self.weather_stats['prefetched_hits'] += 1
+            return cached[0]
 
-        url = f"https://api.ambeedata.com/weather/latest/by-lat-lng?lat={lat}&lng={lng}"
+        self.weather_stats['misses'] += 1
+        weather_key = self.fetch_weather(cell)
+        if weather_key:
+            return weather_key
+        
+        return cached[0] if cached else "any"
+
+    def fetch_weather(self, cell, prefetch=False):
+        """Fetch weather of a cell from Ambee and cache it. Returns None on failure
+        or while Ambee rate limits us."""
+        if time.time() < self.weather_backoff_until:
+            self.weather_stats['rate_limited'] += 1
+            return None
+
+        url = f"{AMBEE_API_URL}/weather/latest/by-lat-lng?lat={cell[0]}&lng={cell[1]}"
         headers = {'x-api-key': AMBEE_API_KEY, 'Content-type': 'application/json'}
         try:
-            response = requests.get(url, headers=headers)
+            response = requests.get(url, headers=headers, timeout=UPSTREAM_TIMEOUT)
+            if response.status_code == 429:
+                retry_after = response.headers.get('Retry-After', '')
+                self.weather_backoff_until = time.time() + (float(retry_after) if retry_after.isdigit() else 60)
+                self.weather_stats['rate_limited'] += 1
+                return None
             if response.status_code == 200:
                 data = response.json().get('data', {})
                 weather_key = infer_weather_key_from_ambee(data)
                 
                 # Update cache
-                self.weather_cache = weather_key
-                self.last_weather_update = current_time
+                with self.weather_lock:
+                    self.weather_cache[cell] = (weather_key, time.time(), prefetch)
+                    self.weather_cache.move_to_end(cell)
+                    while len(self.weather_cache) > WEATHER_CACHE_SIZE:
+                        self.weather_cache.popitem(last=False)
                 return weather_key
         except Exception as e:
             print(f"Weather API Error: {e}")
-        
-        return self.weather_cache if self.weather_cache else "any"
+        return None
 
     def detect_emotion(self, frame):
-        """Detect dominant emotion from a frame"""
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        """Detect dominant emotion from a BGR or grayscale frame"""
+        probabilities, box = self.detect_emotion_probabilities(frame)
+        if probabilities is None:
+            return None, None
+        return get_top_emotion(probabilities), box
+
+    def detect_emotion_probabilities(self, frame):
+        """Detect a face in a BGR or grayscale frame and return the probabilities
+        of all emotions (in EMOTIONS order) and the face box, or (None, None)"""
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
         
         if len(faces) == 0:
             return None, None
             
         (x, y, w, h) = faces[0]
-        roi_gray = gray[y:y+h, x:x+w]
-        roi_gray = cv2.resize(roi_gray, (48, 48))
-        roi_normalized = roi_gray.astype('float32') / 255.0
-        
-        input_data = np.expand_dims(roi_normalized, axis=(0, -1))
-        self.interpreter.set_tensor(self.input_details[0]['index'], input_data)
-        self.interpreter.invoke()
-        
-        output_data = self.interpreter.get_tensor(self.output_details[0]['index'])
-        prediction_idx = np.argmax(output_data[0])
-        return EMOTIONS[prediction_idx], (x, y, w, h)
+        return self.classify_face(gray, (x, y, w, h)), (x, y, w, h)
+
+    def classify_face(self, gray, box):
+        """Return class probabilities of the face in box (x, y, w, h)"""
+        if not self.tta:
+            x, y, w, h = box
+            roi_gray = cv2.resize(gray[y:y+h, x:x+w], (FACE_SIZE, FACE_SIZE))
+            input_data = np.expand_dims(roi_gray.astype('float32') / 255.0, axis=(0, -1))
+            return self.predict(input_data)[0]
+
+        face = self._crop_with_margin(gray, box)
+        return self.predict(get_tta_batch(face)).mean(axis=0)
+
+    def predict(self, batch):
+        """Run a single invoke on a (n, 48, 48, 1) batch and return softmax probabilities.
+        The model is picked by the registry (active model or A/B candidate)."""
+        probabilities, _ = self.models.predict(batch)
+        return probabilities
+
+    def _crop_with_margin(self, gray, box):
+        """Crop the face box enlarged by TTA_SHIFT pixels (at model resolution) on every side"""
+        x, y, w, h = box
+        size = FACE_SIZE + 2 * TTA_SHIFT
+        mx, my = int(round(w * TTA_SHIFT / FACE_SIZE)), int(round(h * TTA_SHIFT / FACE_SIZE))
+        top, bottom, left, right = y - my, y + h + my, x - mx, x + w + mx
+        roi = gray[max(top, 0):bottom, max(left, 0):right]
+        # Near the frame border, replicate edge pixels instead of clipping the
+        # margin, so that the face stays centered and the TTA shifts stay exact
+        roi = cv2.copyMakeBorder(roi,
+                                 max(-top, 0), max(bottom - gray.shape[0], 0),
+                                 max(-left, 0), max(right - gray.shape[1], 0),
+                                 cv2.BORDER_REPLICATE)
+        return cv2.resize(roi, (size, size))
 
     def search_spotify(self, song_name):
         """Find the Spotify URL for a song"""
-        url = f"https://api.spotify.com/v1/search?q={song_name}&type=track&limit=1"
+        with self.spotify_lock:
+            url = self.spotify_cache.get(song_name)
+            if url is not None:
+                self.spotify_cache.move_to_end(song_name)
+                return url
+
+        url = f"{SPOTIFY_API_URL}/v1/search?q={song_name}&type=track&limit=1"
         headers = {"Authorization": f"Bearer {self.spotify_token}"}
-        res = requests.get(url, headers=headers)
-        if res.status_code == 200:
+        try:
+            res = requests.get(url, headers=headers, timeout=UPSTREAM_TIMEOUT)
+        except requests.RequestException as e:
+            print(f"Spotify API Error: {e}")
+            res = None
+        if res is not None and res.status_code == 200:
             items = res.json().get('tracks', {}).get('items', [])
             if items:
-                return items[0]['external_urls']['spotify']
+                url = items[0]['external_urls']['spotify']
+                with self.spotify_lock:
+                    self.spotify_cache[song_name] = url
+                    if len(self.spotify_cache) > SPOTIFY_CACHE_SIZE:
+                        self.spotify_cache.popitem(last=False)
+                return url
         return f"https://open.spotify.com/search/{song_name}"
 
+    def recommend_batch(self, items):
+        """Recommend songs for many (emotion, lat, lng) tuples at once.
+
+        Weather is fetched once per weather cell and every distinct song is
+        looked up on Spotify once, BATCH_CONCURRENCY lookups at a time. Callers
+        should bound the number of distinct cells, every uncached one costs an
+        Ambee call. Returns (weather, song, spotify_url, details) per item.
+        """
+        cells = [get_weather_cell(lat, lng) for _, lat, lng in items]
+        distinct_cells = list(set(cells))
+        weather_by_cell = dict(zip(distinct_cells, self.batch_executor.map(
+            lambda cell: self.get_weather(*cell, count_demand=False), distinct_cells)))
+        # Every item is a request for the weather of its cell
+        if self.track_weather_demand:
+            self.weather_demand.update(cells)
+
+        picks = [self.get_recommendation(emotion, weather_by_cell[cell])
+                 for (emotion, _, _), cell in zip(items, cells)]
+        songs = list(set(song for song, _ in picks))
+        urls = dict(zip(songs, self.batch_executor.map(self.search_spotify, songs)))
+
+        return [(weather_by_cell[cell], song, urls[song], details)
+                for cell, (song, details) in zip(cells, picks)]
+
     def get_recommendation(self, emotion, weather):
-        """Pick a song from the dictionary based on mood and weather"""
-        emotion_dict = SONG_DICTIONARY.get(emotion, SONG_DICTIONARY['neutral'])
-        rec = emotion_dict.get(weather, emotion_dict['any'])
-        import random
-        song = random.choice(rec['tracks'])
-        return song, rec
+        """Pick a song from the catalog based on mood and weather.
+        Returns the song and the genre, acoustic strategy and mechanism of its entry."""
+        index = self.catalog.index
+        bucket = index.get_bucket(emotion, weather)
+        return index.pick_track(bucket), index.get_details(bucket)
+
+    def get_blended_recommendation(self, probabilities, weather, n=1, power=None):
+        """Pick n songs from a mixture of the catalog entries of all emotions for
+        the weather, each weighted by the emotion's probability ** power.
+        Returns (emotion, song, details) per pick, emotion being the mixture
+        component the song was drawn from."""
+        power = BLEND_POWER if power is None else power
+        weights = np.asarray(probabilities, dtype='float64') ** power
+        index = self.catalog.index
+        buckets = [index.get_bucket(emotion, weather) for emotion in EMOTIONS]
+        components, songs = index.sample_tracks(buckets, weights, n)
+        return [(EMOTIONS[c], song, index.get_details(buckets[c])) for c, song in zip(components, songs)]
 
 if __name__ == "__main__":
     # Test Run
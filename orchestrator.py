@@ -0,0 +1,346 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+
+# Hyperparameters of the training notebook, every experiment can override them
+DEFAULT_EXPERIMENT = {
+    'name': 'ferplus_model_pd',
+    'model': 'performance',
+    'dataset': 'FERPLUS',
+    'cross_entropy': True,
+    'original_preprocessing': True,
+    'sparse_labels': False,
+    'augmentation': 'HIGH',
+    'batch_size': 128,
+    'epochs': 1000,
+    'dropout_rate': 0.10,
+    'learning_rate': 0.005,
+    'leaky_relu_slope': 0.02,
+    'lr_patience': 20,
+    'patience': 30,
+    'regularization_rate': 0.01
+}
+
+SPLITS = ['train', 'valid', 'test']
+
+
+def get_pipeline_params(experiment, seed = 123, test = False):
+    '''Creates DataPipelineParams of the experiment.
+
+    Args:
+        experiment(dict): experiment configuration
+        seed(int)
+        test(boolean): whether to create parameters of validation/test
+                       pipelines (majority labels like in the notebook)
+    '''
+    from data.data import has_sparse_labels
+    from data.model_class.DataPipelineParams import (Augmentation, Dataset,
+                                                     DataPipelineParams)
+
+    params = DataPipelineParams(
+        dataset = Dataset[experiment['dataset']],
+        cross_entropy = experiment['cross_entropy'],
+        original_preprocessing = experiment['original_preprocessing'],
+        batch_size = experiment['batch_size'],
+        augmentation = Augmentation[experiment['augmentation']],
+        seed = seed,
+        sparse_labels = experiment['sparse_labels']
+    )
+    if test:
+        # Majority labels in the same format as the training labels
+        params.sparse_labels = has_sparse_labels(params)
+        params.cross_entropy = False
+    return params
+
+def prepare_shared_dataset(dataset_dir, experiments, cache_dir):
+    '''Loads dataset.csv once, applies preprocessing of every distinct data
+    configuration and saves decoded uint8 images and labels as .npy files.
+    Workers memory-map them instead of parsing the csv again.
+
+    Args:
+        dataset_dir(string): a path to a directory with dataset files
+        experiments(list(dict)): experiment configurations
+        cache_dir(string): directory for the .npy files
+
+    Returns: a dict mapping data configuration key to paths of its files.
+    '''
+    from data import data
+    from data.dataset import get_dataset_dict
+
+    os.makedirs(cache_dir, exist_ok = True)
+    dataset_dict = None
+    shared_files = {}
+    for experiment in experiments:
+        key = _get_data_key(experiment)
+        if key in shared_files:
+            continue
+
+        files = {}
+        for split in SPLITS:
+            params = get_pipeline_params(experiment, test = split != 'train')
+            images_path = os.path.join(cache_dir, '{}_{}_images.npy'.format(key, split))
+            labels_path = os.path.join(cache_dir, '{}_{}_labels.npy'.format(key, split))
+            if not (os.path.isfile(images_path) and os.path.isfile(labels_path)):
+                if dataset_dict is None:
+                    dataset_dict = get_dataset_dict(dataset_dir)
+                images, labels = data._get_images_labels(dataset_dict[split],
+                                                         params.dataset,
+                                                         params.cross_entropy,
+                                                         params.original_preprocessing,
+                                                         params.sparse_labels)
+                np.save(images_path, images.astype(np.uint8))
+                np.save(labels_path, np.asarray(labels))
+            files[split] = (images_path, labels_path)
+        shared_files[key] = files
+
+    return shared_files
+
+def run_experiments(experiments,
+                    seeds,
+                    dataset_dir,
+                    output_dir,
+                    n_workers = None,
+                    cache_dir = None):
+    '''Trains every experiment with every seed in parallel worker processes.
+    Available CPUs are split evenly between workers and each worker pins
+    itself to its CPUs and limits TensorFlow threads to their number.
+
+    Args:
+        experiments(list(dict)): experiment configurations, missing keys are
+                                 taken from DEFAULT_EXPERIMENT
+        seeds(list(int)): seeds of the runs of every experiment
+        dataset_dir(string): a path to a directory with dataset files
+        output_dir(string): directory for histories, models and the summary
+        n_workers(int): number of parallel workers (number of runs by default,
+                        at most the number of CPUs)
+        cache_dir(string): directory for the shared dataset files
+
+    Returns: a dict with the summary of every experiment.
+    '''
+    experiments = [dict(DEFAULT_EXPERIMENT, **e) for e in experiments]
+    os.makedirs(output_dir, exist_ok = True)
+    cache_dir = cache_dir or os.path.join(output_dir, 'shared_dataset')
+    shared_files = prepare_shared_dataset(dataset_dir, experiments, cache_dir)
+
+    runs = [(experiment, seed) for experiment in experiments for seed in seeds]
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+           else list(range(os.cpu_count()))
+    n_workers = min(n_workers or len(runs), len(runs), len(cpus))
+    cpu_sets = [cpus[i::n_workers] for i in range(n_workers)]
+
+    context = multiprocessing.get_context('spawn')
+    cpu_queue = context.Queue()
+    for cpu_set in cpu_sets:
+        cpu_queue.put(cpu_set)
+
+    results = []
+    with ProcessPoolExecutor(max_workers = n_workers,
+                             mp_context = context,
+                             initializer = _init_worker,
+                             initargs = (cpu_queue,)) as executor:
+        futures = [executor.submit(_run_single,
+                                   experiment,
+                                   seed,
+                                   shared_files[_get_data_key(experiment)],
+                                   output_dir)
+                   for experiment, seed in runs]
+        for future in as_completed(futures):
+            result = future.result()
+            print('Finished {} (seed {}): test accuracy {:.4f}'.format(
+                result['name'], result['seed'], result['test_accuracy']))
+            results.append(result)
+
+    summary = summarize_results(results)
+    with open(os.path.join(output_dir, 'summary.json'), 'w') as file:
+        json.dump({'runs': results, 'summary': summary}, file, indent = 2)
+    print(format_summary_table(summary))
+    return summary
+
+def summarize_results(results):
+    '''Aggregates results of runs into mean and standard deviation per
+    experiment, like the tables in README.
+
+    Args:
+        results(list(dict)): results of single runs
+
+    Returns: a dict mapping experiment name to its summary.
+    '''
+    summary = {}
+    for name in sorted(set(r['name'] for r in results)):
+        runs = [r for r in results if r['name'] == name]
+        accuracy = np.array([r['test_accuracy'] for r in runs])
+        loss = np.array([r['test_loss'] for r in runs])
+        best = runs[int(accuracy.argmax())]
+        summary[name] = {'runs': len(runs),
+                         'dropout_rate': runs[0]['dropout_rate'],
+                         'accuracy_mean': float(accuracy.mean()),
+                         'accuracy_std': float(accuracy.std()),
+                         'loss_mean': float(loss.mean()),
+                         'loss_std': float(loss.std()),
+                         'best_accuracy': best['test_accuracy'],
+                         'best_loss': best['test_loss'],
+                         'best_seed': best['seed']}
+    return summary
+
+def summarize_histories(history_paths):
+    '''Aggregates training histories (like model/fer_model_best.json) of
+    several runs, using the best validation accuracy and loss of every run.
+
+    Args:
+        history_paths(list(string)): paths to history .json files
+
+    Returns: a dict with mean and standard deviation of best validation
+             accuracy and loss.
+    '''
+    accuracy, loss = [], []
+    for path in history_paths:
+        with open(path, 'r') as file:
+            history = json.load(file)
+        accuracy.append(max(history['val_accuracy']))
+        loss.append(min(history['val_loss']))
+    accuracy, loss = np.array(accuracy), np.array(loss)
+    return {'runs': len(history_paths),
+            'val_accuracy_mean': float(accuracy.mean()),
+            'val_accuracy_std': float(accuracy.std()),
+            'val_loss_mean': float(loss.mean()),
+            'val_loss_std': float(loss.std())}
+
+def format_summary_table(summary):
+    '''Formats the summary as a markdown table in the format used in README'''
+    lines = ['| Experiment | Spatial dropout rate | Accuracy | Loss | Best result (acc \\| loss) |',
+             '| :--------- | :------------------- | :------: | :--: | :-----------------------: |']
+    for name, s in summary.items():
+        lines.append('| {} | {:.2f} | {:.4f} ± {:.4f} | {:.4f} ± {:.4f} | '
+                     '{:.4f} \\| {:.4f} |'.format(name,
+                                                 s['dropout_rate'],
+                                                 s['accuracy_mean'],
+                                                 s['accuracy_std'],
+                                                 s['loss_mean'],
+                                                 s['loss_std'],
+                                                 s['best_accuracy'],
+                                                 s['best_loss']))
+    return '\n'.join(lines)
+
+def _get_data_key(experiment):
+    '''Returns a name of the data configuration of the experiment'''
+    return '{}_{}_{}_{}'.format(experiment['dataset'].lower(),
+                                'pd' if experiment['cross_entropy'] else 'mv',
+                                'orig' if experiment['original_preprocessing'] else 'custom',
+                                'sparse' if experiment['sparse_labels'] else 'dense')
+
+def _init_worker(cpu_queue):
+    '''Pins the worker process to its CPUs and limits TensorFlow threads'''
+    cpu_set = cpu_queue.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_set)
+
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cpu_set))
+    tf.config.threading.set_inter_op_parallelism_threads(max(1, len(cpu_set) // 2))
+
+def _load_shared(files, split):
+    '''Memory-maps images and labels of the split'''
+    images_path, labels_path = files[split]
+    return np.load(images_path, mmap_mode = 'r'), np.load(labels_path, mmap_mode = 'r')
+
+def _run_single(experiment, seed, files, output_dir):
+    '''Trains a single run in a worker process and evaluates it on the test
+    split. Saves history in the same format as model/*_best.json.'''
+    import tensorflow as tf
+    from tensorflow import keras
+    from data import tf_data
+    import models
+    import training
+
+    tf.keras.utils.set_random_seed(seed)
+    run_name = '{}_seed{}'.format(experiment['name'], seed)
+    params = get_pipeline_params(experiment, seed)
+    test_params = get_pipeline_params(experiment, seed, test = True)
+
+    train_images, train_labels = _load_shared(files, 'train')
+    training_pipeline, steps_per_epoch = tf_data.get_tf_data_pipeline_from_arrays(
+        train_images, train_labels, params, shuffle = True
+    )
+    validation_pipeline, _ = tf_data.get_tf_data_pipeline_from_arrays(
+        *_load_shared(files, 'valid'), test_params
+    )
+    test_pipeline, _ = tf_data.get_tf_data_pipeline_from_arrays(
+        *_load_shared(files, 'test'), test_params
+    )
+
+    build_model = {'base': models.get_base_model,
+                   'performance': models.get_performance_model,
+                   'micro': models.get_micro_model}[experiment['model']]
+    model = build_model(leaky_relu_slope = experiment['leaky_relu_slope'],
+                        dropout_rate = experiment['dropout_rate'],
+                        regularization_rate = experiment['regularization_rate'],
+                        logits = True)
+    training.compile_model(model, params, experiment['learning_rate'])
+
+    model_path = os.path.join(output_dir, run_name + '_acc.h5')
+    callbacks = [
+        keras.callbacks.EarlyStopping(monitor = 'val_loss',
+                                      patience = experiment['patience'],
+                                      min_delta = 0.001),
+        keras.callbacks.ReduceLROnPlateau(monitor = 'val_loss',
+                                          factor = 0.5,
+                                          patience = experiment['lr_patience'],
+                                          min_delta = 0.001),
+        keras.callbacks.ModelCheckpoint(model_path,
+                                        monitor = 'val_accuracy',
+                                        save_best_only = True)
+    ]
+    history = model.fit(training_pipeline,
+                        validation_data = validation_pipeline,
+                        epochs = experiment['epochs'],
+                        steps_per_epoch = steps_per_epoch,
+                        callbacks = callbacks,
+                        verbose = 2)
+
+    history_dict = {key: [float(value) for value in values]
+                    for key, values in history.history.items()}
+    with open(os.path.join(output_dir, run_name + '.json'), 'w') as file:
+        json.dump(history_dict, file)
+
+    model.load_weights(model_path)
+    test_loss, test_accuracy = model.evaluate(test_pipeline, verbose = 0)
+    return {'name': experiment['name'],
+            'seed': seed,
+            'dropout_rate': experiment['dropout_rate'],
+            'epochs_trained': len(history_dict['loss']),
+            'best_val_accuracy': max(history_dict['val_accuracy']),
+            'test_accuracy': float(test_accuracy),
+            'test_loss': float(test_loss),
+            'model': model_path}
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Train experiments with '
+                                                   'several seeds in parallel')
+    parser.add_argument('config',
+                        help = 'JSON file with a list of experiments (keys of '
+                               'DEFAULT_EXPERIMENT to override)')
+    parser.add_argument('--seeds', nargs = '+', type = int,
+                        default = [1, 2, 3, 4, 5])
+    parser.add_argument('--workers', type = int)
+    parser.add_argument('--dataset-dir', default = 'dataset')
+    parser.add_argument('--output-dir', default = 'runs')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        experiments = json.load(file)
+    if isinstance(experiments, dict):
+        experiments = [experiments]
+
+    run_experiments(experiments,
+                    args.seeds,
+                    args.dataset_dir,
+                    args.output_dir,
+                    args.workers)
+
+if __name__ == "__main__":
+    main()
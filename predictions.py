@@ -1,8 +1,19 @@
+import json
+import math
+import os
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 import seaborn as sns
 
+
+# Size of a contact sheet tile in pixels: image, probability bars and gap
+TILE_SIZE = 48
+TILE_GAP = 4
+
 def display_majority_predictions(images,
                                  labels,
                                  class_mapping,
@@ -12,14 +23,15 @@ def display_majority_predictions(images,
 
     Args:
         images(ndarray): a batch of (48, 48, 1) images
-        labels(ndarray): a batch of basis vector labels
+        labels(ndarray): a batch of basis vector labels or integer labels
         class_mapping(dict(int, string)): a mapping of class labels to class names
         label_ps(ndarray) : a batch of predicted basis vector labels
 
     Returns: None
     '''
     # Convert labels to integers
-    labels = labels.argmax(axis = 1)
+    if labels.ndim > 1:
+        labels = labels.argmax(axis = 1)
 
     plt.figure(figsize = (12, 8))
     for i in range(24):
@@ -53,7 +65,7 @@ def display_cross_entropy_predictions(images,
 
     Returns: None
     '''
-    class_names = class_mapping.values()
+    class_names = list(class_mapping.values())
 
     plt.figure(figsize = (10.75, 13))
     for i in range(0, 24, 2):
@@ -70,9 +82,9 @@ def display_cross_entropy_predictions(images,
 
         # Draw per two bars if predictions are given
         if label_ps is not None:
-            label = pd.DataFrame({ 'true': label, 'predicted': label_ps[i] },
-                                 index = class_names)
-            label.plot.barh(ax = ax2)
+            ax2.barh(y_ticks - 0.2, label, height = 0.4, label = 'true')
+            ax2.barh(y_ticks + 0.2, label_ps[index], height = 0.4,
+                     label = 'predicted')
             ax2.legend(prop = {'size':8}, loc = 'lower right')
         else:
             ax2.barh(y_ticks, label)
@@ -86,35 +98,262 @@ def display_cross_entropy_predictions(images,
     plt.tight_layout()
     plt.show()
 
-def plot_training_history(history):
+def render_contact_sheet(images,
+                         labels,
+                         class_mapping,
+                         label_ps = None,
+                         columns = 16,
+                         scale = 2,
+                         title = None,
+                         value_range = (0., 1.)):
+    '''Renders a contact sheet of any number of images without a display.
+    Images are composited into a single array drawn with one imshow call and
+    probability bars of all images are drawn as one collection of patches,
+    so rendering hundreds of images costs about as much as rendering one.
+
+    Every tile shows the image and, to its right, one bar per class (top to
+    bottom in class_mapping order): the true distribution in gray and the
+    predicted one in green (correct majority prediction) or red (wrong).
+
+    Args:
+        images(ndarray): a batch of (48, 48, 1) images
+        labels(ndarray): a batch of basis vector labels, label distributions
+                         or integer labels
+        class_mapping(dict(int, string)): a mapping of class labels to class names
+        label_ps(ndarray): a batch of predicted label distributions
+        columns(int): number of tiles per row
+        scale(int): output pixels per image pixel
+        title(string): optional text written above the sheet
+        value_range(tuple): color range (black, white) of the images,
+                            data.PIPELINE_VALUE_RANGE for pipeline batches or
+                            data.RAW_VALUE_RANGE for decoded dataset images
+
+    Returns: matplotlib Figure attached to an Agg canvas, None if there are
+             no images.
+    '''
+    if len(images) == 0:
+        return None
+    n_classes = len(class_mapping)
+    black, white = value_range
+    images = np.asarray(images, dtype = np.float32)
+    images = images.reshape(len(images), TILE_SIZE, TILE_SIZE)
+    images = np.clip((images - black) / (white - black), 0., 1.)
+    labels = np.asarray(labels)
+    if labels.ndim == 1:
+        labels = np.eye(n_classes, dtype = np.float32)[labels.astype(int)]
+
+    n = len(images)
+    columns = max(1, min(columns, n))
+    n_rows = math.ceil(n / columns)
+    tile_w = 2 * TILE_SIZE + TILE_GAP
+    tile_h = TILE_SIZE + TILE_GAP
+
+    # Composite all images into one array, the bar area stays white
+    tiles = np.ones((n_rows * columns, tile_h, tile_w), dtype = np.float32)
+    tiles[:n, :TILE_SIZE, :TILE_SIZE] = images
+    sheet = tiles.reshape(n_rows, columns, tile_h, tile_w)\
+                 .transpose(0, 2, 1, 3)\
+                 .reshape(n_rows * tile_h, columns * tile_w)
+
+    header_px = 14 if title is not None else 0
+    width_px = sheet.shape[1] * scale
+    height_px = (sheet.shape[0] + header_px) * scale
+    figure = Figure(figsize = (width_px / 100., height_px / 100.), dpi = 100)
+    FigureCanvasAgg(figure)
+    ax = figure.add_axes([0, 0, 1, 1 - header_px * scale / height_px])
+    ax.imshow(sheet, cmap = 'gray', vmin = 0., vmax = 1.,
+              interpolation = 'nearest',
+              extent = (0, sheet.shape[1], sheet.shape[0], 0))
+    ax.set_axis_off()
+    if title is not None:
+        figure.text(0.005, 1 - 0.5 * header_px * scale / height_px, title,
+                    va = 'center', fontsize = 8)
+
+    # Top-left corner of the bar area of every tile
+    x0 = (np.arange(n) % columns) * tile_w + TILE_SIZE + 1
+    y0 = (np.arange(n) // columns) * tile_h
+    bar_h = TILE_SIZE / n_classes
+    bar_w = TILE_SIZE - 2
+
+    rectangles = [_get_bar_rectangles(x0, y0, labels, bar_h, bar_w, 0., 1.)]
+    colors = [np.full(n * n_classes, 'lightgray', dtype = object)]
+    if label_ps is not None:
+        label_ps = np.asarray(label_ps)
+        correct = label_ps.argmax(axis = 1) == labels.argmax(axis = 1)
+        rectangles.append(_get_bar_rectangles(x0, y0, label_ps, bar_h, bar_w,
+                                              0.25, 0.75))
+        colors.append(np.repeat(np.where(correct, 'green', 'red'), n_classes))
+
+        # Frame around misclassified images
+        frames = _get_rectangles(x0 - TILE_SIZE - 1, y0, TILE_SIZE, TILE_SIZE)
+        ax.add_collection(PolyCollection(frames[~correct],
+                                         facecolors = 'none',
+                                         edgecolors = 'red',
+                                         linewidths = 0.5 * scale))
+
+    ax.add_collection(PolyCollection(np.concatenate(rectangles),
+                                     facecolors = np.concatenate(colors),
+                                     linewidths = 0))
+    return figure
+
+def save_contact_sheet(images,
+                       labels,
+                       class_mapping,
+                       file_path,
+                       label_ps = None,
+                       columns = 16,
+                       scale = 2,
+                       value_range = (0., 1.)):
+    '''Renders a contact sheet (see render_contact_sheet) and writes it to a
+    PNG file. Works on servers without a display. Nothing is written if there
+    are no images.
+
+    Args:
+        images(ndarray): a batch of (48, 48, 1) images
+        labels(ndarray): a batch of labels
+        class_mapping(dict(int, string)): a mapping of class labels to class names
+        file_path(string): path of the PNG file
+        label_ps(ndarray): a batch of predicted label distributions
+        columns(int): number of tiles per row
+        scale(int): output pixels per image pixel
+        value_range(tuple): color range of the images, see render_contact_sheet
+
+    Returns: None
+    '''
+    title = 'Bars top to bottom: ' + ', '.join(class_mapping.values())
+    figure = render_contact_sheet(images,
+                                  labels,
+                                  class_mapping,
+                                  label_ps,
+                                  columns,
+                                  scale,
+                                  title,
+                                  value_range)
+    if figure is not None:
+        figure.savefig(file_path, format = 'png')
+
+def save_error_contact_sheets(images,
+                              labels,
+                              label_ps,
+                              class_mapping,
+                              output_dir,
+                              images_per_sheet = 256,
+                              columns = 16,
+                              value_range = (0., 1.)):
+    '''Writes contact sheets of misclassified images only, sorted by the
+    confidence of the wrong prediction (most confident errors first).
+
+    Args:
+        images(ndarray): a batch of (48, 48, 1) images
+        labels(ndarray): a batch of labels
+        label_ps(ndarray): a batch of predicted label distributions
+        class_mapping(dict(int, string)): a mapping of class labels to class names
+        output_dir(string): directory for the PNG files
+        images_per_sheet(int)
+        columns(int): number of tiles per row
+        value_range(tuple): color range of the images, see render_contact_sheet
+
+    Returns: list of paths of written files.
+    '''
+    labels = np.asarray(labels)
+    label_ps = np.asarray(label_ps)
+    true_labels = labels.argmax(axis = 1) if labels.ndim > 1 else labels
+    errors = np.flatnonzero(label_ps.argmax(axis = 1) != true_labels)
+    errors = errors[np.argsort(-label_ps[errors].max(axis = 1))]
+
+    os.makedirs(output_dir, exist_ok = True)
+    paths = []
+    for start in range(0, len(errors), images_per_sheet):
+        indexes = errors[start:start + images_per_sheet]
+        path = os.path.join(output_dir, 'errors_{:03d}.png'.format(len(paths)))
+        save_contact_sheet(images[indexes],
+                           labels[indexes],
+                           class_mapping,
+                           path,
+                           label_ps[indexes],
+                           columns,
+                           value_range = value_range)
+        paths.append(path)
+    return paths
+
+def plot_training_history(history, refresh_interval = None):
     '''Plots training accuracy and loss.
 
     Args:
-        history(Object): history object resulting from training
+        history(Object): history object resulting from training or a path to
+                         a .jsonl history log written during training
+        refresh_interval(float): if given together with a log path, the plot is
+                                 redrawn every refresh_interval seconds with
+                                 new epochs until the figure is closed
 
     Returns: None
     '''
-    training_accuracy = history['accuracy']
-    validation_accuracy = history['val_accuracy']
-
-    training_loss = history['loss']
-    validation_loss = history['val_loss']
-
-    epochs_range = range(len(training_accuracy))
-
-    plt.figure(figsize = (8, 8))
-    plt.subplot(1, 2, 1)
-    plt.plot(epochs_range, training_accuracy, label = 'Training Accuracy')
-    plt.plot(epochs_range, validation_accuracy, label = 'Validation Accuracy')
-    plt.legend(loc = 'lower right')
-    plt.title('Training and Validation Accuracy')
-
-    plt.subplot(1, 2, 2)
-    plt.plot(epochs_range, training_loss, label = 'Training Loss')
-    plt.plot(epochs_range, validation_loss, label = 'Validation Loss')
-    plt.legend(loc = 'upper right')
-    plt.title('Training and Validation Loss')
-    plt.show()
+    if not isinstance(history, str):
+        _draw_training_history(plt.figure(figsize = (8, 8)), history)
+        plt.show()
+        return
+
+    figure = plt.figure(figsize = (8, 8))
+    _draw_training_history(figure, read_history_log(history))
+    if refresh_interval is None:
+        plt.show()
+        return
+
+    # Follow the log while training is running
+    while plt.fignum_exists(figure.number):
+        plt.pause(refresh_interval)
+        figure.clear()
+        _draw_training_history(figure, read_history_log(history))
+
+def read_history_log(log_path):
+    '''Reads a .jsonl history log (one JSON record per epoch) into a history
+    dict of lists. If training was resumed, records of repeated epochs
+    override the earlier ones. A partially written last line is skipped.
+
+    Args:
+        log_path(string): path to the log
+
+    Returns: dict mapping metric names to lists of values.
+    '''
+    records = {}
+    with open(log_path, 'r') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['epoch']] = record
+
+    history = {}
+    for epoch in sorted(records):
+        for key, value in records[epoch].items():
+            if key != 'epoch':
+                history.setdefault(key, []).append(value)
+    return history
+
+def _draw_training_history(figure, history):
+    '''Draws training accuracy and loss on the figure'''
+    training_accuracy = history.get('accuracy', [])
+    validation_accuracy = history.get('val_accuracy', [])
+
+    training_loss = history.get('loss', [])
+    validation_loss = history.get('val_loss', [])
+
+    # Validation metrics of a running epoch might not be logged yet
+    ax = figure.add_subplot(1, 2, 1)
+    ax.plot(range(len(training_accuracy)), training_accuracy,
+            label = 'Training Accuracy')
+    ax.plot(range(len(validation_accuracy)), validation_accuracy,
+            label = 'Validation Accuracy')
+    ax.legend(loc = 'lower right')
+    ax.set_title('Training and Validation Accuracy')
+
+    ax = figure.add_subplot(1, 2, 2)
+    ax.plot(range(len(training_loss)), training_loss, label = 'Training Loss')
+    ax.plot(range(len(validation_loss)), validation_loss,
+            label = 'Validation Loss')
+    ax.legend(loc = 'upper right')
+    ax.set_title('Training and Validation Loss')
 
 def plot_confusion_matrix(confusion_matrix, class_names):
     '''Plots confusion matrix.
@@ -143,3 +382,23 @@ def plot_confusion_matrix(confusion_matrix, class_names):
     ax.set(ylabel = "True Label", xlabel = "Predicted Label")
 
     plt.show()
+
+def _get_rectangles(x, y, width, height):
+    '''Returns (n, 4, 2) vertices of rectangles with top-left corners (x, y)'''
+    x = np.asarray(x, dtype = np.float32)
+    y = np.asarray(y, dtype = np.float32)
+    width = np.broadcast_to(width, x.shape)
+    height = np.broadcast_to(height, x.shape)
+    return np.stack([np.stack([x, y], axis = -1),
+                     np.stack([x + width, y], axis = -1),
+                     np.stack([x + width, y + height], axis = -1),
+                     np.stack([x, y + height], axis = -1)], axis = 1)
+
+def _get_bar_rectangles(x0, y0, distributions, bar_h, bar_w, top, bottom):
+    '''Returns vertices of horizontal probability bars of all tiles. Bar k of
+    a tile spans fractions [top, bottom] of the k-th row of the bar area.'''
+    n, n_classes = distributions.shape
+    x = np.repeat(x0, n_classes)
+    y = (y0[:, np.newaxis] + (np.arange(n_classes) + top) * bar_h).ravel()
+    width = np.clip(distributions, 0., 1.).ravel() * bar_w
+    return _get_rectangles(x, y, width, (bottom - top) * bar_h)
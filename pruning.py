@@ -0,0 +1,221 @@
+from data import tf_data
+from data.data import get_image_data, get_labels, has_sparse_labels
+import copy
+import json
+import math
+import os
+
+import numpy as np
+from tensorflow import keras
+from tensorflow.keras import layers
+
+import tflite_utils
+import training
+
+
+# Fraction of channels removed from every prunable convolution
+PRUNING_LEVELS = [0.0, 0.25, 0.5, 0.75]
+
+
+def get_channel_importance(conv, bn):
+    '''Scores output channels of a convolution followed by batch
+    normalization. A channel matters as much as the scale BN gives it times
+    the L1 norm of its (pointwise) filter.
+
+    Args:
+        conv(layers.SeparableConv2D or layers.Conv2D)
+        bn(layers.BatchNormalization)
+
+    Returns: ndarray of scores, one per output channel.
+    '''
+    kernel = (conv.pointwise_kernel if isinstance(conv, layers.SeparableConv2D)
+              else conv.kernel).numpy()
+    filter_norm = np.abs(kernel).reshape(-1, kernel.shape[-1]).sum(axis = 0)
+    bn_scale = np.abs(bn.gamma.numpy()) / np.sqrt(bn.moving_variance.numpy()
+                                                  + bn.epsilon)
+    return bn_scale * filter_norm
+
+def prune_channels(model, pruning_level):
+    '''Builds a smaller model with the least important output channels
+    removed from every convolution followed by batch normalization. Channels
+    are physically removed (with the matching inputs of the next layer), so
+    the model has fewer parameters and FLOPs, not just zero weights.
+
+    Args:
+        model(keras.Model): trained model built with models.py (a chain of
+                            layers, Sequential or functional)
+        pruning_level(float): fraction of channels to remove, in [0, 1)
+
+    Returns: keras.Model with weights copied from the kept channels.
+    '''
+    model_layers = [l for l in model.layers
+                    if not isinstance(l, layers.InputLayer)]
+
+    inputs = keras.Input(shape = model.input_shape[1:])
+    x = inputs
+    keep_in = np.arange(model.input_shape[-1])
+    for i, layer in enumerate(model_layers):
+        next_layer = model_layers[i + 1] if i + 1 < len(model_layers) else None
+        config = layer.get_config()
+        weights = layer.get_weights()
+
+        if isinstance(layer, (layers.SeparableConv2D, layers.Conv2D)):
+            n_filters = config['filters']
+            keep_out = np.arange(n_filters)
+            # The classifier (no batch normalization after it) is not pruned
+            if isinstance(next_layer, layers.BatchNormalization):
+                n_keep = max(1, int(math.ceil(n_filters * (1. - pruning_level))))
+                scores = get_channel_importance(layer, next_layer)
+                keep_out = np.sort(np.argsort(scores)[::-1][:n_keep])
+            config['filters'] = len(keep_out)
+            weights = _slice_conv_weights(layer, weights, keep_in, keep_out)
+            keep_in = keep_out
+        elif isinstance(layer, layers.BatchNormalization):
+            weights = [w[keep_in] for w in weights]
+
+        new_layer = layer.__class__.from_config(config)
+        x = new_layer(x)
+        new_layer.set_weights(weights)
+
+    return keras.Model(inputs, x, name = '{}_pruned_{:02d}'.format(
+        model.name, int(pruning_level * 100)))
+
+def count_flops(model):
+    '''Counts floating point operations (2 per multiply-accumulate) of
+    convolutional and dense layers for a single image'''
+    macs = 0
+    for layer in model.layers:
+        if isinstance(layer, (layers.SeparableConv2D, layers.Conv2D,
+                              layers.Dense)):
+            output_shape = layer.output_shape
+            output_pixels = int(np.prod(output_shape[1:-1])) if len(output_shape) > 2 else 1
+            n_in = layer.input_shape[-1]
+            n_out = output_shape[-1]
+            if isinstance(layer, layers.SeparableConv2D):
+                kernel_area = int(np.prod(layer.kernel_size))
+                macs += output_pixels * n_in * (kernel_area + n_out)
+            elif isinstance(layer, layers.Conv2D):
+                kernel_area = int(np.prod(layer.kernel_size))
+                macs += output_pixels * kernel_area * n_in * n_out
+            else:
+                macs += n_in * n_out
+    return 2 * macs
+
+def prune_and_fine_tune(model_path,
+                        dataset_dict,
+                        pipeline_params,
+                        pruning_levels = PRUNING_LEVELS,
+                        epochs = 20,
+                        learning_rate = 0.001,
+                        output_dir = 'model'):
+    '''Prunes the trained model at several levels, fine-tunes every pruned
+    model, exports it to tflite and reports accuracy against FLOPs and
+    measured CPU latency.
+
+    Args:
+        model_path(string): path to trained .h5 model (logits output), e.g.
+                            model/ferplus_model_pd_best.h5
+        dataset_dict(dict): datasets created using dataset.get_dataset_dict()
+        pipeline_params(DataPipelineParams): parameters of the training pipeline
+        pruning_levels(list): fractions of channels to remove
+        epochs(int): number of fine-tuning epochs
+        learning_rate(float): fine-tuning learning rate
+        output_dir(string): directory for tflite files and the report
+
+    Returns: a dict with the report (also saved as JSON).
+    '''
+    os.makedirs(output_dir, exist_ok = True)
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    model = keras.models.load_model(model_path, compile = False)
+
+    # Test on majority labels, like in the training notebook
+    test_params = copy.copy(pipeline_params)
+    test_params.cross_entropy = False
+    test_params.sparse_labels = True
+    test_images = get_image_data(dataset_dict['test'], test_params)
+    test_labels = get_labels(dataset_dict['test'], test_params)
+
+    training_pipeline, steps_per_epoch = tf_data.get_tf_data_pipeline(
+        dataset_dict['train'],
+        pipeline_params,
+        shuffle = True
+    )
+    # Validate on majority labels in the same format as the training labels
+    valid_params = copy.copy(test_params)
+    valid_params.sparse_labels = has_sparse_labels(pipeline_params)
+    validation_pipeline, _ = tf_data.get_tf_data_pipeline(dataset_dict['valid'],
+                                                          valid_params)
+
+    results = []
+    for pruning_level in pruning_levels:
+        pruned_model = prune_channels(model, pruning_level)
+        if pruning_level > 0 and epochs > 0:
+            training.compile_model(pruned_model, pipeline_params, learning_rate)
+            pruned_model.fit(training_pipeline,
+                             validation_data = validation_pipeline,
+                             epochs = epochs,
+                             steps_per_epoch = steps_per_epoch,
+                             callbacks = [keras.callbacks.EarlyStopping(
+                                 monitor = 'val_loss',
+                                 patience = 5,
+                                 restore_best_weights = True
+                             )])
+
+        tflite_model = tflite_utils.convert_to_tflite(pruned_model)
+        tflite_path = os.path.join(output_dir, '{}_pruned_{:02d}.tflite'.format(
+            name, int(pruning_level * 100)))
+        with open(tflite_path, 'wb') as f:
+            f.write(tflite_model)
+
+        outputs = tflite_utils.get_tflite_model_outputs(tflite_model, test_images)
+        latency = tflite_utils.measure_tflite_latency(tflite_model, n_runs = 500)
+        results.append({'pruning_level': pruning_level,
+                        'parameters': int(pruned_model.count_params()),
+                        'flops': count_flops(pruned_model),
+                        'size_bytes': len(tflite_model),
+                        'accuracy': float(np.mean(outputs.argmax(1) == test_labels)),
+                        'latency_p50_ms': latency['p50_ms'],
+                        'latency_p95_ms': latency['p95_ms'],
+                        'tflite': tflite_path})
+
+    base = results[0]
+    for r in results:
+        r['accuracy_delta'] = r['accuracy'] - base['accuracy']
+        r['speedup'] = base['latency_p50_ms'] / r['latency_p50_ms']
+
+    report = {'source': model_path, 'epochs': epochs, 'results': results}
+    with open(os.path.join(output_dir, name + '_pruning_report.json'), 'w') as file:
+        json.dump(report, file, indent = 2)
+    _print_report(report)
+    return report
+
+def _slice_conv_weights(layer, weights, keep_in, keep_out):
+    '''Keeps only the given input and output channels of convolution weights'''
+    if isinstance(layer, layers.SeparableConv2D):
+        depthwise, pointwise = weights[0], weights[1]
+        sliced = [depthwise[:, :, keep_in, :],
+                  pointwise[:, :, keep_in, :][..., keep_out]]
+    else:
+        sliced = [weights[0][:, :, keep_in, :][..., keep_out]]
+    if layer.use_bias:
+        sliced.append(weights[-1][keep_out])
+    return sliced
+
+def _print_report(report):
+    '''Prints the pruning report as a console table'''
+    header = '{:>8} {:>10} {:>12} {:>10} {:>10} {:>9}'.format('Pruned',
+                                                             'Params',
+                                                             'MFLOPs',
+                                                             'Accuracy',
+                                                             'p50 [ms]',
+                                                             'Speedup')
+    print(header)
+    print('-' * len(header))
+    for r in report['results']:
+        print('{:>7.0f}% {:>10} {:>12.2f} {:>10.4f} {:>10.3f} {:>9.2f}'.format(
+            r['pruning_level'] * 100,
+            r['parameters'],
+            r['flops'] / 1e6,
+            r['accuracy'],
+            r['latency_p50_ms'],
+            r['speedup']))
@@ -0,0 +1,166 @@
+"""Pre-fork launcher of the Moodify API.
+
+The parent process imports TensorFlow, OpenCV and the app, reads the models
+into memory and warms them up once, binds the listening socket and then forks
+the workers. Workers inherit the imported code and the model buffers
+copy-on-write, so the buffers are shared by all of them (they are never
+written) and no worker repeats the cold start. The song catalog index is
+compiled once too and memory-mapped by every worker. Every worker builds its own
+interpreters on the shared buffers with cpu_count / workers threads, so that
+workers do not oversubscribe the cores.
+
+Usage: python serve.py --workers 4 --port 8000
+"""
+import argparse
+import glob
+import os
+import signal
+import socket
+import sys
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+import uvicorn
+
+import app as moodify_app
+from model_registry import MODEL_DIR
+from song_catalog import load_index
+from song_dictionary import SONG_CATALOG_PATH
+from tflite_utils import quantize_input
+
+# A worker that exits sooner than this after it was forked counts as a failed
+# start. Failed starts are retried after exponentially growing delays, and
+# the launcher gives up after MAX_FAILED_STARTS of them in a row.
+FAILED_START_SECONDS = 10.0
+MAX_FAILED_STARTS = 5
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+
+
+def preload_models(model_dir=MODEL_DIR):
+    """Read every .tflite model into memory and run it once before forking.
+    Returns a dict mapping file names to model buffers. Models that cannot be
+    read or run are skipped."""
+    model_contents = {}
+    for path in sorted(glob.glob(os.path.join(model_dir, '*.tflite'))):
+        try:
+            with open(path, 'rb') as f:
+                model_content = f.read()
+
+            # Verifies the model and pages in the interpreter code shared by workers
+            interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=1)
+            interpreter.allocate_tensors()
+            input_details = interpreter.get_input_details()[0]
+            input_data = np.zeros((1,) + tuple(input_details['shape'][1:]), dtype='float32')
+            interpreter.set_tensor(input_details['index'], quantize_input(input_data, input_details))
+            interpreter.invoke()
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"Skipping model {path}: {e}")
+            continue
+        model_contents[os.path.basename(path)] = model_content
+    return model_contents
+
+def bind_socket(host, port):
+    """Create the listening socket shared by all workers"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def run_worker(sock, num_threads, log_level):
+    """Serve requests in a forked worker until it is terminated"""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    cv2.setNumThreads(num_threads)
+    moodify_app.ENGINE_OPTIONS['num_threads'] = num_threads
+
+    config = uvicorn.Config(moodify_app.app, log_level=log_level)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+    # uvicorn returns normally when the app fails to start
+    return 0 if server.started else 1
+
+def fork_worker(sock, num_threads, log_level):
+    """Fork a worker process and return its pid"""
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            status = run_worker(sock, num_threads, log_level)
+        finally:
+            os._exit(status)
+    return pid
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the Moodify API with pre-forked workers')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=None,
+                        help='interpreter threads per worker (cpu_count / workers by default)')
+    parser.add_argument('--model-dir', default=MODEL_DIR)
+    parser.add_argument('--log-level', default='info')
+    args = parser.parse_args()
+
+    num_threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    moodify_app.ENGINE_OPTIONS['model_contents'] = preload_models(args.model_dir)
+    moodify_app.ENGINE_OPTIONS['model_dir'] = args.model_dir
+    # Compile the song catalog once, workers memory-map the same index files
+    load_index(os.getenv("MOODIFY_CATALOG", SONG_CATALOG_PATH))
+    sock = bind_socket(args.host, args.port)
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers, {num_threads} threads each")
+
+    # Start time of every worker by pid
+    workers = {}
+    shutting_down = False
+    failed_starts = 0
+
+    def shutdown(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    for _ in range(args.workers):
+        workers[fork_worker(sock, num_threads, args.log_level)] = time.monotonic()
+
+    # Restart workers that die unexpectedly until shutdown
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        started = workers.pop(pid, None)
+        if shutting_down or started is None:
+            continue
+
+        if time.monotonic() - started < FAILED_START_SECONDS:
+            failed_starts += 1
+        else:
+            failed_starts = 0
+        if failed_starts >= MAX_FAILED_STARTS:
+            print(f"Worker {pid} failed to start {failed_starts} times in a row, giving up")
+            shutdown(None, None)
+            continue
+
+        delay = min(RESTART_DELAY * 2 ** failed_starts, MAX_RESTART_DELAY) if failed_starts else 0
+        print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, "
+              f"restarting in {delay:.1f}s")
+        time.sleep(delay)
+        if not shutting_down:
+            workers[fork_worker(sock, num_threads, args.log_level)] = time.monotonic()
+
+    sock.close()
+    sys.exit(1 if failed_starts >= MAX_FAILED_STARTS else 0)
+
+if __name__ == "__main__":
+    main()
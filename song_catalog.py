@@ -0,0 +1,302 @@
+"""Compiled, hot-reloadable song catalog.
+
+The catalog JSON (see song_dictionary.py) is validated and compiled into an
+index of integer ids: every distinct emotion, weather key, genre, text and
+track name is stored once in a StringTable, and the tracks of every
+(emotion, weather) bucket are a slice of one track id array, with cumulative
+track weights for O(log n) weighted picks. The index is saved as .npy files
+in a directory named after the catalog's content hash, and loaded
+memory-mapped, so all serve.py workers share one read-only copy through the
+page cache however large the catalog is.
+
+SongCatalog polls the catalog file in a background thread. A changed file is
+compiled off the request path and swapped in with one assignment; requests
+keep using the previous index until then. An invalid file is reported and
+ignored.
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from song_dictionary import DEFAULT_EMOTION, SONG_CATALOG_PATH, validate_song_dictionary
+
+# Compiled indexes, one directory per catalog content hash and INDEX_VERSION
+INDEX_DIR = os.path.join(os.path.dirname(SONG_CATALOG_PATH), "index")
+INDEX_VERSION = 2
+
+STRING_TABLES = ("emotions", "weathers", "genres", "texts", "tracks")
+ARRAYS = ("bucket_index", "bucket_genres", "bucket_texts", "track_offsets", "track_ids", "track_cumweights")
+
+
+class StringTable:
+    """Interned strings stored as one UTF-8 buffer and their offsets, i.e. two
+    arrays that can be memory-mapped whatever the number of strings"""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype="int64")
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        return cls(np.frombuffer(b"".join(encoded), dtype="uint8"), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def to_list(self):
+        return [self[i] for i in range(len(self))]
+
+
+class CompiledCatalog:
+    """Read-only index of a validated catalog.
+
+    bucket_index[emotion id, weather id] is the bucket of an (emotion, weather)
+    entry or -1. The genre and (acoustic strategy, mechanism) text ids of a
+    bucket are in bucket_genres and bucket_texts, and its track ids are
+    track_ids[track_offsets[bucket]:track_offsets[bucket + 1]].
+
+    track_cumweights holds the normalized cumulative weights of the tracks of
+    every bucket shifted by the bucket number, i.e. bucket b covers (b, b + 1].
+    The array is increasing as a whole, so the track for a uniform u in [0, 1)
+    is one searchsorted of b + u, and so are the tracks of many buckets at once.
+    """
+
+    def __init__(self, tables, arrays):
+        for name in STRING_TABLES:
+            setattr(self, name, tables[name])
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+        # Emotions and weather keys are few, their ids are looked up in dicts
+        self.emotion_ids = {name: i for i, name in enumerate(self.emotions.to_list())}
+        self.weather_ids = {name: i for i, name in enumerate(self.weathers.to_list())}
+        self.any_weather = self.weather_ids["any"]
+        self.default_emotion = self.emotion_ids[DEFAULT_EMOTION]
+        self.details = [
+            {
+                "genre": self.genres[self.bucket_genres[b]],
+                "acoustic_strategy": self.texts[self.bucket_texts[b, 0]],
+                "mechanism": self.texts[self.bucket_texts[b, 1]],
+            }
+            for b in range(len(self.bucket_genres))
+        ]
+
+    @classmethod
+    def compile(cls, catalog):
+        """Validate a catalog dict and build its index"""
+        validate_song_dictionary(catalog)
+        ids = {name: {} for name in STRING_TABLES}
+
+        def intern(table, value):
+            return ids[table].setdefault(value, len(ids[table]))
+
+        for weathers in catalog.values():
+            for weather in weathers:
+                intern("weathers", weather)
+
+        bucket_index = np.full((len(catalog), len(ids["weathers"])), -1, dtype="int32")
+        bucket_genres, bucket_texts, track_ids, track_offsets, track_cumweights = [], [], [], [0], []
+        for emotion, weathers in catalog.items():
+            e = intern("emotions", emotion)
+            for weather, entry in weathers.items():
+                bucket_index[e, ids["weathers"][weather]] = len(bucket_genres)
+                bucket_genres.append(intern("genres", entry["genre"]))
+                bucket_texts.append((intern("texts", entry["acoustic_strategy"]),
+                                     intern("texts", entry["mechanism"])))
+                track_ids.extend(intern("tracks", track) for track in entry["tracks"])
+                track_offsets.append(len(track_ids))
+
+                weights = np.asarray(entry.get("weights") or np.ones(len(entry["tracks"])), dtype="float64")
+                cumweights = np.cumsum(weights) / weights.sum()
+                cumweights[-1] = 1.0
+                track_cumweights.append(len(track_cumweights) + cumweights)
+
+        tables = {name: StringTable.build(list(ids[name])) for name in STRING_TABLES}
+        arrays = {
+            "bucket_index": bucket_index,
+            "bucket_genres": np.array(bucket_genres, dtype="int32"),
+            "bucket_texts": np.array(bucket_texts, dtype="int32").reshape(-1, 2),
+            "track_offsets": np.array(track_offsets, dtype="int64"),
+            "track_ids": np.array(track_ids, dtype="int32"),
+            "track_cumweights": np.concatenate(track_cumweights),
+        }
+        return cls(tables, arrays)
+
+    def save(self, directory):
+        """Write the index as .npy files"""
+        os.makedirs(directory, exist_ok=True)
+        for name in STRING_TABLES:
+            table = getattr(self, name)
+            np.save(os.path.join(directory, f"{name}_data.npy"), table.data)
+            np.save(os.path.join(directory, f"{name}_offsets.npy"), table.offsets)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Load an index saved with save(), memory-mapped by default"""
+        def load_array(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        tables = {name: StringTable(load_array(f"{name}_data"), load_array(f"{name}_offsets"))
+                  for name in STRING_TABLES}
+        return cls(tables, {name: load_array(name) for name in ARRAYS})
+
+    def get_bucket(self, emotion, weather):
+        """Bucket of an emotion and weather key, falling back to the default
+        emotion and to the 'any' weather of the emotion"""
+        e = self.emotion_ids.get(emotion, self.default_emotion)
+        w = self.weather_ids.get(weather, self.any_weather)
+        bucket = self.bucket_index[e, w]
+        if bucket < 0:
+            bucket = self.bucket_index[e, self.any_weather]
+        return int(bucket)
+
+    def get_tracks(self, bucket):
+        """Track ids of a bucket"""
+        return self.track_ids[self.track_offsets[bucket]:self.track_offsets[bucket + 1]]
+
+    def pick_track(self, bucket):
+        """Name of a random track of a bucket, drawn by track weight"""
+        position = np.searchsorted(self.track_cumweights, bucket + random.random(), side="right")
+        return self.tracks[self.track_ids[position]]
+
+    def sample_tracks(self, buckets, weights, n=1, rng=None):
+        """Draw n tracks from a mixture of buckets.
+
+        A bucket is drawn with probability proportional to its weight, then a
+        track of it by track weight, both by searchsorted over cumulative
+        weights, for all n picks at once. Returns the index into buckets of
+        the component and the track name of every pick.
+        """
+        rng = rng or np.random.default_rng()
+        buckets = np.asarray(buckets, dtype="int64")
+        cumweights = np.cumsum(np.asarray(weights, dtype="float64"))
+        if len(cumweights) == 0 or not cumweights[-1] > 0:
+            raise ValueError("Mixture weights must have a positive sum")
+
+        components = np.searchsorted(cumweights, rng.random(n) * cumweights[-1], side="right")
+        # Guards against u * total rounding up to the total
+        components = np.minimum(components, len(buckets) - 1)
+        positions = np.searchsorted(self.track_cumweights, buckets[components] + rng.random(n), side="right")
+        return components, [self.tracks[t] for t in self.track_ids[positions]]
+
+    def get_details(self, bucket):
+        """Genre, acoustic strategy and mechanism of a bucket"""
+        return self.details[bucket]
+
+    def get_stats(self):
+        return {
+            "emotions": len(self.emotions),
+            "weathers": len(self.weathers),
+            "buckets": len(self.bucket_genres),
+            "tracks": len(self.tracks),
+            "bucket_tracks": len(self.track_ids),
+        }
+
+
+def get_index_path(content, index_dir=INDEX_DIR):
+    """Index directory of a catalog file's content"""
+    digest = hashlib.sha1(content).hexdigest()[:16]
+    return os.path.join(index_dir, f"v{INDEX_VERSION}-{digest}")
+
+def load_index(path=SONG_CATALOG_PATH, index_dir=INDEX_DIR):
+    """Return the compiled index of a catalog file, compiling it first if no
+    process did it yet. Raises ValueError if the catalog is invalid."""
+    with open(path, "rb") as f:
+        content = f.read()
+    index_path = get_index_path(content, index_dir)
+    if not os.path.isdir(index_path):
+        catalog = CompiledCatalog.compile(json.loads(content.decode("utf-8")))
+
+        # Write to a temporary directory and rename it, so that processes
+        # compiling the same catalog at once never see a partial index
+        os.makedirs(index_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=index_dir, prefix=".tmp-")
+        try:
+            catalog.save(tmp_path)
+            os.rename(tmp_path, index_path)
+        except OSError:
+            if not os.path.isdir(index_path):
+                raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    return CompiledCatalog.load(index_path)
+
+
+class SongCatalog:
+    """The engine's song catalog, reloaded when its file changes.
+
+    index is the current CompiledCatalog; read it once per request and use
+    that reference, a reload only replaces the attribute.
+    """
+
+    def __init__(self, path=SONG_CATALOG_PATH, index_dir=INDEX_DIR, reload_interval=5.0):
+        self.path = path
+        self.index_dir = index_dir
+        self.reload_interval = reload_interval
+        self.signature = self._get_signature()
+        self.index = load_index(path, index_dir)
+        self.reloads = 0
+        self.reload_errors = 0
+        self.last_error = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def _get_signature(self):
+        stat = os.stat(self.path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self):
+        """Watch the catalog file in a daemon thread"""
+        if self.reload_interval > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self._watch, name="catalog-reload", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _watch(self):
+        while not self.stop_event.wait(self.reload_interval):
+            self.reload_if_changed()
+
+    def reload_if_changed(self):
+        """Swap in the index of the catalog file if it changed. Returns whether it did."""
+        try:
+            signature = self._get_signature()
+            if signature == self.signature:
+                return False
+            # A file caught in the middle of a write is retried once the
+            # write changes its signature again
+            self.signature = signature
+            index = load_index(self.path, self.index_dir)
+        except (OSError, ValueError) as e:
+            self.reload_errors += 1
+            self.last_error = str(e)
+            print(f"Song catalog reload failed, keeping the previous catalog: {e}")
+            return False
+
+        self.index = index
+        self.reloads += 1
+        self.last_error = None
+        return True
+
+    def get_metrics(self):
+        return dict(
+            self.index.get_stats(),
+            reloads=self.reloads,
+            reload_errors=self.reload_errors,
+            last_error=self.last_error,
+        )
@@ -1,4 +1,9 @@
 # song_dictionary.py
+import bisect
+import json
+import os
+import re
+
 # Canonical weather keys (from Ambee docs)
 AMBEE_WEATHER_KEYS = [
     "clear",
@@ -21,417 +26,304 @@ WEATHER_CODE_MAP = {
     "80x": "partly-cloudy",     # choose partly-cloudy vs cloudy by cloud_cover threshold
 }
 
-# Main song dictionary:
-# Structure: SONG_DICTIONARY[emotion][weather_key] = {
+# Song catalog, kept in catalog/song_catalog.json so it can change without a deploy.
+# Structure: catalog[emotion][weather_key] = {
 #     "genre": ...,
 #     "acoustic_strategy": ...,
 #     "tracks": [...],
-#     "mechanism": ...
+#     "mechanism": ...,
+#     "weights": [...]    (optional, relative weight of every track, 1 by default)
 # }
-SONG_DICTIONARY = {
-    "neutral": {
-        "clear": {
-            "genre": "Chill Phonk / Instrumental Synthwave",
-            "acoustic_strategy": "Repetitive 808 sub-bass, mid-tempo synth lines, instrumental (no vocals)",
-            "tracks": ["Sahara - Hensonn", "Close Eyes - DVRST"],
-            "mechanism": "Maintains cognitive focus and elevates baseline arousal without vocal distraction."
-        },
-        "partly-cloudy": {
-            "genre": "Chill Phonk / Lo-fi instrumental",
-            "acoustic_strategy": "Sustained low-mid synth pads with subtle rhythmic elements",
-            "tracks": ["Sahara - Hensonn", "Close Eyes - DVRST"],
-            "mechanism": "Keeps attention steady while remaining unobtrusive."
-        },
-        "cloudy": {
-            "genre": "Bollywood Lofi (Slowed + Reverb)",
-            "acoustic_strategy": "Heavy reverb + slowed tempo to create acoustic space",
-            "tracks": ["Dil Ka Rishta (Lofi)", "Piya O Re Piya (Lofi)"],
-            "mechanism": "Reverberation expansion creates psychological acoustic space matching overcast visuals."
-        },
-        "rain": {
-            "genre": "Marathi Soft Acoustic / Nostalgic Hindi",
-            "acoustic_strategy": "Mid-range acoustic frequencies; soft vocals",
-            "tracks": ["Sunya Sunya - Timepass 2", "Boondon Se Baaten"],
-            "mechanism": "Mid-range frequencies blend with precipitation noise to soothe the listener."
-        },
-        "fog": {
-            "genre": "Ambient Chill / Cinematic Lo-Fi",
-            "acoustic_strategy": "Ethereal pads, low-pass filtering, sparse percussive elements",
-            "tracks": ["Valhalla - NERONUS", "Endless Night - SLEEP SPIRIT"],
-            "mechanism": "Pads + low-pass mimic atmospheric density and reduce high-frequency stimulation."
-        },
-        "snow": {
-            "genre": "Ambient / Minimal Instrumental",
-            "acoustic_strategy": "Soft bells, slow pads, minimal beat",
-            "tracks": ["Valhalla - NERONUS"],
-            "mechanism": "Sparse textures support calmness in low-temperature, low-arousal states."
-        },
-        "thunderstorm": {
-            "genre": "Ambient Chill / Low-impact Score",
-            "acoustic_strategy": "Deep pads, gentle low-frequency rumble, soft predictable chord cycles",
-            "tracks": ["Endless Night - SLEEP SPIRIT"],
-            "mechanism": "Predictable textures reduce startle and support grounding during noisy weather."
-        },
-        "any": {
-            "genre": "Instrumental Lo-fi",
-            "acoustic_strategy": "Neutral, low-energy instrumental",
-            "tracks": ["Sahara - Hensonn"],
-            "mechanism": "Baseline focus support across conditions."
-        }
-    },
-
-    "happiness": {
-        "clear": {
-            "genre": "South Indian Kuthu / Bollywood Dance",
-            "acoustic_strategy": "High BPM, major-key, heavy syncopated percussion",
-            "tracks": ["Arabic Kuthu - Anirudh", "Besharam Rang - Pathaan"],
-            "mechanism": "Maximizes dopaminergic output and stimulates motor cortex (movement/joy)."
-        },
-        "partly-cloudy": {
-            "genre": "Bollywood Pop / Feel-Good Anthems",
-            "acoustic_strategy": "Brass sections, group chorus, mid-to-high energy",
-            "tracks": ["Tune Maari Entriyaan", "Luv Ju - Bunty Aur Babli 2"],
-            "mechanism": "Brass + chorus lift social joy and counter gray visuals."
-        },
-        "cloudy": {
-            "genre": "Bollywood Pop / Anthems",
-            "acoustic_strategy": "Uplifting chord progressions, brass, chorus",
-            "tracks": ["Tune Maari Entriyaan", "Luv Ju - Bunty Aur Babli 2"],
-            "mechanism": "Elevates social joy against overcast conditions."
-        },
-        "rain": {
-            "genre": "Marathi Monsoon Joy / Romantic Hindi",
-            "acoustic_strategy": "Sweeping strings + traditional percussion",
-            "tracks": ["Mala Ved Lagle - Timepass", "Ek Ladki Bheegi Bhaagi Si"],
-            "mechanism": "Culturally-conditioned romantic joy amplified by monsoon cues."
-        },
-        "fog": {
-            "genre": "Hollywood Instrumental Pop / Tropical",
-            "acoustic_strategy": "Bright xylophone-like tones, major harmonies",
-            "tracks": ["Toucans - Tatono"],
-            "mechanism": "Pure tonal content fools the brain into tropical warmth, countering dullness."
-        },
-        "any": {
-            "genre": "Upbeat Instrumental Pop",
-            "acoustic_strategy": "Positive major-key hooks, danceable groove",
-            "tracks": ["Toucans - Tatono"],
-            "mechanism": "Directly boosts mood regardless of weather."
-        }
-    },
-
-    "surprise": {
-        "clear": {
-            "genre": "Aggressive Phonk / Hardstyle",
-            "acoustic_strategy": "Heavy sidechain, sudden 808 drops, extreme frequency shifts",
-            "tracks": ["Neon Blade - MoonDeity", "Murder Plot - Kordhell"],
-            "mechanism": "Converts shock into energised arousal without long-term anxiety."
-        },
-        "partly-cloudy": {
-            "genre": "High-Energy Bollywood Reveal",
-            "acoustic_strategy": "Unpredictable synth drops, sudden vocal entrances",
-            "tracks": ["Aavan Jaavan - War 2", "Dhating Naach"],
-            "mechanism": "Keeps auditory cortex in anticipatory arousal for novelty."
-        },
-        "cloudy": {
-            "genre": "Aggressive Electronic / Cinematic",
-            "acoustic_strategy": "Large dynamic swings, sudden percussive stabs",
-            "tracks": ["Neon Blade - MoonDeity"],
-            "mechanism": "Maintains high neurological engagement, transforms surprise into action."
-        },
-        "rain": {
-            "genre": "Cinematic Trailer Music / Epic Score",
-            "acoustic_strategy": "Staccato strings, sudden silences, explosive brass",
-            "tracks": ["Air Raid - Chroma", "Furious Retribution"],
-            "mechanism": "Mimics environmental unpredictability, channels startle into excitement."
-        },
-        "fog": {
-            "genre": "Cinematic / Ambient Surprise",
-            "acoustic_strategy": "Sparse ambiences punctuated by sudden transient events",
-            "tracks": ["Air Raid - Chroma"],
-            "mechanism": "Triggers curiosity while preventing panic."
-        },
-        "any": {
-            "genre": "Unexpected Genre-Bending Covers",
-            "acoustic_strategy": "Familiar lyric set in shocking instrumentation",
-            "tracks": ["The Sound of Silence - Disturbed"],
-            "mechanism": "High novelty keeps attention focused on music rather than unpleasant surprise."
-        }
-    },
-
-    "sadness": {
-        "clear": {
-            "genre": "South Indian / Malayalam Soft Indie",
-            "acoustic_strategy": "Acoustic guitars, breathy vocal performances",
-            "tracks": ["Cherathukal", "Arerey Manasa"],
-            "mechanism": "Empathic comfort without demanding high physiological energy."
-        },
-        "partly-cloudy": {
-            "genre": "Soft Indie / Lyrical Empathy",
-            "acoustic_strategy": "Warm acoustic timbres, close-mic vocals",
-            "tracks": ["Everybody Hurts - R.E.M.", "True Love Waits - Radiohead"],
-            "mechanism": "Lyrical empathy promotes self-soothing and reduces isolation."
-        },
-        "cloudy": {
-            "genre": "English Self-Compassion / Empathy",
-            "acoustic_strategy": "Slow tempi, intimate vocal lines",
-            "tracks": ["Everybody Hurts - R.E.M.", "True Love Waits - Radiohead"],
-            "mechanism": "Directly addresses cognitive sorrow and aids processing."
-        },
-        "rain": {
-            "genre": "Marathi Sad / Nostalgic Folk",
-            "acoustic_strategy": "Sweeping strings, traditional instrumentation",
-            "tracks": ["Olya Sanjveli - Premachi Goshta", "Sunya Sunya"],
-            "mechanism": "Culturally resonant container for grief processing."
-        },
-        "fog": {
-            "genre": "Bollywood Soulful / Slow Ballads",
-            "acoustic_strategy": "Minor keys, extended vocal legato",
-            "tracks": ["Rait Zara Si", "Ek Dil Ek Jaan"],
-            "mechanism": "Facilitates catharsis in low-visibility / introspective environments."
-        },
-        "any": {
-            "genre": "Low-energy Acoustic",
-            "acoustic_strategy": "Minimal arrangement, empathetic lyricism",
-            "tracks": ["True Love Waits - Radiohead"],
-            "mechanism": "Low demand listening encourages emotional processing."
-        }
-    },
-
-    "anger": {
-        "clear": {
-            "genre": "Aggressive Phonk / Drift Phonk",
-            "acoustic_strategy": "Distortion, heavy 808 clipping, high BPMs",
-            "tracks": ["Fatality - Kordhell", "Vendetta! - MUPP"],
-            "mechanism": "Matches sympathetic arousal and allows safe discharge via music."
-        },
-        "partly-cloudy": {
-            "genre": "Bollywood Revenge / Motivational",
-            "acoustic_strategy": "Anthemic builds, heavy percussion",
-            "tracks": ["Aarambh Hai Prachand", "Dangal - Title Song"],
-            "mechanism": "Redirects anger into focused motivation and physical energy."
-        },
-        "cloudy": {
-            "genre": "Bollywood Motivational / Anthemic",
-            "acoustic_strategy": "Strong rhythms, marching percussion",
-            "tracks": ["Dangal - Title Song"],
-            "mechanism": "Transforms diffuse anger into task-oriented vigor."
-        },
-        "rain": {
-            "genre": "Indian Classical (Cooling) / Raga",
-            "acoustic_strategy": "Soothing microtonal phrases, slow tempo",
-            "tracks": ["Saraswathi Raag Compositions"],
-            "mechanism": "Microtones interact with auditory cortex to lower cortisol and muscle tension."
-        },
-        "thunderstorm": {
-            "genre": "Cinematic Dark / Epic Orchestral",
-            "acoustic_strategy": "Massive orchestral hits, heavy low brass",
-            "tracks": ["Furious Retribution - Epic Score"],
-            "mechanism": "Grand externalisation of frustration in a controlled way."
-        },
-        "any": {
-            "genre": "Controlled High-energy / Motivational",
-            "acoustic_strategy": "Power rhythms with regulated tempo",
-            "tracks": ["Fatality - Kordhell"],
-            "mechanism": "Channel sympathetic arousal into productive action."
-        }
-    },
-
-    "fear": {
-        "clear": {
-            "genre": "Bollywood Slow / Gentle Romance",
-            "acoustic_strategy": "Slow BPM (60-70), predictable chord progressions",
-            "tracks": ["Dil Jaaniye", "Hoor"],
-            "mechanism": "Heart-rate entrainment and predictable chords signal safety to amygdala."
-        },
-        "partly-cloudy": {
-            "genre": "English Acoustic / Soft Self-Care",
-            "acoustic_strategy": "Warm acoustic guitars and empathetic lyrics",
-            "tracks": ["Light On - Maggie Rogers", "Fear is a Liar - Zach Williams"],
-            "mechanism": "Reduces cognitive spirals and grounds the listener."
-        },
-        "cloudy": {
-            "genre": "Acoustic Self-care",
-            "acoustic_strategy": "Low dynamics, reassuring lyrical content",
-            "tracks": ["Light On - Maggie Rogers"],
-            "mechanism": "Encourages cognitive grounding through familiarity."
-        },
-        "rain": {
-            "genre": "Healing Frequencies / Solfeggio",
-            "acoustic_strategy": "Drone frequencies (396Hz/432Hz) and slow textures",
-            "tracks": ["396Hz Energy Cleanse", "432Hz Indian Classical"],
-            "mechanism": "Continuous drone inhibits threat-detection and lowers physiological arousal."
-        },
-        "fog": {
-            "genre": "Ambient Instrumental / Nature Sounds",
-            "acoustic_strategy": "No sudden percussive transients; gentle field recordings",
-            "tracks": ["Blissful and Calm", "A Day Without Rain"],
-            "mechanism": "Prevents startle reflex and fosters safe slow breathing."
-        },
-        "any": {
-            "genre": "Soft Acoustic / Healing Frequencies",
-            "acoustic_strategy": "Slow predictable progressions",
-            "tracks": ["Dil Jaaniye"],
-            "mechanism": "Heart-rate entrainment and reassurance."
-        }
-    },
-
-    "disgust": {
-        "clear": {
-            "genre": "South Indian Pop / Upbeat Dance",
-            "acoustic_strategy": "High-fidelity production, bright leads",
-            "tracks": ["Rowdy Baby", "Enjoy Enjaami"],
-            "mechanism": "Overrides aversive cognitive loops with high sensory engagement."
-        },
-        "partly-cloudy": {
-            "genre": "Instrumental Pop / Pure Tones",
-            "acoustic_strategy": "Consonant xylophone-like instruments, clean mixes",
-            "tracks": ["Toucans - Tatono", "Misery Business - Paramore"],
-            "mechanism": "Acts as acoustic palate-cleansing, resetting aesthetic centers."
-        },
-        "cloudy": {
-            "genre": "Instrumental Pop / Bright Production",
-            "acoustic_strategy": "Clear mixes, bright synths, upbeat rhythm",
-            "tracks": ["Toucans - Tatono"],
-            "mechanism": "Forces positive sensory re-evaluation."
-        },
-        "rain": {
-            "genre": "Marathi Clean Melodies / Acoustic",
-            "acoustic_strategy": "Crystal-clear vocal engineering and consonant string harmonies",
-            "tracks": ["Tu Havishi - Online Binline", "Qayde Se"],
-            "mechanism": "Elicits purity feelings that match cleansing visuals of rain."
-        },
-        "fog": {
-            "genre": "Bright Instrumental / Palate Cleanser",
-            "acoustic_strategy": "High clarity pure tones",
-            "tracks": ["Toucans - Tatono"],
-            "mechanism": "Resets sensory disgust loops."
-        },
-        "any": {
-            "genre": "High-fidelity Upbeat Pop",
-            "acoustic_strategy": "Clean mixes, saturated high frequencies, major keys",
-            "tracks": ["Enjoy Enjaami"],
-            "mechanism": "Overrides aversive states with high sensory reward."
-        }
-    },
-
-    "contempt": {
-        "clear": {
-            "genre": "R&B / Self-Care Pop",
-            "acoustic_strategy": "Warm basslines, affirming lyrics",
-            "tracks": ["Put Your Records On", "Self Care - Louis the Child"],
-            "mechanism": "Dissolves harsh self-criticism and promotes acceptance."
-        },
-        "partly-cloudy": {
-            "genre": "Conscious Hip-Hop / Empathetic Pop",
-            "acoustic_strategy": "Narrative lyrics, warm instrumentation",
-            "tracks": ["Keep Ya Head Up - Tupac", "1-800-273-8255 - Logic"],
-            "mechanism": "Storytelling reduces distance and builds shared humanity."
-        },
-        "cloudy": {
-            "genre": "Conscious Hip-Hop / Empathy",
-            "acoustic_strategy": "Story-driven lyrics with warm backings",
-            "tracks": ["Keep Ya Head Up - Tupac"],
-            "mechanism": "Fosters humility and connection."
-        },
-        "rain": {
-            "genre": "Devotional Marathi / Soulful Hindi",
-            "acoustic_strategy": "Expansive vocal delivery, traditional instrumentation",
-            "tracks": ["Ek Dil Ek Jaan", "Arziyaan"],
-            "mechanism": "Induces humility and dissolves ego-driven superiority."
-        },
-        "fog": {
-            "genre": "Indie / Vulnerable Acoustic",
-            "acoustic_strategy": "Ethereal textures and raw lyrics",
-            "tracks": ["How to Disappear Completely", "Sarajevo - Watsky"],
-            "mechanism": "Provides safe space for regret and dismantling emotional walls."
-        },
-        "any": {
-            "genre": "Warm R&B / Lyrical Self-care",
-            "acoustic_strategy": "Comforting chord progressions and affirming lyrics",
-            "tracks": ["Put Your Records On"],
-            "mechanism": "Promotes relaxed acceptance of present moment."
-        }
-    }
+# song_catalog.py compiles it into the index used by the engine.
+SONG_CATALOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog", "song_catalog.json")
+
+# Emotion used for labels missing from the catalog
+DEFAULT_EMOTION = "neutral"
+ENTRY_FIELDS = ("genre", "acoustic_strategy", "mechanism")
+
+
+def load_song_dictionary(path=SONG_CATALOG_PATH) -> dict:
+    """Read the song catalog JSON"""
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+# --- weather inference from Ambee response JSON ---
+# The rules below are compiled once at import time. validate_song_dictionary()
+# checks that a catalog has songs for every key they can produce.
+
+# Response fields used by the rules and their aliases in order of preference.
+# The first alias with a truthy value is used. Dotted aliases look into nested objects.
+AMBEE_FIELD_ALIASES = {
+    "icon": ("icon", "weather.icon"),
+    "cloud_cover": ("cloudCover", "cloud_cover", "clouds"),
+    "precipitation": ("precipitationIntensity", "precipIntensity", "rain"),
+    "visibility": ("visibility",),
+    "summary": ("summary",),
+}
+
+# Keywords of the icon per weather key, in priority order. Icons equal to one of
+# AMBEE_WEATHER_KEYS are used as they are.
+ICON_KEYWORDS = (
+    ("clear", ("clear",)),            # 'clear-day' / 'clear-night' / 'clear_day'
+    ("partly-cloudy", ("cloud",)),    # cloudy when cloud cover >= CLOUDY_COVER
+    ("rain", ("rain", "drizzle")),
+    ("snow", ("snow",)),
+    ("fog", ("fog", "mist")),
+)
+
+# Numeric rules applied when the icon gives no answer: (field, comparison, threshold, weather key)
+THRESHOLD_RULES = (
+    ("precipitation", ">", 0.1, "rain"),
+    ("visibility", "<", 2000, "fog"),   # meters
+)
+
+# Keywords of the summary per weather key, in priority order, used last
+SUMMARY_KEYWORDS = (
+    ("thunderstorm", ("thunder", "lightning")),
+    ("snow", ("snow",)),
+    ("rain", ("rain", "drizzle")),
+    ("fog", ("fog", "mist", "haze")),
+    ("clear", ("clear",)),
+    ("partly-cloudy", ("cloud",)),
+)
+
+# Cloud cover (0-1) from which a cloud icon means cloudy rather than partly-cloudy
+CLOUDY_COVER = 0.6
+
+COMPARISONS = {
+    ">": lambda value, threshold: value > threshold,
+    "<": lambda value, threshold: value < threshold,
 }
 
-# --- helper: example inference from Ambee response JSON ---
+
+def _compile_keywords(keyword_rules):
+    """Compile (weather key, keywords) rules into one regex with a group per rule"""
+    pattern = "|".join(
+        "(" + "|".join(re.escape(keyword) for keyword in keywords) + ")"
+        for _, keywords in keyword_rules
+    )
+    return re.compile(pattern), tuple(key for key, _ in keyword_rules)
+
+ICON_PATTERN, ICON_KEYS = _compile_keywords(ICON_KEYWORDS)
+SUMMARY_PATTERN, SUMMARY_KEYS = _compile_keywords(SUMMARY_KEYWORDS)
+
+
+def _match_keywords(pattern, keys, text):
+    """Weather key of the highest priority keyword found in text, or None"""
+    best = None
+    for match in pattern.finditer(text):
+        # Groups are not nested, so lastindex is the number of the matched rule
+        if best is None or match.lastindex < best:
+            best = match.lastindex
+            if best == 1:
+                break
+    return keys[best - 1] if best else None
+
+def _match_keywords_batch(pattern, keys, texts):
+    """Weather key of the highest priority keyword of every text in a
+    {row: text} dict, found with one scan of the texts joined by newlines
+    (keywords never contain one). Rows without a keyword are left out."""
+    rows = list(texts)
+    starts, offset = [], 0
+    for row in rows:
+        starts.append(offset)
+        offset += len(texts[row]) + 1
+    best = {}
+    for match in pattern.finditer("\n".join(texts[row] for row in rows)):
+        row = rows[bisect.bisect_right(starts, match.start()) - 1]
+        if match.lastindex < best.get(row, len(keys) + 1):
+            best[row] = match.lastindex
+    return {row: keys[rule - 1] for row, rule in best.items()}
+
+# Aliases split into their keys once
+AMBEE_FIELD_PATHS = {
+    field: tuple(tuple(alias.split(".")) for alias in aliases)
+    for field, aliases in AMBEE_FIELD_ALIASES.items()
+}
+
+def _get_path(response, path):
+    value = response
+    for part in path:
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def _get_field(response, field):
+    """Value of the first truthy alias of a field, else of the first one present"""
+    present = None
+    for path in AMBEE_FIELD_PATHS[field]:
+        value = _get_path(response, path)
+        if value:
+            return value
+        if present is None:
+            present = value
+    return present
+
+def _get_column(responses, field, rows):
+    """_get_field() of responses[row] for every row, reading one alias of all
+    rows at a time. The responses of rows have to be dicts."""
+    values = [None] * len(rows)
+    pending = range(len(rows))
+    for path in AMBEE_FIELD_PATHS[field]:
+        if len(path) == 1:
+            column = [responses[rows[j]].get(path[0]) for j in pending]
+        else:
+            column = [_get_path(responses[rows[j]], path) for j in pending]
+        falsy = []
+        for j, value in zip(pending, column):
+            if value:
+                values[j] = value
+            else:
+                if values[j] is None:
+                    values[j] = value
+                falsy.append(j)
+        pending = falsy
+        if not pending:
+            break
+    return values
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _validate_weather_rules():
+    """Check that threshold rules refer to known fields and comparisons"""
+    for field, comparison, _, _ in THRESHOLD_RULES:
+        if field not in AMBEE_FIELD_ALIASES or comparison not in COMPARISONS:
+            raise ValueError(f"Invalid threshold rule for {field}: {comparison}")
+
+_validate_weather_rules()
+
+# Every weather key the rules can produce
+WEATHER_RULE_KEYS = frozenset(
+    set(AMBEE_WEATHER_KEYS) | set(ICON_KEYS) | set(SUMMARY_KEYS) | {"cloudy", "any"}
+    | {key for _, _, _, key in THRESHOLD_RULES}
+)
+
+
+def validate_song_dictionary(catalog):
+    """Check the structure of a song catalog and that it has songs for every
+    weather key the rules can produce. Raises ValueError."""
+    if not isinstance(catalog, dict) or DEFAULT_EMOTION not in catalog:
+        raise ValueError(f"The catalog must be an object with a '{DEFAULT_EMOTION}' emotion")
+
+    for emotion, weathers in catalog.items():
+        if not isinstance(weathers, dict) or "any" not in weathers:
+            raise ValueError(f"catalog['{emotion}'] must be an object with an 'any' entry")
+        for weather, entry in weathers.items():
+            name = f"catalog['{emotion}']['{weather}']"
+            if not isinstance(entry, dict):
+                raise ValueError(f"{name} must be an object")
+            for field in ENTRY_FIELDS:
+                if not isinstance(entry.get(field), str):
+                    raise ValueError(f"{name}['{field}'] must be a string")
+            tracks = entry.get("tracks")
+            if not isinstance(tracks, list) or not tracks or not all(isinstance(t, str) and t for t in tracks):
+                raise ValueError(f"{name}['tracks'] must be a non-empty list of track names")
+            weights = entry.get("weights")
+            if weights is not None and (
+                    not isinstance(weights, list) or len(weights) != len(tracks)
+                    or not all(isinstance(w, (int, float)) and not isinstance(w, bool) and 0 < w < float("inf")
+                               for w in weights)):
+                raise ValueError(f"{name}['weights'] must be a list of positive numbers, one per track")
+
+    known_keys = {key for weathers in catalog.values() for key in weathers}
+    missing = WEATHER_RULE_KEYS - known_keys
+    if missing:
+        raise ValueError(f"Weather rules produce keys missing from the catalog: {sorted(missing)}")
+
+
 def infer_weather_key_from_ambee(ambee_response: dict) -> str:
     """
-    Example logic to map an Ambee response JSON to one of the dictionary keys.
+    Map an Ambee response JSON to one of the dictionary keys.
     ambee_response is expected to be the JSON returned by Ambee /weather/latest/by-lat-lng.
 
     Priority:
       1) If 'icon' present -> use it (maps directly to clear/cloudy/rain/fog/snow/partly-cloudy)
-      2) If precipitation intensity > threshold -> 'rain' or 'thunderstorm' (use severe-storms endpoint or lightning flag if present)
-      3) If visibility is very low -> 'fog'
-      4) If 'summary' string contains keyword thunder/lightning/hail -> 'thunderstorm'
-      5) fallback -> 'any'
+      2) THRESHOLD_RULES: precipitation intensity -> 'rain', low visibility -> 'fog'
+      3) If 'summary' string contains a keyword of SUMMARY_KEYWORDS -> its key
+      4) fallback -> 'any'
     """
     if not ambee_response or not isinstance(ambee_response, dict):
         return "any"
 
-    # 1) direct icon
-    icon = ambee_response.get("icon") or ambee_response.get("weather", {}).get("icon")
+    icon = _get_field(ambee_response, "icon")
     if icon:
-        # normalize known values
-        icon = icon.lower()
+        icon = str(icon).lower()
         if icon in AMBEE_WEATHER_KEYS:
             return icon
-        # some responses use 'clear-day' / 'clear-night' or 'clear_day' variants
-        if "clear" in icon:
-            return "clear"
-        if "cloud" in icon:
-            # decide between partly-cloudy and cloudy by cloud_cover if present
-            cloud_cover = ambee_response.get("cloudCover") or ambee_response.get("cloud_cover") or ambee_response.get("clouds")
-            try:
-                if cloud_cover is not None and float(cloud_cover) >= 0.6:
-                    return "cloudy"
-            except Exception:
-                pass
-            return "partly-cloudy"
-        if "rain" in icon or "drizzle" in icon:
-            return "rain"
-        if "snow" in icon:
-            return "snow"
-        if "fog" in icon or "mist" in icon:
-            return "fog"
-
-    # 2) precipitation intensity (names vary by API; adapt to your response keys)
-    precip = ambee_response.get("precipitationIntensity") or ambee_response.get("precipIntensity") or ambee_response.get("rain")
-    if precip:
-        try:
-            # low values -> drizzle-like, high -> rain
-            val = float(precip)
-            if val > 5.0:
-                return "rain"
-            if val > 0.1:
-                return "rain"
-        except Exception:
-            pass
-
-    # 3) visibility -> fog
-    visibility = ambee_response.get("visibility")
-    if visibility is not None:
-        try:
-            if float(visibility) < 2000:  # meters threshold
-                return "fog"
-        except Exception:
-            pass
-
-    # 4) summary keyword search
-    summary = (ambee_response.get("summary") or "").lower()
-    if "thunder" in summary or "lightning" in summary:
-        return "thunderstorm"
-    if "snow" in summary:
-        return "snow"
-    if "rain" in summary or "drizzle" in summary:
-        return "rain"
-    if "fog" in summary or "mist" in summary or "haze" in summary:
-        return "fog"
-    if "clear" in summary:
-        return "clear"
-    if "cloud" in summary:
-        return "partly-cloudy"
-
-    # fallback
-    return "any"
\ No newline at end of file
+        key = _match_keywords(ICON_PATTERN, ICON_KEYS, icon)
+        if key == "partly-cloudy":
+            cloud_cover = _to_float(_get_field(ambee_response, "cloud_cover"))
+            if cloud_cover is not None and cloud_cover >= CLOUDY_COVER:
+                return "cloudy"
+        if key:
+            return key
+
+    for field, comparison, threshold, key in THRESHOLD_RULES:
+        value = _get_field(ambee_response, field)
+        if value is None or value == "":
+            continue
+        value = _to_float(value)
+        if value is not None and COMPARISONS[comparison](value, threshold):
+            return key
+
+    summary = _get_field(ambee_response, "summary")
+    if summary:
+        key = _match_keywords(SUMMARY_PATTERN, SUMMARY_KEYS, str(summary).lower())
+        if key:
+            return key
+
+    return "any"
+
+def infer_weather_keys_from_ambee(ambee_responses) -> list:
+    """
+    Map a batch of Ambee response JSONs to dictionary keys, with the same
+    result as infer_weather_key_from_ambee() for every response.
+
+    The rules are applied to the batch one at a time instead of to every
+    response in turn: each field is read as a column of the responses the
+    previous rules left undecided, every threshold rule is one pass over its
+    column, and icons and summaries are matched by one regex scan each.
+    """
+    responses = list(ambee_responses)
+    keys = [None if response and isinstance(response, dict) else "any" for response in responses]
+
+    def undecided():
+        return [i for i, key in enumerate(keys) if key is None]
+
+    # 1) Icons, exact weather keys first
+    rows = undecided()
+    icons = {i: str(icon).lower() for i, icon in zip(rows, _get_column(responses, "icon", rows)) if icon}
+    for i, icon in list(icons.items()):
+        if icon in AMBEE_WEATHER_KEYS:
+            keys[i] = icon
+            del icons[i]
+    icon_keys = _match_keywords_batch(ICON_PATTERN, ICON_KEYS, icons)
+    cloud_rows = [i for i, key in icon_keys.items() if key == "partly-cloudy"]
+    for i, cloud_cover in zip(cloud_rows, _get_column(responses, "cloud_cover", cloud_rows)):
+        cloud_cover = _to_float(cloud_cover)
+        if cloud_cover is not None and cloud_cover >= CLOUDY_COVER:
+            icon_keys[i] = "cloudy"
+    for i, key in icon_keys.items():
+        keys[i] = key
+
+    # 2) Threshold rules, each on the rows no earlier rule decided
+    for field, comparison, threshold, key in THRESHOLD_RULES:
+        compare = COMPARISONS[comparison]
+        rows = undecided()
+        for i, value in zip(rows, _get_column(responses, field, rows)):
+            if value is None or value == "":
+                continue
+            value = _to_float(value)
+            if value is not None and compare(value, threshold):
+                keys[i] = key
+
+    # 3) Summaries, 4) fallback
+    rows = undecided()
+    summaries = {i: str(summary).lower()
+                 for i, summary in zip(rows, _get_column(responses, "summary", rows)) if summary}
+    for i, key in _match_keywords_batch(SUMMARY_PATTERN, SUMMARY_KEYS, summaries).items():
+        keys[i] = key
+    return [key or "any" for key in keys]
@@ -0,0 +1,47 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("cv2")
+
+from frame_cache import FrameCache, dhash, hamming_distance
+
+FACE_BOX = (300, 200, 48, 48)
+
+
+def get_frame(face_left, face_right):
+    """640x480 gradient frame with a face box whose halves have the given brightness"""
+    frame = np.tile(np.linspace(0, 255, 640), (480, 1)).astype(np.uint8)
+    x, y, w, h = FACE_BOX
+    frame[y:y + h, x:x + w // 2] = face_left
+    frame[y:y + h, x + w // 2:x + w] = face_right
+    return frame
+
+
+def test_frames_differing_only_in_face_region_miss():
+    cache = FrameCache()
+    first, second = get_frame(50, 200), get_frame(200, 50)
+    # The change is invisible to the whole-frame hash
+    assert hamming_distance(dhash(first), dhash(second)) <= cache.max_distance
+
+    result = ("probabilities", FACE_BOX)
+    cache.store("session", dhash(first), result, first, FACE_BOX)
+
+    assert cache.lookup("session", dhash(second), second) is None
+    assert cache.get_metrics()["region_misses"] == 1
+
+
+def test_identical_frame_hits():
+    cache = FrameCache()
+    frame = get_frame(50, 200)
+    result = ("probabilities", FACE_BOX)
+    cache.store("session", dhash(frame), result, frame, FACE_BOX)
+
+    assert cache.lookup("session", dhash(frame), frame) == result
+
+
+def test_results_without_face_use_frame_hash_only():
+    cache = FrameCache()
+    frame = get_frame(50, 200)
+    cache.store("session", dhash(frame), (None, None))
+
+    assert cache.lookup("session", dhash(frame)) == (None, None)
@@ -0,0 +1,33 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+
+if getattr(tf.keras, "__version__", "2").startswith("3."):
+    pytest.skip("models.py is written for Keras 2 (set TF_USE_LEGACY_KERAS=1 with tf-keras)",
+                allow_module_level = True)
+
+import models
+from tflite_utils import convert_to_tflite
+
+
+def get_student():
+    """The micro_w50_32px distillation student, which resizes its input inside the model"""
+    return models.get_micro_model(0.02, 0.1, 0.01, width_multiplier = 0.5, internal_resolution = 32,
+                                  logits = True)
+
+
+@pytest.mark.parametrize("quantize", [False, True])
+def test_32px_student_converts_to_tflite(quantize):
+    student = get_student()
+    images = np.random.default_rng(0).random((4, 48, 48, 1)).astype('float32')
+
+    tflite_model = convert_to_tflite(student, quantize)
+
+    interpreter = tf.lite.Interpreter(model_content = tflite_model)
+    interpreter.allocate_tensors()
+    input_index = interpreter.get_input_details()[0]['index']
+    interpreter.set_tensor(input_index, images[:1])
+    interpreter.invoke()
+    outputs = interpreter.get_tensor(interpreter.get_output_details()[0]['index'])
+    assert outputs.shape == (1, 8)
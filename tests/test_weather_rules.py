@@ -0,0 +1,100 @@
+import pytest
+
+from song_dictionary import (infer_weather_key_from_ambee, infer_weather_keys_from_ambee,
+                             load_song_dictionary)
+
+# "data" objects of Ambee /weather/latest/by-lat-lng responses, with the
+# fields the rules do not read trimmed, and the weather key each should give
+RECORDED_PAYLOADS = [
+    # Icons
+    ({"time": 1729382400, "summary": "Clear", "icon": "clear-night", "temperature": 71.6,
+      "cloudCover": 0.02, "visibility": 10000, "precipIntensity": 0},
+     "clear"),
+    ({"time": 1729386000, "summary": "Mostly Cloudy", "icon": "partly-cloudy-day", "temperature": 80.2,
+      "cloudCover": 0.75, "visibility": 10000, "precipIntensity": 0},
+     "cloudy"),
+    ({"time": 1729389600, "summary": "Partly Cloudy", "icon": "partly-cloudy-day", "temperature": 82.4,
+      "cloudCover": 0.35, "visibility": 10000, "precipIntensity": 0},
+     "partly-cloudy"),
+    ({"time": 1729393200, "summary": "Cloudy", "icon": "partly-cloudy-night", "cloudCover": "0.6"},
+     "cloudy"),
+    ({"time": 1729396800, "summary": "Overcast", "icon": "cloudy", "cloudCover": 0.1},
+     "cloudy"),
+    ({"time": 1729400400, "summary": "Clear", "icon": "", "weather": {"icon": "snow"}},
+     "snow"),
+    ({"time": 1729404000, "summary": "Clear", "weather": {"icon": "light-rain"}, "visibility": 500},
+     "rain"),
+    ({"time": 1729407600, "icon": "Mist", "visibility": 10000},
+     "fog"),
+    # Thresholds
+    ({"time": 1729411200, "summary": "Overcast", "precipIntensity": 0.52, "visibility": 8000},
+     "rain"),
+    ({"time": 1729414800, "summary": "Overcast", "precipitationIntensity": "", "precipIntensity": 0.3},
+     "rain"),
+    ({"time": 1729418400, "summary": "Overcast", "precipIntensity": 0.1, "visibility": 9000},
+     "any"),
+    ({"time": 1729422000, "summary": "Overcast", "precipIntensity": 0, "visibility": 1500},
+     "fog"),
+    ({"time": 1729425600, "summary": "Overcast", "precipIntensity": 0, "visibility": 0},
+     "fog"),
+    ({"time": 1729429200, "summary": "Clear", "precipIntensity": "", "visibility": ""},
+     "clear"),
+    ({"time": 1729432800, "summary": "Overcast", "precipIntensity": 0, "visibility": 2000},
+     "any"),
+    # Summaries
+    ({"time": 1729436400, "summary": "Thunderstorms and Rain", "cloudCover": 0.9, "visibility": 6000},
+     "thunderstorm"),
+    ({"time": 1729440000, "summary": "Rain with distant lightning", "visibility": 6000},
+     "thunderstorm"),
+    ({"time": 1729443600, "summary": "Light Drizzle", "visibility": 6000},
+     "rain"),
+    ({"time": 1729447200, "summary": "Haze", "visibility": 4000},
+     "fog"),
+    ({"time": 1729450800, "summary": "Possible Flurries and Snow"},
+     "snow"),
+    # Malformed values
+    ({"time": 1729454400, "icon": "partly-cloudy-day", "cloudCover": "n/a"},
+     "partly-cloudy"),
+    ({"time": 1729458000, "icon": 42, "precipIntensity": "heavy", "visibility": None, "summary": "Rain"},
+     "rain"),
+    ({"time": 1729461600, "icon": None, "precipIntensity": [0.5], "visibility": {"value": 100},
+      "summary": 7},
+     "any"),
+    ({"time": 1729465200, "weather": "rain", "summary": None},
+     "any"),
+    # Fallback
+    ({"time": 1729468800, "icon": "unknown-icon", "summary": "Overcast", "visibility": 10000},
+     "any"),
+    ({}, "any"),
+    (None, "any"),
+    ([], "any"),
+    ("clear", "any"),
+]
+
+
+def get_catalog_weather_keys():
+    return {key for weathers in load_song_dictionary().values() for key in weathers}
+
+
+@pytest.mark.parametrize("payload, expected", RECORDED_PAYLOADS)
+def test_recorded_payload(payload, expected):
+    key = infer_weather_key_from_ambee(payload)
+
+    assert key == expected
+    assert key in get_catalog_weather_keys()
+
+
+def test_batch_matches_single_payloads():
+    payloads = [payload for payload, _ in RECORDED_PAYLOADS]
+    keys = infer_weather_keys_from_ambee(payloads)
+
+    assert keys == [expected for _, expected in RECORDED_PAYLOADS]
+    assert set(keys) <= get_catalog_weather_keys()
+
+
+def test_batch_of_repeated_payloads():
+    payloads = [payload for payload, _ in RECORDED_PAYLOADS] * 3
+
+    assert infer_weather_keys_from_ambee(iter(payloads)) == \
+        [infer_weather_key_from_ambee(payload) for payload in payloads]
+    assert infer_weather_keys_from_ambee([]) == []
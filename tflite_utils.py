@@ -1,3 +1,5 @@
+import time
+
 import numpy as np
 import tensorflow as tf
 
@@ -19,7 +21,7 @@ def get_tflite_model_predictions(tflite_model_path, image_data):
     output_details = interpreter.get_output_details()
 
     # Collect model's predictions for the input data
-    y_pred = np.zeros(len(image_data), dtype = np.int)
+    y_pred = np.zeros(len(image_data), dtype = int)
 
     # Model takes in images one by one
     for i in range(len(image_data)):
@@ -39,3 +41,209 @@ def get_tflite_model_predictions(tflite_model_path, image_data):
         y_pred[i] = prediction
 
     return y_pred
+
+def get_tflite_model_outputs(tflite_model, image_data, batch_size = 256):
+    '''Runs the tflite model on batches of input images.
+
+    Args:
+        tflite_model(string or bytes): path to .tflite model file or the
+                                       content of the model
+        image_data(ndarray): array of unnormalized images (n, 48, 48, 1)
+        batch_size(int): number of images passed to the model at once
+
+    Returns: float32 array with raw model outputs (n, n_classes).
+    '''
+    interpreter = get_interpreter(tflite_model)
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+
+    outputs = []
+    current_size = None
+    for start in range(0, len(image_data), batch_size):
+        batch = image_data[start:start + batch_size].astype(np.float32) / 255.
+        # Resize input only if the batch size has changed (e.g. last batch)
+        if len(batch) != current_size:
+            interpreter.resize_tensor_input(input_index, batch.shape)
+            interpreter.allocate_tensors()
+            current_size = len(batch)
+        interpreter.set_tensor(input_index, batch)
+        interpreter.invoke()
+        outputs.append(interpreter.get_tensor(output_index).copy())
+
+    return np.concatenate(outputs)
+
+def get_interpreter(tflite_model, num_threads = None):
+    '''Creates tflite interpreter with allocated tensors.
+
+    Args:
+        tflite_model(string or bytes): path to .tflite model file or the
+                                       content of the model
+        num_threads(int): number of threads used by the interpreter
+    '''
+    if isinstance(tflite_model, (bytes, bytearray, memoryview)):
+        interpreter = tf.lite.Interpreter(model_content = bytes(tflite_model),
+                                          num_threads = num_threads)
+    else:
+        interpreter = tf.lite.Interpreter(model_path = tflite_model,
+                                          num_threads = num_threads)
+    interpreter.allocate_tensors()
+    return interpreter
+
+def convert_to_tflite(model,
+                      quantize = False,
+                      representative_images = None,
+                      integer_io = False):
+    '''Converts a keras model to tflite.
+
+    Args:
+        model(keras.Model): model to convert
+        quantize(boolean): whether to apply post-training quantization (dynamic
+                           range or, if representative images are given, full
+                           integer quantization of weights and activations)
+        representative_images(ndarray): unnormalized images (n, 48, 48, 1)
+                                        used to calibrate activation ranges,
+                                        with them the conversion fails if an
+                                        operator has no int8 kernel instead of
+                                        falling back to float
+        integer_io(boolean): whether a fully quantized model should also take
+                             int8 input and return int8 output (float32 if
+                             False)
+
+    Returns: bytes of the tflite model.
+    '''
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if representative_images is not None:
+            def representative_dataset():
+                for image in representative_images[:500]:
+                    image = image.astype(np.float32) / 255.
+                    yield [np.expand_dims(image, axis = 0)]
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [
+                tf.lite.OpsSet.TFLITE_BUILTINS_INT8
+            ]
+            if integer_io:
+                converter.inference_input_type = tf.int8
+                converter.inference_output_type = tf.int8
+    return converter.convert()
+
+def quantize_input(input_data, input_details):
+    '''Converts float input to the dtype of a model input. Fully quantized
+    models take integer input, which is scaled with the input's quantization
+    parameters.
+
+    Args:
+        input_data(ndarray): float input
+        input_details(dict): details of the input from get_input_details()
+
+    Returns: input array with the dtype of the model input.
+    '''
+    dtype = input_details['dtype']
+    if np.issubdtype(dtype, np.floating):
+        return input_data.astype(dtype)
+    scale, zero_point = input_details['quantization']
+    if scale:
+        input_data = np.rint(input_data / scale + zero_point)
+    info = np.iinfo(dtype)
+    return np.clip(input_data, info.min, info.max).astype(dtype)
+
+def dequantize_output(outputs, output_details):
+    '''Converts integer outputs of a fully quantized model to float32 using
+    the output's quantization parameters. Float outputs are returned as they are.
+    '''
+    if np.issubdtype(output_details['dtype'], np.floating):
+        return outputs
+    scale, zero_point = output_details['quantization']
+    if not scale:
+        return outputs.astype(np.float32)
+    return ((outputs.astype(np.float32) - zero_point) * scale).astype(np.float32)
+
+def softmax(x):
+    '''Computes softmax of every row of logits'''
+    x = x - np.max(x, axis = -1, keepdims = True)
+    e = np.exp(x)
+    return e / np.sum(e, axis = -1, keepdims = True)
+
+def to_probabilities(outputs, from_logits = True):
+    '''Returns model outputs as class probabilities.
+
+    Args:
+        outputs(ndarray): (n, n_classes) model outputs
+        from_logits(boolean): whether the model outputs logits (softmax is
+                              applied) or probabilities (returned as they
+                              are), decide it once per model with
+                              outputs_are_logits or keras_outputs_are_logits
+    '''
+    outputs = np.asarray(outputs, dtype = np.float32)
+    return softmax(outputs) if from_logits else outputs
+
+def outputs_are_logits(interpreter):
+    '''Tells whether the first output of a tflite model is logits, i.e. it is
+    not produced by a SOFTMAX operator (possibly followed by (de)quantization).
+    Models without operator details are assumed to output logits, like the
+    models trained in this repo.'''
+    get_ops_details = getattr(interpreter, '_get_ops_details', None)
+    if get_ops_details is None:
+        return True
+    producers = {}
+    for op in get_ops_details():
+        for tensor_index in op['outputs']:
+            producers[int(tensor_index)] = op
+
+    tensor_index = interpreter.get_output_details()[0]['index']
+    op = producers.get(tensor_index)
+    while op is not None and op['op_name'] in ('QUANTIZE', 'DEQUANTIZE'):
+        op = producers.get(int(op['inputs'][0]))
+    return op is None or op['op_name'] != 'SOFTMAX'
+
+def keras_outputs_are_logits(model):
+    '''Tells whether a keras model outputs logits, i.e. its last layer is not
+    a Softmax layer or a layer with softmax activation'''
+    last_layer = model.layers[-1]
+    if isinstance(last_layer, tf.keras.layers.Softmax):
+        return False
+    return getattr(last_layer, 'activation', None) is not tf.keras.activations.softmax
+
+def measure_tflite_latency(tflite_model,
+                           batch_size = 1,
+                           num_threads = 1,
+                           n_runs = 100,
+                           n_warmup = 10):
+    '''Measures latency of a single invoke of the tflite model on random input.
+
+    Args:
+        tflite_model(string or bytes): path to .tflite model file or the
+                                       content of the model
+        batch_size(int): number of images passed to the model at once
+        num_threads(int): number of threads used by the interpreter
+        n_runs(int): number of timed invokes
+        n_warmup(int): number of invokes before timing
+
+    Returns: a dict with mean, p50 and p95 latency in milliseconds and
+             throughput in images per second.
+    '''
+    interpreter = get_interpreter(tflite_model, num_threads)
+    input_details = interpreter.get_input_details()[0]
+    input_shape = [batch_size] + list(input_details['shape'][1:])
+    interpreter.resize_tensor_input(input_details['index'], input_shape)
+    interpreter.allocate_tensors()
+
+    input_data = np.random.default_rng(0).random(input_shape)
+    interpreter.set_tensor(input_details['index'],
+                           quantize_input(input_data, input_details))
+
+    for _ in range(n_warmup):
+        interpreter.invoke()
+
+    latencies = np.empty(n_runs)
+    for i in range(n_runs):
+        start = time.perf_counter()
+        interpreter.invoke()
+        latencies[i] = time.perf_counter() - start
+
+    latencies *= 1000.
+    return {'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'images_per_sec': float(batch_size * 1000. / latencies.mean())}
@@ -0,0 +1,462 @@
+from data import augmentation_bank, tf_data
+from data.data import has_sparse_labels
+from tensorflow import keras
+import copy
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+STATE_FILE_NAME = 'state.json'
+
+HISTORY_LOG_FILE_NAME = 'history.jsonl'
+
+
+def get_loss(params, from_logits = True):
+    '''Returns the loss matching labels produced by the data pipeline.
+
+    Args:
+        params(DataPipelineParams): parameters of the training data pipeline
+        from_logits(boolean): whether the model outputs logits
+
+    Returns: sparse categorical cross-entropy for integer class labels,
+             categorical cross-entropy for basis vectors and distributions.
+    '''
+    if has_sparse_labels(params):
+        return keras.losses.SparseCategoricalCrossentropy(from_logits = from_logits)
+    return keras.losses.CategoricalCrossentropy(from_logits = from_logits)
+
+def get_metrics(params):
+    '''Returns training metrics matching labels produced by the data pipeline.
+
+    Args:
+        params(DataPipelineParams): parameters of the training data pipeline
+    '''
+    if has_sparse_labels(params):
+        return [keras.metrics.SparseCategoricalAccuracy(name = 'accuracy')]
+    return [keras.metrics.CategoricalAccuracy(name = 'accuracy')]
+
+def compile_model(model, params, learning_rate, from_logits = True):
+    '''Compiles the model with Adam optimizer and the loss and metrics matching
+    the labels (basis vectors, distributions or integer class indices).
+
+    Args:
+        model(keras.Model): model to compile
+        params(DataPipelineParams): parameters of the training data pipeline
+        learning_rate(float)
+        from_logits(boolean): whether the model outputs logits
+
+    Returns: the compiled model.
+    '''
+    model.compile(optimizer = keras.optimizers.Adam(learning_rate = learning_rate),
+                  loss = get_loss(params, from_logits),
+                  metrics = get_metrics(params))
+    return model
+
+
+class TrainingParams():
+    '''Wrapper object for train_model parameters'''
+
+    def __init__(self,
+                 epochs = 10,
+                 learning_rate = 0.005,
+                 mixed_precision = None,
+                 jit_compile = False,
+                 batch_size_multiplier = 1):
+        '''Args:
+            epochs(int)
+            learning_rate(float): learning rate for the base batch size
+            mixed_precision(string): keras mixed precision policy, e.g.
+                                     'mixed_bfloat16' (fast on modern CPUs) or
+                                     'mixed_float16' (GPUs), None for float32
+            jit_compile(boolean): whether to compile the training step with XLA
+            batch_size_multiplier(int): multiplies the batch size of the data
+                                        pipeline, learning rate is scaled
+                                        linearly with it
+        '''
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+        self.mixed_precision = mixed_precision
+        self.jit_compile = jit_compile
+        self.batch_size_multiplier = batch_size_multiplier
+
+
+class EpochTimer(keras.callbacks.Callback):
+    '''Adds wall time of every epoch to the training logs as 'epoch_time'.'''
+
+    def on_epoch_begin(self, epoch, logs = None):
+        self._start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs = None):
+        if logs is not None:
+            logs['epoch_time'] = time.perf_counter() - self._start
+
+
+class HistoryLogger(keras.callbacks.Callback):
+    '''Appends metrics of every epoch as a JSON line to a log file, so that the
+    history can be read (e.g. by predictions.plot_training_history) while
+    training is still running and survives a crash.'''
+
+    def __init__(self, log_path):
+        '''Args:
+            log_path(string): path to .jsonl file, appended if it exists
+        '''
+        super().__init__()
+        self.log_path = log_path
+
+    def on_epoch_end(self, epoch, logs = None):
+        record = {'epoch': epoch}
+        record.update({key: float(value) for key, value in (logs or {}).items()})
+        with open(self.log_path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+
+class ResumableCheckpoint(keras.callbacks.Callback):
+    '''Periodically saves weights, optimizer state, the epoch and the position
+    of a keras data iterator (e.g. from data.get_data_pipeline), so that
+    training can be resumed exactly with fit_resumable.
+
+    Pipelines from data.tf_data derive shuffling and augmentation from the
+    epoch number, so for them it is enough to create the pipeline with
+    initial_epoch = get_initial_epoch(checkpoint_dir).'''
+
+    def __init__(self, checkpoint_dir, data_iterator = None, save_freq = 1, max_to_keep = 3):
+        '''Args:
+            checkpoint_dir(string): directory for checkpoints
+            data_iterator(keras Iterator): training iterator whose position
+                                           should be saved
+            save_freq(int): save every save_freq epochs
+            max_to_keep(int): number of kept checkpoints
+        '''
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.data_iterator = data_iterator
+        self.save_freq = save_freq
+        self.max_to_keep = max_to_keep
+        self._manager = None
+
+    def on_train_begin(self, logs = None):
+        self._manager = _get_checkpoint_manager(self.model,
+                                                self.checkpoint_dir,
+                                                self.max_to_keep)
+
+    def on_epoch_end(self, epoch, logs = None):
+        if (epoch + 1) % self.save_freq != 0:
+            return
+        checkpoint_path = self._manager.save(checkpoint_number = epoch + 1)
+        state = {'epoch': epoch + 1,
+                 'checkpoint': os.path.basename(checkpoint_path),
+                 'iterator': _get_iterator_state(self.data_iterator)}
+        # Write atomically, so that a crash never leaves a broken state file
+        state_path = os.path.join(self.checkpoint_dir, STATE_FILE_NAME)
+        with open(state_path + '.tmp', 'w') as file:
+            json.dump(state, file)
+        os.replace(state_path + '.tmp', state_path)
+
+
+def train_model(build_model,
+                dataset_dict,
+                pipeline_params,
+                training_params,
+                callbacks = None,
+                augmentation_bank_dir = None):
+    '''Builds and trains a model on tf.data pipelines, optionally with mixed
+    precision, XLA compilation and a larger batch.
+
+    Args:
+        build_model(function): function without arguments returning a model
+                               with logits output (e.g. a lambda calling
+                               models.get_performance_model), it is called
+                               after the precision policy is set
+        dataset_dict(dict): datasets created using dataset.get_dataset_dict()
+        pipeline_params(DataPipelineParams): parameters of the training pipeline
+        training_params(TrainingParams): parameters of the training
+        callbacks(list): additional keras callbacks
+        augmentation_bank_dir(string): optional directory of an augmentation
+                                       bank (data.augmentation_bank) to train
+                                       on instead of augmenting on the fly
+
+    Returns: a tuple (model, history dict). History contains also
+             'epoch_time' of every epoch.
+    '''
+    # Larger effective batch with linearly scaled learning rate
+    multiplier = training_params.batch_size_multiplier
+    pipeline_params = copy.copy(pipeline_params)
+    pipeline_params.batch_size *= multiplier
+    # Validate on majority labels in the same format as the training labels
+    test_params = copy.copy(pipeline_params)
+    test_params.cross_entropy = False
+    test_params.sparse_labels = has_sparse_labels(pipeline_params)
+
+    if augmentation_bank_dir is not None:
+        training_pipeline, steps_per_epoch = \
+            augmentation_bank.get_augmentation_bank_pipeline(augmentation_bank_dir,
+                                                             pipeline_params)
+    else:
+        training_pipeline, steps_per_epoch = tf_data.get_tf_data_pipeline(
+            dataset_dict['train'],
+            pipeline_params,
+            shuffle = True
+        )
+    validation_pipeline, _ = tf_data.get_tf_data_pipeline(dataset_dict['valid'],
+                                                          test_params)
+
+    previous_policy = keras.mixed_precision.global_policy()
+    if training_params.mixed_precision:
+        keras.mixed_precision.set_global_policy(training_params.mixed_precision)
+    try:
+        model = build_model()
+    finally:
+        keras.mixed_precision.set_global_policy(previous_policy)
+
+    optimizer = keras.optimizers.Adam(
+        learning_rate = training_params.learning_rate * multiplier
+    )
+    model.compile(optimizer = optimizer,
+                  loss = get_loss(pipeline_params),
+                  metrics = get_metrics(pipeline_params),
+                  jit_compile = training_params.jit_compile)
+
+    history = model.fit(training_pipeline,
+                        validation_data = validation_pipeline,
+                        epochs = training_params.epochs,
+                        steps_per_epoch = steps_per_epoch,
+                        callbacks = [EpochTimer()] + (callbacks or []))
+
+    return model, _to_json_history(history.history)
+
+def compare_training_modes(build_model,
+                           dataset_dict,
+                           pipeline_params,
+                           training_params_dict,
+                           baseline = 'baseline',
+                           report_path = None):
+    '''Trains the same architecture with every training configuration and
+    compares epoch time and final accuracy against the baseline.
+
+    Example:
+        compare_training_modes(
+            build_model,
+            dataset_dict,
+            pipeline_params,
+            {'baseline': TrainingParams(epochs = 5),
+             'bf16_xla': TrainingParams(epochs = 5,
+                                        mixed_precision = 'mixed_bfloat16',
+                                        jit_compile = True),
+             'bf16_xla_x4': TrainingParams(epochs = 5,
+                                           mixed_precision = 'mixed_bfloat16',
+                                           jit_compile = True,
+                                           batch_size_multiplier = 4)})
+
+    Args:
+        build_model(function): see train_model
+        dataset_dict(dict): datasets created using dataset.get_dataset_dict()
+        pipeline_params(DataPipelineParams): parameters of the training pipeline
+        training_params_dict(dict(string, TrainingParams)): named configurations
+        baseline(string): name of the baseline configuration
+        report_path(string): optional path of a JSON file to save the report
+
+    Returns: a dict with results of every configuration.
+    '''
+    report = {}
+    for name, training_params in training_params_dict.items():
+        _, history = train_model(build_model,
+                                 dataset_dict,
+                                 pipeline_params,
+                                 training_params)
+        # The first epoch includes tracing and XLA compilation
+        epoch_times = history['epoch_time'][1:] or history['epoch_time']
+        report[name] = {
+            'mixed_precision': training_params.mixed_precision,
+            'jit_compile': training_params.jit_compile,
+            'batch_size': pipeline_params.batch_size
+                          * training_params.batch_size_multiplier,
+            'first_epoch_time': history['epoch_time'][0],
+            'mean_epoch_time': float(np.mean(epoch_times)),
+            'final_accuracy': history['accuracy'][-1],
+            'final_val_accuracy': history['val_accuracy'][-1],
+            'final_val_loss': history['val_loss'][-1]
+        }
+
+    base = report[baseline]
+    for results in report.values():
+        results['speedup'] = base['mean_epoch_time'] / results['mean_epoch_time']
+        results['val_accuracy_delta'] = (results['final_val_accuracy']
+                                         - base['final_val_accuracy'])
+
+    _print_comparison(report)
+    if report_path is not None:
+        with open(report_path, 'w') as file:
+            json.dump(report, file, indent = 2)
+    return report
+
+def get_initial_epoch(checkpoint_dir):
+    '''Returns the epoch from which training continues, 0 if there is no
+    checkpoint in the directory'''
+    state = _read_state(checkpoint_dir)
+    return state['epoch'] if state else 0
+
+def restore_checkpoint(model, checkpoint_dir, data_iterator = None):
+    '''Restores weights, optimizer state and the data iterator position from
+    the latest checkpoint. The model has to be compiled beforehand.
+
+    Args:
+        model(keras.Model): compiled model
+        checkpoint_dir(string): directory with checkpoints
+        data_iterator(keras Iterator): training iterator to move to the saved
+                                       position
+
+    Returns: the epoch from which training continues (0 if nothing was
+             restored).
+    '''
+    state = _read_state(checkpoint_dir)
+    if state is None:
+        return 0
+
+    checkpoint = tf.train.Checkpoint(model = model, optimizer = model.optimizer)
+    # Optimizer slots are restored once they are created in the first step
+    checkpoint.restore(os.path.join(checkpoint_dir, state['checkpoint']))
+    _set_iterator_state(data_iterator, state['iterator'])
+    print('Restored {} (epoch {})'.format(state['checkpoint'], state['epoch']))
+    return state['epoch']
+
+def fit_resumable(model,
+                  training_data,
+                  checkpoint_dir,
+                  epochs,
+                  validation_data = None,
+                  steps_per_epoch = None,
+                  callbacks = None,
+                  save_freq = 1,
+                  augmentation_bank_dir = None,
+                  pipeline_params = None):
+    '''Trains a compiled model with periodic checkpoints, continuing from the
+    latest checkpoint in checkpoint_dir if there is one. Metrics of every
+    epoch are appended to history.jsonl in checkpoint_dir.
+
+    Keras iterators (data.get_data_pipeline) are resumed at the exact batch
+    position, they shuffle themselves, so fit is called with shuffle = False.
+    Pipelines from data.tf_data have to be created with
+    initial_epoch = get_initial_epoch(checkpoint_dir). If augmentation_bank_dir
+    is given, the training pipeline is created from the bank at the restored
+    epoch and training_data should be None.
+
+    Args:
+        model(keras.Model): compiled model
+        training_data: keras iterator or tf.data pipeline
+        checkpoint_dir(string): directory for checkpoints and the history log
+        epochs(int): total number of epochs
+        validation_data: validation pipeline
+        steps_per_epoch(int): required for endless tf.data pipelines
+        callbacks(list): additional keras callbacks
+        save_freq(int): save a checkpoint every save_freq epochs
+        augmentation_bank_dir(string): optional directory of an augmentation
+                                       bank (data.augmentation_bank)
+        pipeline_params(DataPipelineParams): parameters of the bank pipeline,
+                                             required with augmentation_bank_dir
+
+    Returns: history dict read from the log, including epochs trained before
+             the resume.
+    '''
+    os.makedirs(checkpoint_dir, exist_ok = True)
+    data_iterator = training_data if isinstance(
+        training_data, keras.preprocessing.image.Iterator) else None
+
+    initial_epoch = restore_checkpoint(model, checkpoint_dir, data_iterator)
+    if augmentation_bank_dir is not None:
+        training_data, steps_per_epoch = \
+            augmentation_bank.get_augmentation_bank_pipeline(
+                augmentation_bank_dir,
+                pipeline_params,
+                initial_epoch = initial_epoch
+            )
+    log_path = os.path.join(checkpoint_dir, HISTORY_LOG_FILE_NAME)
+    model.fit(training_data,
+              validation_data = validation_data,
+              epochs = epochs,
+              initial_epoch = initial_epoch,
+              steps_per_epoch = steps_per_epoch,
+              shuffle = False,
+              callbacks = [HistoryLogger(log_path),
+                           ResumableCheckpoint(checkpoint_dir,
+                                               data_iterator,
+                                               save_freq)] + (callbacks or []))
+
+    from predictions import read_history_log
+    return read_history_log(log_path)
+
+def _get_checkpoint_manager(model, checkpoint_dir, max_to_keep):
+    '''Returns checkpoint manager of the model and its optimizer'''
+    checkpoint = tf.train.Checkpoint(model = model, optimizer = model.optimizer)
+    return tf.train.CheckpointManager(checkpoint,
+                                      checkpoint_dir,
+                                      max_to_keep = max_to_keep)
+
+def _read_state(checkpoint_dir):
+    '''Returns the state of the latest checkpoint or None'''
+    state_path = os.path.join(checkpoint_dir, STATE_FILE_NAME)
+    if not os.path.isfile(state_path):
+        return None
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+def _get_iterator_state(data_iterator):
+    '''Returns JSON serializable position of a keras iterator. Keras
+    iterators reseed numpy with seed + total_batches_seen and reshuffle the
+    index array with numpy at the end of every epoch, so this is enough to
+    continue with the same batches.'''
+    if data_iterator is None:
+        return None
+    random_state = np.random.get_state()
+    return {'total_batches_seen': data_iterator.total_batches_seen,
+            'batch_index': data_iterator.batch_index,
+            'index_array': (None if data_iterator.index_array is None
+                            else data_iterator.index_array.tolist()),
+            'numpy_random_state': [random_state[0],
+                                   random_state[1].tolist(),
+                                   *random_state[2:]]}
+
+def _set_iterator_state(data_iterator, state):
+    '''Moves a keras iterator to the saved position'''
+    if data_iterator is None or state is None:
+        return
+    data_iterator.total_batches_seen = state['total_batches_seen']
+    data_iterator.batch_index = state['batch_index']
+    if state['index_array'] is not None:
+        data_iterator.index_array = np.array(state['index_array'])
+    random_state = state['numpy_random_state']
+    np.random.set_state((random_state[0],
+                         np.array(random_state[1], dtype = np.uint32),
+                         *random_state[2:]))
+    # Checkpoints are saved before keras reshuffles the iterator for the
+    # next epoch, so do it now with the same random state
+    data_iterator.on_epoch_end()
+
+def _to_json_history(history_dict):
+    '''Converts history values to floats, so that it can be saved as JSON'''
+    return {key: [float(value) for value in values]
+            for key, values in history_dict.items()}
+
+def _print_comparison(report):
+    '''Prints the comparison of training modes as a console table'''
+    header = '{:<16} {:>8} {:>12} {:>9} {:>9} {:>10}'.format('Mode',
+                                                            'Batch',
+                                                            'Epoch [s]',
+                                                            'Speedup',
+                                                            'Val acc',
+                                                            'Acc delta')
+    print(header)
+    print('-' * len(header))
+    for name, r in report.items():
+        print('{:<16} {:>8} {:>12.2f} {:>9.2f} {:>9.4f} {:>+10.4f}'.format(
+            name[:16],
+            r['batch_size'],
+            r['mean_epoch_time'],
+            r['speedup'],
+            r['final_val_accuracy'],
+            r['val_accuracy_delta']))
@@ -0,0 +1,129 @@
+import asyncio
+import random
+import time
+from collections import deque
+
+
+class WeatherPrefetcher:
+    """Keeps the weather of the most requested cells warm in the engine cache.
+
+    Every interval seconds it decays the request counts of cells, adds the
+    requests since the last tick and refreshes the hottest cells whose cached
+    weather expires within refresh_margin seconds (minus a random jitter per
+    cell, so refreshes of cells cached together spread out). Refreshes run in
+    threads with at most max_concurrency at once and at most
+    max_requests_per_minute Ambee calls. While Ambee rate limits the engine
+    (HTTP 429), refreshes are skipped.
+
+    With serve.py every worker has its own cache and prefetcher, so the
+    request budget applies per worker.
+    """
+
+    def __init__(self, engine, max_cells=50, refresh_margin=120, jitter=60, interval=10,
+                 max_concurrency=4, max_requests_per_minute=30, decay=0.8):
+        self.engine = engine
+        self.max_cells = max_cells
+        self.refresh_margin = refresh_margin
+        self.jitter = jitter
+        self.interval = interval
+        self.max_concurrency = max_concurrency
+        self.max_requests_per_minute = max_requests_per_minute
+        self.decay = decay
+        self.scores = {}
+        self.jitter_offsets = {}
+        self.request_times = deque()
+        self.stats = {"refreshes": 0, "failures": 0, "budget_skips": 0, "rate_limited_skips": 0}
+        self.task = None
+
+    def start(self):
+        # The engine counts requests per cell only while they are consumed here
+        self.engine.track_weather_demand = True
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.engine.track_weather_demand = False
+        self.engine.weather_demand.clear()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick(semaphore)
+            except Exception as e:
+                print(f"Weather prefetch error: {e}")
+
+    async def tick(self, semaphore):
+        """Refresh hot cells that are about to expire"""
+        now = time.time()
+        due = [cell for cell in self.get_hot_cells() if self._is_due(cell, now)]
+        await asyncio.gather(*(self._refresh(cell, semaphore) for cell in due))
+
+    def get_hot_cells(self):
+        """Update decayed request counts and return the hottest cells"""
+        demand = self.engine.weather_demand
+        self.engine.weather_demand = type(demand)()
+        for cell in list(self.scores):
+            self.scores[cell] *= self.decay
+            if self.scores[cell] < 0.01 and cell not in demand:
+                del self.scores[cell]
+                self.jitter_offsets.pop(cell, None)
+        for cell, count in demand.items():
+            self.scores[cell] = self.scores.get(cell, 0.0) + count
+        return sorted(self.scores, key=self.scores.get, reverse=True)[:self.max_cells]
+
+    def _is_due(self, cell, now):
+        cached = self.engine.weather_cache.get(cell)
+        if cached is None:
+            return True
+        if cell not in self.jitter_offsets:
+            self.jitter_offsets[cell] = random.uniform(0, self.jitter)
+        expires = cached[1] + self.engine.weather_cache_duration
+        return now >= expires - self.refresh_margin - self.jitter_offsets[cell]
+
+    async def _refresh(self, cell, semaphore):
+        async with semaphore:
+            if time.time() < self.engine.weather_backoff_until:
+                self.stats["rate_limited_skips"] += 1
+                return
+            if not self._take_request_budget():
+                self.stats["budget_skips"] += 1
+                return
+            weather_key = await asyncio.to_thread(self.engine.fetch_weather, cell, True)
+            if weather_key is None:
+                self.stats["failures"] += 1
+            else:
+                self.stats["refreshes"] += 1
+                # A new offset for the next refresh of this cell
+                self.jitter_offsets[cell] = random.uniform(0, self.jitter)
+
+    def _take_request_budget(self):
+        """Allow at most max_requests_per_minute calls in any 60 second window"""
+        now = time.monotonic()
+        while self.request_times and now - self.request_times[0] > 60:
+            self.request_times.popleft()
+        if len(self.request_times) >= self.max_requests_per_minute:
+            return False
+        self.request_times.append(now)
+        return True
+
+    def get_metrics(self):
+        """Return prefetch counters and the share of weather lookups served by prefetched entries"""
+        weather_stats = self.engine.weather_stats
+        lookups = weather_stats['hits'] + weather_stats['misses']
+        return dict(
+            self.stats,
+            tracked_cells=len(self.scores),
+            lookups=lookups,
+            cache_hits=weather_stats['hits'],
+            prefetched_hits=weather_stats['prefetched_hits'],
+            cache_hit_ratio=weather_stats['hits'] / lookups if lookups else 0.0,
+            prefetch_hit_ratio=weather_stats['prefetched_hits'] / lookups if lookups else 0.0,
+            upstream_rate_limited=weather_stats['rate_limited'],
+        )